@@ -0,0 +1,523 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import metrics
+import schema
+import weather_data_analysis as an
+from db_pool import ReadOnlyPool
+from lazy import is_available, lazy_import
+from schema import DB_PATH
+
+pd = lazy_import('pandas')
+if is_available('pyarrow'):
+    pa = lazy_import('pyarrow')
+else:  # Arrow responses are optional
+    pa = None
+
+JSON_TYPE = 'application/json'
+ARROW_TYPE = 'application/vnd.apache.arrow.stream'
+
+# observation ranges longer than this are streamed STREAM_WINDOW seconds at a time, in chunked responses
+STREAM_THRESHOLD = 31 * 86400
+STREAM_WINDOW = 7 * 86400
+
+# seconds an idle keep-alive connection stays open
+KEEP_ALIVE_SECONDS = 30
+# seconds a client has to send the headers and body of a request once its request line arrived
+REQUEST_SECONDS_LIMIT = 10
+MAX_HEADERS = 100
+
+# end-of-stream marker of the Arrow IPC stream format
+_ARROW_EOS = b'\xff\xff\xff\xff\x00\x00\x00\x00'
+
+REQUEST_SECONDS = metrics.histogram('weather_api_request_seconds', "Duration of the API requests.",
+                                    ('endpoint', 'status'))
+NOT_MODIFIED = metrics.counter('weather_api_not_modified_total', "Requests answered with 304 Not Modified.",
+                               ('endpoint',))
+
+_REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            406: 'Not Acceptable', 431: 'Request Header Fields Too Large', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    """
+    An error answered to the client with its status and message.
+    """
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class _Exchange:
+    """
+    One request and the state of its response on a keep-alive connection.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, method: str, query: dict[str, list[str]],
+                 headers: dict[str, str], keep_alive: bool) -> None:
+        self.writer = writer
+        self.head = method == 'HEAD'
+        self.query = query
+        self.headers = headers
+        self.keep_alive = keep_alive
+        self.started = False
+
+    def param(self, name: str, default: str | None = None) -> str:
+        values = self.query.get(name)
+        if values:
+            return values[-1]
+        if default is None:
+            raise HTTPError(400, f"missing parameter '{name}'")
+        return default
+
+    def start(self, status: int, headers: dict[str, str]) -> None:
+        headers = {**headers, 'Connection': 'keep-alive' if self.keep_alive else 'close'}
+        head = f'HTTP/1.1 {status} {_REASONS[status]}\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in headers.items())
+        self.writer.write(f'{head}\r\n'.encode('latin-1'))
+        self.started = True
+
+    async def send(self, status: int, body: bytes, headers: dict[str, str]) -> None:
+        self.start(status, {**headers, 'Content-Length': str(len(body))})
+        if not self.head:
+            self.writer.write(body)
+        await self.writer.drain()
+
+    async def send_chunk(self, data: bytes) -> None:
+        if data and not self.head:
+            self.writer.write(b'%x\r\n%b\r\n' % (len(data), data))
+            await self.writer.drain()
+
+    async def end_chunks(self) -> None:
+        if not self.head:
+            self.writer.write(b'0\r\n\r\n')
+        await self.writer.drain()
+
+
+def _iso(value: str) -> tuple[int, str]:
+    try:
+        ts = schema.to_epoch(value)
+    except ValueError:
+        raise HTTPError(400, f"invalid date '{value}', expected ISO format") from None
+    return ts, schema.from_epoch(ts).isoformat()
+
+
+def _json(df: pd.DataFrame) -> bytes:
+    return df.to_json(orient='records', date_format='iso', date_unit='s', double_precision=6).encode()
+
+
+def _arrow_frame(df: pd.DataFrame) -> pd.DataFrame:
+    # plain strings rather than categoricals, whose dictionaries would differ between streamed chunks
+    for column in df.columns[[dtype == 'category' for dtype in df.dtypes]]:
+        df[column] = df[column].astype(object)
+    return df
+
+
+def _arrow(df: pd.DataFrame) -> bytes:
+    table = pa.Table.from_pandas(_arrow_frame(df), preserve_index=False)
+    return (table.schema.serialize().to_pybytes()
+            + b''.join(batch.serialize().to_pybytes() for batch in table.to_batches()) + _ARROW_EOS)
+
+
+class QueryServer:
+    """
+    An asyncio HTTP/1.1 server answering range and aggregate queries on the weather database.
+
+    Endpoints (GET or HEAD), dates in ISO format:
+
+        /cities
+        /observations?city=<name>&start=<date>&end=<date>[&columns=temperature,humidity,weather,city]
+        /rollups?city=<name>[&city=...]&start=<date>&end=<date>[&grain=h|D|W|auto][&width=<pixels>]
+        /means?start=<date>&end=<date>[&city=...][&grain=h|D|W|auto][&width=<pixels>]
+
+    Responses are JSON records, or Arrow IPC streams with format=arrow or an `Accept:
+    application/vnd.apache.arrow.stream` header (requires pyarrow). Observation ranges longer
+    than STREAM_THRESHOLD are sent in chunks of STREAM_WINDOW, so memory stays bounded whatever
+    the range. Every response carries an ETag derived from the data it was computed from (the
+    raw rows for observations, the hourly rollups for aggregates), and requests whose
+    If-None-Match matches it get a 304 after an index-only check instead of the query.
+
+    Connections are served by one event loop, so many idle dashboard clients cost little; the
+    queries run on a pool of worker threads, each borrowing a read-only connection of the
+    server's ReadOnlyPool, passed to the weather_data_analysis queries, and share their query
+    cache. A client has KEEP_ALIVE_SECONDS to start a request and REQUEST_SECONDS_LIMIT more to
+    send its headers, after which its connection is closed.
+
+    Args:
+        db_path (str, optional): The path of the SQLite database. Defaults to DB_PATH.
+        host (str, optional): The address to listen on. Defaults to '127.0.0.1'.
+        port (int, optional): The port to listen on, 0 for any free port. Defaults to 8000.
+        workers (int, optional): The number of query threads and pooled connections. Defaults to 8.
+    """
+
+    def __init__(self, db_path: str = DB_PATH, host: str = '127.0.0.1', port: int = 8000, workers: int = 8) -> None:
+        self.db_path = db_path
+        self.host = host
+        self.port = port
+        self.pool = ReadOnlyPool(db_path, workers)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='api')
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.stopping = None
+
+    @property
+    def base_url(self) -> str:
+        """
+        The root URL of the endpoints.
+        """
+        return f'http://{self.host}:{self.port}'
+
+    def routes(self) -> dict[str, Callable]:
+        """
+        Maps the served paths to the coroutines answering them.
+        """
+        return {'/cities': self._cities, '/observations': self._observations, '/rollups': self._rollups,
+                '/means': self._means}
+
+    async def _run(self, function: Callable, *args):
+        return await self.loop.run_in_executor(self.executor, function, *args)
+
+    def _format(self, exchange: _Exchange) -> str:
+        fmt = exchange.param('format', 'arrow' if ARROW_TYPE in exchange.headers.get('accept', '') else 'json')
+        if fmt not in ('json', 'arrow'):
+            raise HTTPError(400, f"unknown format '{fmt}', expected json or arrow")
+        if fmt == 'arrow' and pa is None:
+            raise HTTPError(406, "Arrow responses require pyarrow, install it with 'pip install pyarrow'")
+        return fmt
+
+    @staticmethod
+    def _etag(exchange: _Exchange, path: str, fmt: str, version: tuple) -> str:
+        query = sorted((name, values) for name, values in exchange.query.items())
+        return f'"{hashlib.sha1(repr((path, query, fmt, version)).encode()).hexdigest()[:24]}"'
+
+    async def _not_modified(self, exchange: _Exchange, path: str, etag: str) -> bool:
+        tags = exchange.headers.get('if-none-match')
+        if tags is None or (tags.strip() != '*' and etag not in [tag.strip() for tag in tags.split(',')]):
+            return False
+        NOT_MODIFIED.inc(endpoint=path)
+        await exchange.send(304, b'', {'ETag': etag, 'Cache-Control': 'no-cache'})
+        return True
+
+    async def _send_frame(self, exchange: _Exchange, df: pd.DataFrame, fmt: str, etag: str) -> None:
+        body = await self._run(_arrow if fmt == 'arrow' else _json, df)
+        await exchange.send(200, body, {'Content-Type': ARROW_TYPE if fmt == 'arrow' else JSON_TYPE,
+                                        'ETag': etag, 'Cache-Control': 'no-cache'})
+
+    # -- versions of the data behind the responses, run on the worker threads
+
+    def _cities_version(self) -> tuple:
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT COUNT(*), MAX(city_id) FROM city').fetchone()
+
+    def _observations_version(self, city: str, starting_ts: int, ending_ts: int) -> tuple:
+        # index only: any insert raises the largest rowid, any deletion lowers the count
+        with self.pool.connection() as conn:
+            return conn.execute(
+                '''SELECT COUNT(*), MAX(rowid) FROM observation
+                WHERE city_id = (SELECT city_id FROM city WHERE name = ?) AND timestamp BETWEEN ? AND ?''',
+                (city, starting_ts, ending_ts)
+                ).fetchone()
+
+    def _rollups_version(self, cities: list[str], starting_ts: int, ending_ts: int, grain: str) -> tuple:
+        # the hourly buckets change with every observation inserted, whatever the grain served; those
+        # of every bucket served are covered, the first and last ones extending past the range
+        starting_ts, ending_ts = an.bucket_range(starting_ts, ending_ts, grain)
+        with self.pool.connection() as conn:
+            return tuple(conn.execute(
+                f"""SELECT city.name, COUNT(*), TOTAL(temp_count), TOTAL(temp_sum), MAX(bucket)
+                FROM rollup_hourly JOIN city USING (city_id)
+                WHERE city.name IN ({', '.join('?' * len(cities))}) AND bucket BETWEEN ? AND ?
+                GROUP BY city_id ORDER BY city.name""",
+                (*cities, starting_ts, ending_ts)
+                ).fetchall())
+
+    # -- endpoints
+
+    async def _cities(self, exchange: _Exchange) -> int:
+        etag = self._etag(exchange, '/cities', 'json', await self._run(self._cities_version))
+        if await self._not_modified(exchange, '/cities', etag):
+            return 304
+        cities = await self._run(an.list_cities, self.pool)
+        await exchange.send(200, json.dumps(cities).encode(), {'Content-Type': JSON_TYPE, 'ETag': etag,
+                                                                'Cache-Control': 'no-cache'})
+        return 200
+
+    async def _observations(self, exchange: _Exchange) -> int:
+        city = exchange.param('city')
+        starting_ts, starting_date = _iso(exchange.param('start'))
+        ending_ts, ending_date = _iso(exchange.param('end'))
+        columns = exchange.query.get('columns')
+        columns = [column for value in columns for column in value.split(',') if column] if columns else None
+        unknown = set(columns or ()) - set(an.WEATHER_COLUMNS) - {'city'}
+        if unknown:
+            raise HTTPError(400, f"unknown column(s): {', '.join(sorted(unknown))}")
+        fmt = self._format(exchange)
+
+        etag = self._etag(exchange, '/observations', fmt,
+                          await self._run(self._observations_version, city, starting_ts, ending_ts))
+        if await self._not_modified(exchange, '/observations', etag):
+            return 304
+        if ending_ts - starting_ts <= STREAM_THRESHOLD:
+            df = await self._run(an.fetch_data_from_db, city, starting_date, ending_date, columns, self.pool)
+            if df is None:
+                raise HTTPError(404, f"no observations of {city} between {starting_date} and {ending_date}")
+            await self._send_frame(exchange, df.reset_index(), fmt, etag)
+            return 200
+        return await self._stream_observations(exchange, city, starting_ts, ending_ts, columns, fmt, etag)
+
+    def _window(self, city: str, starting_ts: int, ending_ts: int, columns: list[str] | None, fmt: str,
+                arrow_schema: pa.Schema | None) -> tuple[bytes, pa.Schema | None]:
+        frames = list(an.iter_data_from_db(city, schema.from_epoch(starting_ts).isoformat(),
+                                           schema.from_epoch(ending_ts).isoformat(), columns, pool=self.pool))
+        if not frames:
+            return b'', arrow_schema
+        df = pd.concat(frames).reset_index()
+        if fmt == 'json':
+            return _json(df)[1:-1], None
+        df = _arrow_frame(df)
+        if arrow_schema is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            prefix = table.schema.serialize().to_pybytes()
+        else:
+            # same types as the first chunk, e.g. for a chunk whose descriptions are all missing
+            table = pa.Table.from_pandas(df, schema=arrow_schema, preserve_index=False)
+            prefix = b''
+        return prefix + b''.join(batch.serialize().to_pybytes() for batch in table.to_batches()), table.schema
+
+    async def _stream_observations(self, exchange: _Exchange, city: str, starting_ts: int, ending_ts: int,
+                                   columns: list[str] | None, fmt: str, etag: str) -> int:
+        arrow_schema = None
+        for start in range(starting_ts, ending_ts + 1, STREAM_WINDOW):
+            end = min(start + STREAM_WINDOW - 1, ending_ts)
+            # each window borrows a connection only while it is read, so slow clients do not hold one
+            data, arrow_schema = await self._run(self._window, city, start, end, columns, fmt, arrow_schema)
+            if not data:
+                continue
+            if not exchange.started:
+                exchange.start(200, {'Content-Type': ARROW_TYPE if fmt == 'arrow' else JSON_TYPE,
+                                           'ETag': etag, 'Cache-Control': 'no-cache',
+                                           'Transfer-Encoding': 'chunked'})
+                await exchange.send_chunk(b'[' + data if fmt == 'json' else data)
+            else:
+                await exchange.send_chunk(b',' + data if fmt == 'json' else data)
+            if exchange.head:
+                break
+        if not exchange.started:
+            raise HTTPError(404, f"no observations of {city} between {schema.from_epoch(starting_ts).isoformat()} "
+                                 f"and {schema.from_epoch(ending_ts).isoformat()}")
+        await exchange.send_chunk(b']' if fmt == 'json' else _ARROW_EOS)
+        await exchange.end_chunks()
+        return 200
+
+    @staticmethod
+    def _aggregate_params(exchange: _Exchange) -> tuple[int, str, int, str, str]:
+        starting_ts, starting_date = _iso(exchange.param('start'))
+        ending_ts, ending_date = _iso(exchange.param('end'))
+        grain = exchange.param('grain', 'auto')
+        if grain == 'auto':
+            width = exchange.param('width', '')
+            if width and not width.isdigit():
+                raise HTTPError(400, f"invalid width '{width}'")
+            grain = an.rollup_grain(starting_date, ending_date, int(width) if width else None)
+        elif grain not in an.GRAINS:
+            raise HTTPError(400, f"unknown grain '{grain}', expected one of {', '.join(an.GRAINS)} or auto")
+        return starting_ts, starting_date, ending_ts, ending_date, grain
+
+    async def _rollups(self, exchange: _Exchange) -> int:
+        cities = list(dict.fromkeys(exchange.query.get('city', [])))
+        if not cities:
+            raise HTTPError(400, "missing parameter 'city'")
+        starting_ts, starting_date, ending_ts, ending_date, grain = self._aggregate_params(exchange)
+        fmt = self._format(exchange)
+        version = await self._run(self._rollups_version, cities, starting_ts, ending_ts, grain)
+        etag = self._etag(exchange, '/rollups', fmt, (grain, version))
+        if await self._not_modified(exchange, '/rollups', etag):
+            return 304
+        df = await self._run(an.fetch_temperature_rollups, cities, starting_date, ending_date, grain, self.pool)
+        await self._send_frame(exchange, df, fmt, etag)
+        return 200
+
+    async def _means(self, exchange: _Exchange) -> int:
+        cities = list(dict.fromkeys(exchange.query.get('city', []))) or await self._run(an.list_cities, self.pool)
+        starting_ts, starting_date, ending_ts, ending_date, grain = self._aggregate_params(exchange)
+        fmt = self._format(exchange)
+        version = await self._run(self._rollups_version, cities, starting_ts, ending_ts, grain)
+        etag = self._etag(exchange, '/means', fmt, (grain, cities, version))
+        if await self._not_modified(exchange, '/means', etag):
+            return 304
+        df = await self._run(an.mean_temperature_by_city, starting_date, ending_date, cities, grain, self.pool)
+        df.columns = df.columns.astype(str)
+        await self._send_frame(exchange, df.reset_index(), fmt, etag)
+        return 200
+
+    # -- HTTP
+
+    async def _respond(self, exchange: _Exchange, path: str) -> None:
+        started = time.perf_counter()
+        status = 500
+        route = self.routes().get(path)
+        try:
+            if route is None:
+                raise HTTPError(404, f"unknown path '{path}'")
+            status = await route(exchange)
+        except HTTPError as error:
+            status = error.status
+            if exchange.started:
+                raise
+            await exchange.send(status, json.dumps({'error': error.message}).encode(), {'Content-Type': JSON_TYPE})
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except Exception as error:
+            metrics.log_event('api_error', level=logging.ERROR, path=path, error=repr(error))
+            if exchange.started:
+                raise
+            await exchange.send(500, json.dumps({'error': 'internal error'}).encode(), {'Content-Type': JSON_TYPE})
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=path if route else 'other',
+                                    status=str(status))
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> tuple[str, str, str, dict[str, str]] | None:
+        line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_SECONDS)
+        if not line:
+            return None
+        # a client trickling or withholding the rest of its request does not hold the connection
+        return await asyncio.wait_for(self._read_rest(reader, line), REQUEST_SECONDS_LIMIT)
+
+    @staticmethod
+    async def _read_rest(reader: asyncio.StreamReader, line: bytes) -> tuple[str, str, str, dict[str, str]]:
+        parts = line.decode('latin-1').split()
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+            if len(headers) >= MAX_HEADERS:
+                raise HTTPError(431, "too many headers")
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise HTTPError(400, "malformed request line")
+        # requests have no use for a body, but it must be consumed to keep the connection in sync
+        length = headers.get('content-length', '0')
+        if not length.isdigit():
+            raise HTTPError(400, "invalid Content-Length")
+        if int(length):
+            await reader.readexactly(int(length))
+        return parts[0], parts[1], parts[2], headers
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HTTPError as error:
+                    exchange = _Exchange(writer, 'GET', {}, {}, keep_alive=False)
+                    await exchange.send(error.status, json.dumps({'error': error.message}).encode(),
+                                        {'Content-Type': JSON_TYPE})
+                    return
+                if request is None:
+                    return
+                method, target, version, headers = request
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                url = urlsplit(target)
+                exchange = _Exchange(writer, method, parse_qs(url.query), headers, keep_alive)
+                if method not in ('GET', 'HEAD'):
+                    exchange.keep_alive = False
+                    await exchange.send(405, json.dumps({'error': f"method {method} not allowed"}).encode(),
+                                        {'Content-Type': JSON_TYPE, 'Allow': 'GET, HEAD'})
+                    return
+                await self._respond(exchange, url.path)
+                if not exchange.keep_alive:
+                    return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError,
+                ConnectionError):
+            pass
+        except Exception:
+            # a response failed after its headers were sent: closing the connection tells the client
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def serve(self) -> None:
+        """
+        Serves on the running event loop until stopped or cancelled.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port, backlog=1024)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+        try:
+            await self.stopping.wait()
+        finally:
+            self.server.close()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.pool.close()
+
+    def start(self) -> 'QueryServer':
+        """
+        Starts serving in a background thread, with its own event loop.
+        """
+        self.thread = threading.Thread(target=asyncio.run, args=(self.serve(),), name='query-api', daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops a server started with start.
+        """
+        self.loop.call_soon_threadsafe(self.stopping.set)
+        self.thread.join()
+
+    def __enter__(self) -> 'QueryServer':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def main() -> None:
+    """
+    Command line entry point serving the query API until interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Serve range and aggregate queries on the weather database.")
+    parser.add_argument('--db', default=DB_PATH, help=f"path of the database (default: {DB_PATH})")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8000, help="port to listen on (default: 8000)")
+    parser.add_argument('--workers', type=int, default=8, help="query threads and pooled connections (default: 8)")
+    parser.add_argument('--metrics-port', type=int, help="serve Prometheus metrics on this port")
+    parser.add_argument('--json-logs', action='store_true', help="log errors as JSON lines on stderr")
+    args = parser.parse_args()
+
+    if args.json_logs:
+        metrics.enable_json_logs()
+    if args.metrics_port:
+        metrics.start_metrics_server(args.metrics_port)
+    # fails early on a missing or outdated database rather than on the first request
+    schema.connect_readonly(args.db).close()
+    server = QueryServer(args.db, args.host, args.port, args.workers)
+    print(f"Serving {args.db} on http://{args.host}:{args.port}")
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import argparse
+import os
+import sqlite3
+import time
+from collections.abc import Iterator
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+import schema
+from db_writer import configure_connection
+from lazy import is_available, lazy_import
+from schema import DB_PATH
+
+np = lazy_import('numpy')
+if is_available('pyarrow'):
+    pa = lazy_import('pyarrow')
+    ds = lazy_import('pyarrow.dataset')
+    pq = lazy_import('pyarrow.parquet')
+else:  # the archive tier is optional
+    pa = None
+
+# name of the archive directory created next to the database, unless compact is given another one
+ARCHIVE_DIR = 'archive'
+
+DAY = 86400
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise RuntimeError("the Parquet archive requires pyarrow, install it with 'pip install pyarrow'")
+
+
+def _day(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp - timestamp % DAY, timezone.utc).strftime('%Y-%m-%d')
+
+
+def _city_dir(archive_dir: str, city: str) -> str:
+    return os.path.join(archive_dir, f'city={quote(city, safe="")}')
+
+
+def archive_location(conn: sqlite3.Connection) -> str | None:
+    """
+    Returns the directory of the archive of a database, as recorded by compact.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+
+    Returns:
+        str or None: The absolute path of the archive, None if nothing was ever archived.
+
+    Raises:
+        FileNotFoundError: If the recorded directory is missing, as the archived rows would be lost.
+        RuntimeError: If pyarrow is not installed.
+    """
+    directory = schema.get_setting(conn, 'archive_dir')
+    if directory is None:
+        return None
+    if not os.path.isdir(directory):
+        raise FileNotFoundError(f"the archive of the database is missing from {directory}")
+    _require_pyarrow()
+    return directory
+
+
+def _resolve_location(conn: sqlite3.Connection, db_path: str, archive_dir: str | None) -> str:
+    recorded = schema.get_setting(conn, 'archive_dir')
+    if archive_dir is None:
+        archive_dir = recorded or os.path.join(os.path.dirname(os.path.abspath(db_path)), ARCHIVE_DIR)
+    archive_dir = os.path.abspath(archive_dir)
+    if recorded is None:
+        os.makedirs(archive_dir, exist_ok=True)
+    elif recorded != archive_dir and os.path.isdir(recorded):
+        raise ValueError(f"the database is already archived to {recorded}, not {archive_dir}")
+    elif not os.path.isdir(archive_dir):
+        raise FileNotFoundError(f"the archive of the database is missing from {recorded}")
+    if recorded != archive_dir:
+        # recorded before any file is written, so that readers never miss archived rows
+        with conn:
+            schema.set_setting(conn, 'archive_dir', archive_dir)
+    return archive_dir
+
+
+def _archive_schema() -> 'pa.Schema':
+    return pa.schema([
+        ('timestamp', pa.int64()),
+        ('temperature', pa.float32()),
+        ('humidity', pa.int8()),
+        ('weather', pa.dictionary(pa.int8(), pa.string())),
+    ])
+
+
+def compact(db_path: str = DB_PATH, archive_dir: str | None = None, older_than_days: float = 30) -> int:
+    """
+    Moves the observations older than a given age from SQLite into the Parquet archive.
+
+    The archive is partitioned by city and UTC day (archive/city=<name>/day=<yyyy-mm-dd>/), and
+    only whole days are moved. Each city-day is written to a file named after its time range,
+    then deleted from SQLite in its own short transaction, so an interrupted run can be resumed
+    and rewrites the same files. Rollups are left untouched. The archived cities are sealed at the
+    cutoff (see schema.seal): observations older than it are skipped when ingested or backfilled
+    again, so backfill old ranges before archiving them.
+
+    The absolute path of the archive is recorded in the database, where the readers find it (see
+    archive_location). A database keeps one archive: another directory is only accepted once the
+    recorded one was moved there.
+
+    Args:
+        db_path (str, optional): The path of the SQLite database. Defaults to DB_PATH.
+        archive_dir (str, optional): The root directory of the archive. Defaults to the recorded
+            one, or to ARCHIVE_DIR next to the database on the first run.
+        older_than_days (float, optional): The age, in days, past which observations are moved.
+            Defaults to 30.
+
+    Returns:
+        int: The number of observations moved.
+
+    Raises:
+        ValueError: If archive_dir differs from the recorded archive, which still exists.
+        FileNotFoundError: If the recorded archive is missing, and archive_dir too.
+    """
+    _require_pyarrow()
+    cutoff = int(time.time() - older_than_days * DAY)
+    cutoff -= cutoff % DAY
+    conn = schema.connect(db_path)
+    configure_connection(conn)
+    try:
+        archive_dir = _resolve_location(conn, db_path, archive_dir)
+    except BaseException:
+        conn.close()
+        raise
+    partitions = conn.execute(
+        '''SELECT city_id, city.name, timestamp - timestamp % ? AS day FROM observation JOIN city USING (city_id)
+        WHERE timestamp < ? GROUP BY city_id, day ORDER BY city_id, day''',
+        (DAY, cutoff)
+        ).fetchall()
+
+    # sealed before anything is read, so that no row can be inserted again below the cutoff once
+    # its day is archived, out of reach of the UNIQUE constraint
+    with conn:
+        for city_id in dict.fromkeys(city_id for city_id, _, _ in partitions):
+            schema.seal(conn, city_id, cutoff)
+
+    moved = 0
+    for city_id, city, day in partitions:
+        rows = conn.execute(
+            '''SELECT timestamp, temperature, humidity, description.text
+            FROM observation LEFT JOIN description USING (description_id)
+            WHERE city_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp''',
+            (city_id, day, day + DAY)
+            ).fetchall()
+        timestamps, temperatures, humidities, weathers = zip(*rows)
+        table = pa.table({
+            'timestamp': pa.array(timestamps, pa.int64()),
+            'temperature': pa.array(temperatures, pa.float32()),
+            'humidity': pa.array(humidities, pa.int8()),
+            'weather': pa.array(weathers, pa.string()).dictionary_encode().cast(pa.dictionary(pa.int8(), pa.string())),
+        }, schema=_archive_schema())
+
+        directory = os.path.join(_city_dir(archive_dir, city), f'day={_day(day)}')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'part-{timestamps[0]}-{timestamps[-1]}.parquet')
+        pq.write_table(table, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+        with conn:
+            conn.execute('DELETE FROM observation WHERE city_id = ? AND timestamp >= ? AND timestamp < ?',
+                         (city_id, day, day + DAY))
+            schema.count_deletion(conn)
+        moved += len(rows)
+    conn.close()
+    return moved
+
+
+def read_archive(archive_dir: str, city: str, starting_ts: int, ending_ts: int, dtype: np.dtype,
+                 chunksize: int) -> Iterator[np.ndarray]:
+    """
+    Yields the archived observations of a city within a time range as structured arrays.
+
+    Only the directory of the city and the day partitions overlapping the range are opened, the
+    timestamp filter is pushed down to the Parquet row groups and only the columns of dtype are
+    read. Nothing is yielded if no day of the city was archived.
+
+    Args:
+        archive_dir (str): The root directory of the archive, see archive_location.
+        city (str): The name of the city.
+        starting_ts (int): The start of the range in epoch seconds.
+        ending_ts (int): The end of the range in epoch seconds (inclusive).
+        dtype (np.dtype): The structured dtype of the chunks, its field names being the columns to read.
+        chunksize (int): The maximum number of rows per chunk.
+
+    Yields:
+        np.ndarray: Structured arrays of at most chunksize rows.
+    """
+    _require_pyarrow()
+    city_dir = _city_dir(archive_dir, city)
+    if not os.path.isdir(city_dir):
+        return
+    dataset = ds.dataset(city_dir, format='parquet',
+                         partitioning=ds.partitioning(pa.schema([('day', pa.string())]), flavor='hive'))
+    predicate = ((ds.field('day') >= _day(starting_ts)) & (ds.field('day') <= _day(ending_ts))
+                 & (ds.field('timestamp') >= starting_ts) & (ds.field('timestamp') <= ending_ts))
+    for batch in dataset.to_batches(columns=list(dtype.names), filter=predicate, batch_size=chunksize):
+        if batch.num_rows == 0:
+            continue
+        chunk = np.empty(batch.num_rows, dtype=dtype)
+        for name in dtype.names:
+            chunk[name] = batch.column(name).to_numpy(zero_copy_only=False)
+        yield chunk
+
+
+def main() -> None:
+    """
+    Command line entry point moving old observations into the archive.
+    """
+    parser = argparse.ArgumentParser(description="Move old observations from SQLite into the Parquet archive.")
+    parser.add_argument('--db', default=DB_PATH, help=f"path of the database (default: {DB_PATH})")
+    parser.add_argument('--archive-dir',
+                        help=f"archive directory, recorded in the database (default: the recorded one, or {ARCHIVE_DIR} "
+                        "next to the database)")
+    parser.add_argument('--older-than', type=float, default=30,
+                        help="age in days past which observations are archived (default: 30)")
+    args = parser.parse_args()
+
+    moved = compact(args.db, args.archive_dir, args.older_than)
+    conn = schema.connect(args.db)
+    print(f"{moved} observations moved to {schema.get_setting(conn, 'archive_dir')}.")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+import time
+from typing import BinaryIO
+
+import schema
+from db_writer import configure_connection
+from schedule import city_name, parse_weather_data
+from schema import DB_PATH
+
+try:
+    from orjson import loads
+except ImportError:  # orjson is optional and about 5x faster at decoding payloads
+    _decode = json.JSONDecoder().decode
+
+    def loads(line: bytes) -> dict:
+        return _decode(line.decode('utf-8'))
+
+# rows are loaded into this temporary table, then moved into observation in key order
+STAGING_TABLE = 'backfill_staging'
+
+
+def _open(path: str) -> BinaryIO:
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def parse_line(line: bytes) -> list[tuple]:
+    """
+    Parses one JSONL line into observation records.
+
+    A line holds either a current weather payload or a group response (whose `list` holds
+    payloads). Payloads go through parse_weather_data, timestamped with their `dt`, and are
+    named with city_name, like the observations ingested live.
+
+    Args:
+        line (bytes): The line.
+
+    Returns:
+        list[tuple]: The (city, timestamp, temperature, humidity, weather) records of the line.
+
+    Raises:
+        ValueError, KeyError, IndexError, TypeError: If the line is not a valid payload.
+    """
+    data = loads(line)
+    records = []
+    for payload in data['list'] if 'list' in data else (data,):
+        wd = parse_weather_data(payload, payload['dt'])
+        records.append((city_name(payload['name']), wd['timestamp'], wd['temperature'], wd['humidity'], wd['weather']))
+    return records
+
+
+def _load(conn: sqlite3.Connection, records: list[tuple], city_ids: dict[str, int], source: str,
+          offset: int, lines: int, inserted: int) -> int:
+    """
+    Inserts a batch and advances the checkpoint of its source in a single transaction.
+
+    Returns:
+        int: The number of observations inserted, duplicates excluded.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        new_ids = {city: schema.city_id(conn, city) for city in {record[0] for record in records} - city_ids.keys()}
+        ids = city_ids | new_ids
+        conn.executemany(f'INSERT INTO {STAGING_TABLE} VALUES (?, ?, ?, ?, ?)',
+                         [(ids[city], *values) for city, *values in records])
+        # the trigger would update the rollups row by row, the new rows are folded in per bucket instead
+        schema.drop_rollup_trigger(conn)
+        last_rowid = conn.execute('SELECT IFNULL(MAX(rowid), 0) FROM observation').fetchone()[0]
+        conn.execute(f'''
+        INSERT OR IGNORE INTO description (text) SELECT DISTINCT weather FROM {STAGING_TABLE} WHERE weather IS NOT NULL
+        ''')
+        before = conn.total_changes
+        conn.execute(f'''
+        INSERT OR IGNORE INTO observation (city_id, timestamp, temperature, humidity, description_id)
+        SELECT city_id, timestamp, temperature, humidity, description_id
+        FROM {STAGING_TABLE} LEFT JOIN description ON description.text = {STAGING_TABLE}.weather
+        ORDER BY city_id, timestamp
+        ''')
+        count = conn.total_changes - before
+        schema.create_rollup_trigger(conn)
+        if count:
+            schema.merge_into_rollups(conn, last_rowid)
+        conn.execute(f'DELETE FROM {STAGING_TABLE}')
+        conn.execute(
+            '''INSERT INTO backfill_checkpoint (source, offset, lines, inserted) VALUES (?, ?, ?, ?)
+            ON CONFLICT (source) DO UPDATE SET offset = excluded.offset, lines = excluded.lines,
+                inserted = excluded.inserted''',
+            (source, offset, lines, inserted + count)
+            )
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    city_ids.update(new_ids)
+    return count
+
+
+def backfill(path: str, db_path: str = DB_PATH, batch_size: int = 100_000, restart: bool = False) -> dict:
+    """
+    Bulk-loads a JSONL file of recorded API payloads into the database.
+
+    The file is streamed, so memory stays bounded by batch_size whatever its size, and may be
+    gzip-compressed. Each batch goes through a staging table and is inserted in one transaction,
+    in (city, timestamp) order, ignoring observations already stored and those in the sealed,
+    i.e. archived, range of their city (see schema.seal). The new observations are
+    folded into the rollups once per batch instead of by the trigger. The byte offset reached
+    is committed with each batch, so an interrupted load resumes where it stopped.
+
+    Args:
+        path (str): The path of the JSONL file, optionally ending in .gz.
+        db_path (str, optional): The path of the SQLite database. Defaults to DB_PATH.
+        batch_size (int, optional): The number of observations per transaction. Defaults to 100,000.
+        restart (bool, optional): Whether to ignore the checkpoint of the file and load it from
+            the beginning. Defaults to False.
+
+    Returns:
+        dict: The lines read and observations inserted by this run, the invalid lines skipped,
+            the number of seconds taken and the totals recorded in the checkpoint.
+    """
+    source = os.path.abspath(path)
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    configure_connection(conn)
+    schema.migrate(conn)
+    conn.execute(f'''
+    CREATE TEMP TABLE {STAGING_TABLE} (
+        city_id INTEGER, timestamp INTEGER, temperature REAL, humidity INTEGER, weather TEXT
+    )
+    ''')
+    if restart:
+        conn.execute('DELETE FROM backfill_checkpoint WHERE source = ?', (source,))
+    checkpoint = conn.execute('SELECT offset, lines, inserted FROM backfill_checkpoint WHERE source = ?',
+                              (source,)).fetchone()
+    offset, lines, inserted = checkpoint or (0, 0, 0)
+    city_ids = dict(conn.execute('SELECT name, city_id FROM city').fetchall())
+
+    started = time.perf_counter()
+    start_lines, start_inserted, skipped = lines, inserted, 0
+    batch = []
+    try:
+        with _open(path) as f:
+            f.seek(offset)
+            for line in f:
+                offset += len(line)
+                lines += 1
+                if not line.strip():
+                    continue
+                try:
+                    batch.extend(parse_line(line))
+                except (ValueError, KeyError, IndexError, TypeError):
+                    if not line.endswith(b'\n'):
+                        # a last line still being written, left for the next run
+                        offset -= len(line)
+                        lines -= 1
+                        break
+                    skipped += 1
+                    continue
+                if len(batch) >= batch_size:
+                    inserted += _load(conn, batch, city_ids, source, offset, lines, inserted)
+                    batch = []
+        if lines > start_lines:
+            inserted += _load(conn, batch, city_ids, source, offset, lines, inserted)
+    finally:
+        conn.close()
+    return {
+        'lines': lines - start_lines,
+        'inserted': inserted - start_inserted,
+        'skipped': skipped,
+        'seconds': time.perf_counter() - started,
+        'total_lines': lines,
+        'total_inserted': inserted,
+    }
+
+
+def main() -> None:
+    """
+    Command line entry point loading JSONL dumps of API payloads into the database.
+    """
+    parser = argparse.ArgumentParser(description="Bulk-load recorded weather payloads (JSONL) into the database.")
+    parser.add_argument('files', nargs='+', help="JSONL files, one payload or group response per line (.gz allowed)")
+    parser.add_argument('--db', default=DB_PATH, help=f"path of the database (default: {DB_PATH})")
+    parser.add_argument('--batch-size', type=int, default=100_000,
+                        help="observations per transaction (default: 100000)")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoints and load the files again")
+    args = parser.parse_args()
+
+    for path in args.files:
+        result = backfill(path, args.db, args.batch_size, args.restart)
+        rate = result['lines'] / result['seconds'] if result['seconds'] else 0
+        print(f"{path}: {result['inserted']} observations inserted from {result['lines']} lines "
+              f"({result['skipped']} invalid) in {result['seconds']:.2f}s, {rate:,.0f} lines/s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,815 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+import datagen
+import schema
+import weather_data_analysis as an
+from api import QueryServer
+from backfill import backfill
+from db_writer import BatchWriter
+from fetcher import ResilientFetcher
+from ingest import GroupIngestionEngine, IngestionEngine
+from mock_api import MockWeatherAPI, observation_payload
+from supervisor import Supervisor
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+def _legacy_fetch(db_path: str, city: str, starting_date: str, ending_date: str) -> pd.DataFrame:
+    """
+    The former fetch_data_from_db: fetchall into row tuples, DataFrame, rename, to_datetime.
+    """
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute(
+        """SELECT city.name, observation.timestamp, temperature, humidity, description.text
+        FROM observation JOIN city USING (city_id) LEFT JOIN description USING (description_id)
+        WHERE city_id = (SELECT city_id FROM city WHERE name = ?) AND timestamp BETWEEN ? AND ?""",
+        (city, schema.to_epoch(starting_date), schema.to_epoch(ending_date))).fetchall()
+    conn.close()
+    df = pd.DataFrame(rows)
+    df.columns = ['city', 'timestamp', 'temperature', 'humidity', 'weather']
+    df['date'] = pd.to_datetime(df['timestamp'], unit='s')
+    return df
+
+
+def _measure(function, *args, **kwargs) -> dict:
+    # tracemalloc slows allocations down, so latency and peak memory are taken from separate runs,
+    # both on a cold query cache
+    an.query_cache.clear()
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - started
+    del result
+    an.query_cache.clear()
+    tracemalloc.start()
+    result = function(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': seconds, 'peak_mib': peak / 2 ** 20, 'rows': len(result)}
+
+
+def bench_query(n: int, db_path: str | None = None) -> dict:
+    """
+    Compares the latency and peak memory of the former row-tuple query path with
+    fetch_data_from_db (all columns and temperature only) on a synthetic database.
+
+    Args:
+        n (int): The number of observations of the synthetic database.
+        db_path (str, optional): An existing database to reuse, or to create if missing.
+            Defaults to a temporary database.
+
+    Returns:
+        dict: The seconds, peak MiB and row count of each path.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = db_path or os.path.join(tmp, 'synthetic.db')
+        if not os.path.exists(db_path):
+            datagen.generate(db_path, n, cities=3)
+        conn = schema.connect(db_path)
+        city = conn.execute('SELECT name FROM city ORDER BY city_id LIMIT 1').fetchone()[0]
+        start, end = conn.execute('SELECT MIN(timestamp), MAX(timestamp) FROM observation').fetchone()
+        conn.close()
+        starting_date, ending_date = schema.from_epoch(start).isoformat(), schema.from_epoch(end).isoformat()
+
+        an.DB_PATH = db_path
+        return {
+            'legacy': _measure(_legacy_fetch, db_path, city, starting_date, ending_date),
+            'typed': _measure(an.fetch_data_from_db, city, starting_date, ending_date),
+            'typed_temperature_only': _measure(an.fetch_data_from_db, city, starting_date, ending_date,
+                                               columns=['temperature']),
+        }
+
+
+def bench_per_row_insert(db_path: str, rows: list[tuple[str, dict]]) -> float:
+    """
+    Inserts rows the way fetch_weather_data does: one connection, insert and commit per row.
+
+    Returns:
+        float: The throughput in rows per second.
+    """
+    started = time.perf_counter()
+    for city, wd in rows:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute(schema.INSERT_OBSERVATION_SQL,
+                       (schema.city_id(conn, city), wd['timestamp'], wd['temperature'], wd['humidity'],
+                        schema.description_id(conn, wd['weather'])))
+        conn.commit()
+        conn.close()
+    return len(rows) / (time.perf_counter() - started)
+
+
+def bench_batched_insert(db_path: str, rows: list[tuple[str, dict]], batch_size: int = 500) -> float:
+    """
+    Inserts rows through a BatchWriter, including the final flush and close.
+
+    Returns:
+        float: The throughput in rows per second.
+    """
+    started = time.perf_counter()
+    with BatchWriter(db_path, batch_size=batch_size) as writer:
+        for city, wd in rows:
+            writer.write(city, wd)
+    return len(rows) / (time.perf_counter() - started)
+
+
+def bench_writer(n: int, batch_size: int = 500) -> dict:
+    """
+    Compares the per-row insert path with the BatchWriter on fresh temporary databases.
+
+    Args:
+        n (int): The number of rows to insert with each path.
+        batch_size (int, optional): The batch size of the BatchWriter. Defaults to 500.
+
+    Returns:
+        dict: The rows per second of both paths and the speedup of the BatchWriter.
+    """
+    rows = list(datagen.synthetic_rows(n))
+    with tempfile.TemporaryDirectory() as tmp:
+        per_row_db = os.path.join(tmp, 'per_row.db')
+        batched_db = os.path.join(tmp, 'batched.db')
+        schema.connect(per_row_db).close()
+        schema.connect(batched_db).close()
+        per_row = bench_per_row_insert(per_row_db, rows)
+        batched = bench_batched_insert(batched_db, rows, batch_size)
+    return {'rows': n, 'per_row_rows_per_sec': per_row, 'batched_rows_per_sec': batched,
+            'speedup': batched / per_row}
+
+
+def bench_fetch_faults(n_cities: int = 200, latency: float = 0.05, error_rate: float = 0.2,
+                       hang_rate: float = 0.02, timeout: float = 1, workers: int = 64) -> dict:
+    """
+    Runs ingestion cycles against the mock API while it injects latency, errors and hung requests.
+
+    The first cycle fetches every city; the second one runs before the mock publishes new
+    observations, so it measures the requests skipped as unchanged.
+
+    Args:
+        n_cities (int, optional): The number of cities. Defaults to 200.
+        latency (float, optional): The latency of every response, in seconds. Defaults to 0.05.
+        error_rate (float, optional): The fraction of requests failing with 500/503/429. Defaults to 0.2.
+        hang_rate (float, optional): The fraction of requests hanging past the timeout. Defaults to 0.02.
+        timeout (float, optional): The request timeout of the fetcher, in seconds. Defaults to 1.
+        workers (int, optional): The number of concurrent requests. Defaults to 64.
+
+    Returns:
+        dict: The duration, fetched observations and cities per second of each cycle, and the
+            fetcher outcome counters.
+    """
+    cities = [f'City {i}' for i in range(n_cities)]
+    result = {}
+    with tempfile.TemporaryDirectory() as tmp, \
+            MockWeatherAPI(latency=latency, error_rate=error_rate, hang_rate=hang_rate,
+                           hang_seconds=timeout * 3, update_interval=3600) as api:
+        writer = BatchWriter(os.path.join(tmp, 'faults.db'))
+        fetcher = ResilientFetcher(timeout=timeout, retries=3, backoff_base=0.05, backoff_cap=0.5,
+                                   pool_size=workers)
+        engine = IngestionEngine(cities, max_workers=workers, rate_limit=0, writer=writer, fetcher=fetcher,
+                                 base_url=api.base_url)
+        for cycle in ('first_cycle', 'second_cycle'):
+            started = time.perf_counter()
+            fetched = engine.run_cycle()
+            seconds = time.perf_counter() - started
+            result[cycle] = {'seconds': seconds, 'new_observations': fetched, 'cities_per_sec': n_cities / seconds}
+        engine.close()
+        writer.close()
+        result['requests_served'] = api.requests
+        result['outcomes'] = dict(fetcher.stats)
+    return result
+
+
+def bench_group(n_cities: int = 500, latency: float = 0.1, workers: int = 16) -> dict:
+    """
+    Compares per-city and group ingestion cycles against the mock API.
+
+    The group engine resolves the city ids during its first cycle, so the second cycle of each
+    engine is reported as the steady state. The mock publishes a new observation every second.
+
+    Args:
+        n_cities (int, optional): The number of cities. Defaults to 500.
+        latency (float, optional): The latency of every response, in seconds. Defaults to 0.1.
+        workers (int, optional): The number of concurrent requests. Defaults to 16.
+
+    Returns:
+        dict: The requests sent, duration and fetched observations of the steady cycle of each mode.
+    """
+    cities = [f'City {i}' for i in range(n_cities)]
+    result = {}
+    for name, engine_class in (('per_city', IngestionEngine), ('group', GroupIngestionEngine)):
+        with tempfile.TemporaryDirectory() as tmp, MockWeatherAPI(latency=latency, update_interval=1) as api:
+            writer = BatchWriter(os.path.join(tmp, f'{name}.db'))
+            engine = engine_class(cities, max_workers=workers, rate_limit=0, writer=writer, base_url=api.base_url)
+            engine.run_cycle()
+            time.sleep(1)
+            requests_before = api.requests
+            started = time.perf_counter()
+            fetched = engine.run_cycle()
+            result[name] = {'requests': api.requests - requests_before, 'seconds': time.perf_counter() - started,
+                            'new_observations': fetched}
+            engine.close()
+            writer.close()
+    return result
+
+
+def bench_backfill(n: int = 1_000_000, n_cities: int = 50, batch_size: int = 100_000) -> dict:
+    """
+    Measures the backfill of a JSONL file of recorded payloads, then of the same file again.
+
+    Args:
+        n (int, optional): The number of payloads in the file. Defaults to 1,000,000.
+        n_cities (int, optional): The number of cities. Defaults to 50.
+        batch_size (int, optional): The number of observations per transaction. Defaults to 100,000.
+
+    Returns:
+        dict: The lines per second and observations inserted of the first load and of the
+            reload, where every observation is a duplicate.
+    """
+    result = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'payloads.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            for city, wd in datagen.synthetic_rows(n, n_cities, step=600):
+                f.write(json.dumps(observation_payload(city, wd)) + '\n')
+        db_path = os.path.join(tmp, 'backfill.db')
+        for run, restart in (('load', False), ('reload', True)):
+            loaded = backfill(path, db_path, batch_size, restart=restart)
+            result[run] = {'lines_per_sec': loaded['lines'] / loaded['seconds'], 'inserted': loaded['inserted']}
+    return result
+
+
+def bench_supervisor(n_cities: int = 1000, processes: list[int] | None = None, latency: float = 0.02) -> dict:
+    """
+    Measures the cycle time of the multi-process ingestion for several numbers of processes.
+
+    Each run starts a Supervisor against the mock API and lets every worker run two cycles,
+    the second one being reported, so that process start-up is left out.
+
+    Args:
+        n_cities (int, optional): The number of cities. Defaults to 1000.
+        processes (list[int], optional): The numbers of worker processes. Defaults to 1, 2 and 4.
+        latency (float, optional): The latency of every response, in seconds. Defaults to 0.02.
+
+    Returns:
+        dict: The cycle time (slowest shard) and cities per second of the steady cycle, by
+            number of processes.
+    """
+    cities = [f'City {i}' for i in range(n_cities)]
+    result = {}
+    for n in processes or [1, 2, 4]:
+        with tempfile.TemporaryDirectory() as tmp, MockWeatherAPI(latency=latency, update_interval=1) as api:
+            supervisor = Supervisor(cities, n, interval=0, db_path=os.path.join(tmp, 'supervisor.db'),
+                                    rate_limit=0, base_url=api.base_url)
+            supervisor.run(cycles=2)
+            seconds = max(s for s, _ in supervisor.cycle_stats[1].values())
+            result[n] = {'seconds': seconds, 'cities_per_sec': n_cities / seconds}
+    return result
+
+
+def _peak_to_mean(times: list[float], start: float, end: float, bin_seconds: float) -> float:
+    counts = [0] * max(1, int((end - start) / bin_seconds))
+    for t in times:
+        if start <= t < end:
+            counts[min(len(counts) - 1, int((t - start) / bin_seconds))] += 1
+    return max(counts) / (sum(counts) / len(counts)) if sum(counts) else 0.0
+
+
+def bench_scheduler(n_cities: int = 500, interval: float = 5, bin_seconds: float = 0.25) -> dict:
+    """
+    Compares the request load of burst cycles (run_forever) and scheduled ticks (run_scheduled).
+
+    Each mode runs for two intervals against the mock API; requests are counted per bin and the
+    ratio of the busiest bin to the mean bin is reported (1 is perfectly flat).
+
+    Args:
+        n_cities (int, optional): The number of cities. Defaults to 500.
+        interval (float, optional): The interval, in seconds. Defaults to 5.
+        bin_seconds (float, optional): The width of the bins, in seconds. Defaults to 0.25.
+
+    Returns:
+        dict: The number of requests and the peak-to-mean ratio of each mode.
+    """
+    cities = [f'City {i}' for i in range(n_cities)]
+    result = {}
+    for mode in ('burst', 'scheduled'):
+        with tempfile.TemporaryDirectory() as tmp, MockWeatherAPI(update_interval=1) as api:
+            writer = BatchWriter(os.path.join(tmp, f'{mode}.db'))
+            engine = IngestionEngine(cities, interval / 60, rate_limit=0, writer=writer, base_url=api.base_url)
+            start = time.time()
+            if mode == 'burst':
+                for _ in range(2):
+                    engine.run_cycle()
+                    time.sleep(max(0.0, start + interval - time.time()))
+            else:
+                thread = threading.Thread(target=engine.run_scheduled)
+                thread.start()
+                time.sleep(2 * interval)
+                engine.scheduler.stop()
+                thread.join()
+            end = start + 2 * interval
+            engine.close()
+            writer.close()
+            result[mode] = {'requests': sum(start <= t < end for t in api.request_times),
+                            'peak_to_mean': _peak_to_mean(api.request_times, start, end, bin_seconds)}
+    return result
+
+
+def peak_rss_mib() -> float | None:
+    """
+    Returns the peak resident set size of the process so far in MiB, None where unavailable.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kibibytes elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _percentiles(seconds: list[float]) -> dict:
+    milliseconds = np.array(seconds) * 1000
+    return {'p50_ms': float(np.percentile(milliseconds, 50)), 'p90_ms': float(np.percentile(milliseconds, 90)),
+            'p99_ms': float(np.percentile(milliseconds, 99)), 'max_ms': float(milliseconds.max()),
+            'mean_ms': float(milliseconds.mean())}
+
+
+def _bench_ingest(n_rows: int, n_cities: int, seed: int) -> dict:
+    """
+    Measures the insert path (BatchWriter) and a full ingestion cycle against the mock API.
+    """
+    rows = list(datagen.synthetic_rows(n_rows, seed=seed))
+    cities = [f'City {i}' for i in range(n_cities)]
+    with tempfile.TemporaryDirectory() as tmp, MockWeatherAPI() as api:
+        writer_rows_per_sec = bench_batched_insert(os.path.join(tmp, 'writer.db'), rows)
+        writer = BatchWriter(os.path.join(tmp, 'engine.db'))
+        engine = IngestionEngine(cities, rate_limit=0, writer=writer, base_url=api.base_url)
+        started = time.perf_counter()
+        fetched = engine.run_cycle()
+        writer.flush()
+        seconds = time.perf_counter() - started
+        engine.close()
+        writer.close()
+    return {'writer_rows_per_sec': writer_rows_per_sec, 'cycle_seconds': seconds,
+            'cycle_cities_per_sec': n_cities / seconds, 'cycle_observations': fetched, 'peak_rss_mib': peak_rss_mib()}
+
+
+def _bench_range_queries(cities: list[str], start: int, end: int, queries: int, seed: int) -> dict:
+    """
+    Measures the latency of fetch_data_from_db over random cities and ranges of several spans.
+
+    The query cache is cleared before every query, so each one reads SQLite.
+    """
+    rng = random.Random(seed)
+    result = {}
+    for span, seconds in (('day', 86400), ('week', 7 * 86400), ('month', 30 * 86400), ('year', 365 * 86400)):
+        if seconds > end - start:
+            continue
+        latencies, rows = [], 0
+        for _ in range(queries):
+            first = rng.randrange(start, end - seconds + 1)
+            starting_date = schema.from_epoch(first).isoformat()
+            ending_date = schema.from_epoch(first + seconds).isoformat()
+            an.query_cache.clear()
+            started = time.perf_counter()
+            df = an.fetch_data_from_db(rng.choice(cities), starting_date, ending_date)
+            latencies.append(time.perf_counter() - started)
+            rows += len(df) if df is not None else 0
+        result[span] = {**_percentiles(latencies), 'rows_per_query': rows / queries}
+    result['peak_rss_mib'] = peak_rss_mib()
+    return result
+
+
+def _bench_aggregations(cities: list[str], start: int, end: int, repeats: int) -> dict:
+    """
+    Measures the analysis functions behind the GUI over the whole span and over its last month.
+
+    The graph functions draw with the Agg backend, so no window opens.
+    """
+    plt.switch_backend('Agg')
+    whole = schema.from_epoch(start).isoformat(), schema.from_epoch(end).isoformat()
+    month = schema.from_epoch(max(start, end - 30 * 86400)).isoformat(), whole[1]
+    cases = {
+        'temperature_trends_month': lambda: an.temperature_trends(cities[0], *month),
+        'temperature_trends_all': lambda: an.temperature_trends(cities[0], *whole),
+        'mean_temperature_by_city_month': lambda: an.mean_temperature_by_city(*month, cities),
+        'mean_temperature_by_city_all': lambda: an.mean_temperature_by_city(*whole, cities),
+        'temperature_trends_graph_month': lambda: an.temperature_trends_graph(cities[0], *month),
+        'mean_temperature_per_hr_comp_diff_city_month':
+            lambda: an.mean_temperature_per_hr_comp_diff_city(*month, cities),
+    }
+    result = {}
+    for name, function in cases.items():
+        latencies = []
+        for _ in range(repeats):
+            an.query_cache.clear()
+            started = time.perf_counter()
+            function()
+            latencies.append(time.perf_counter() - started)
+            plt.close('all')
+        result[name] = {'median_ms': float(np.median(latencies)) * 1000, 'min_ms': min(latencies) * 1000}
+    result['peak_rss_mib'] = peak_rss_mib()
+    return result
+
+
+# the entry points whose import time is measured, and the libraries they should not load
+STARTUP_MODULES = ['gui', 'ingest', 'supervisor', 'backfill', 'report', 'api']
+HEAVY_MODULES = ['numpy', 'pandas', 'matplotlib', 'pyarrow', 'requests']
+
+
+def bench_startup(modules: list[str] | None = None, repeats: int = 3, top: int = 5) -> dict:
+    """
+    Measures how long the entry points take to import, each in a fresh interpreter.
+
+    Every module is imported with `python -X importtime` from the directory of the sources; the
+    best of the runs is kept. The import time of the module itself is the cumulative time the
+    interpreter reports for it, and the wall time includes the start of the interpreter.
+
+    Args:
+        modules (list[str], optional): The modules to import. Defaults to STARTUP_MODULES.
+        repeats (int, optional): The number of runs per module. Defaults to 3.
+        top (int, optional): The number of heaviest imports listed per module. Defaults to 5.
+
+    Returns:
+        dict: Per module, the wall time and import time in milliseconds, the heaviest imports
+            and the heavy libraries (HEAVY_MODULES) loaded.
+    """
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    result = {}
+    for module in modules or STARTUP_MODULES:
+        best = None
+        for _ in range(repeats):
+            started = time.perf_counter()
+            process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                     capture_output=True, text=True, cwd=source_dir)
+            wall = time.perf_counter() - started
+            if process.returncode:
+                raise RuntimeError(f'import {module} failed: {process.stderr.strip().splitlines()[-1]}')
+            if best is None or wall < best[0]:
+                best = wall, process.stderr
+        wall, report = best
+        # lines: "import time:      self [us] |  cumulative | imported package"
+        cumulative = {}
+        for line in report.splitlines():
+            fields = line.split('|')
+            if line.startswith('import time:') and len(fields) == 3 and fields[1].strip().isdigit():
+                cumulative[fields[2].strip()] = int(fields[1])
+        heaviest = sorted(((name, us) for name, us in cumulative.items() if name != module),
+                          key=lambda item: -item[1])[:top]
+        result[module] = {
+            'wall_ms': wall * 1000,
+            'import_ms': cumulative.get(module, 0) / 1000,
+            'heaviest': {name: us / 1000 for name, us in heaviest},
+            'heavy_modules': [name for name in HEAVY_MODULES if name in cumulative],
+        }
+    return result
+
+
+def _api_paths(cities: list[str], start: int, end: int, n: int, seed: int) -> list[str]:
+    """
+    Draws a mix of the requests of a dashboard: a day of observations, a month of hourly rollups
+    and a week of daily means.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for i in range(n):
+        seconds = (86400, 30 * 86400, 7 * 86400)[i % 3]
+        first = rng.randrange(start, max(start + 1, end - seconds))
+        span = f'start={schema.from_epoch(first).isoformat()}&end={schema.from_epoch(first + seconds).isoformat()}'
+        city = rng.choice(cities).replace(' ', '+')
+        paths.append((f'/observations?city={city}&{span}', f'/rollups?city={city}&grain=h&{span}',
+                      f'/means?grain=D&{span}')[i % 3])
+    return paths
+
+
+def bench_api(rows: int = 1_000_000, n_cities: int = 10, clients: int = 8, requests: int = 300, seed: int = 0,
+              data_dir: str | None = None) -> dict:
+    """
+    Measures the HTTP query API (see api.QueryServer) on a synthetic database.
+
+    Several clients, each on its own keep-alive connection, send a mix of observation, rollup and
+    mean requests twice: a first time without validators, then again with the ETags they got, so
+    the second pass measures the conditional requests answered with 304. A year of observations
+    is then downloaded as streamed JSON and Arrow.
+
+    Args:
+        rows (int, optional): The number of observations of the database. Defaults to 1,000,000.
+        n_cities (int, optional): The number of cities. Defaults to 10.
+        clients (int, optional): The number of concurrent clients, and of server workers. Defaults to 8.
+        requests (int, optional): The number of requests per pass. Defaults to 300.
+        seed (int, optional): The seed of the data and of the requests. Defaults to 0.
+        data_dir (str, optional): The directory keeping the generated databases. Defaults to a
+            temporary directory.
+
+    Returns:
+        dict: Per pass, the requests per second, latency percentiles and status counts, and per
+            format, the time and size of the download of a year.
+    """
+    result = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(data_dir or tmp, f'synthetic-{rows}-{n_cities}-2y-{seed}.db')
+        if not os.path.exists(db_path):
+            datagen.generate(db_path, rows, n_cities, 2, seed=seed)
+        conn = schema.connect(db_path)
+        cities = [name for (name,) in conn.execute('SELECT name FROM city ORDER BY city_id')]
+        start, end = conn.execute('SELECT MIN(timestamp), MAX(timestamp) FROM observation').fetchone()
+        conn.close()
+        paths = _api_paths(cities, start, end, requests, seed)
+        etags = {}
+
+        def client(share: list[str], conditional: bool, latencies: list[float], statuses: list[int]) -> None:
+            connection = http.client.HTTPConnection(server.host, server.port)
+            for path in share:
+                headers = {'If-None-Match': etags[path]} if conditional and path in etags else {}
+                started = time.perf_counter()
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                latencies.append(time.perf_counter() - started)
+                statuses.append(response.status)
+                if response.getheader('ETag'):
+                    etags[path] = response.getheader('ETag')
+            connection.close()
+
+        with QueryServer(db_path, port=0, workers=clients) as server:
+            for name, conditional in (('first_pass', False), ('conditional_pass', True)):
+                latencies, statuses = [], []
+                threads = [threading.Thread(target=client, args=(paths[i::clients], conditional, latencies, statuses))
+                           for i in range(clients)]
+                started = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                seconds = time.perf_counter() - started
+                result[name] = {'requests_per_sec': len(latencies) / seconds, **_percentiles(latencies),
+                                'statuses': {str(status): statuses.count(status) for status in sorted(set(statuses))}}
+            year = (f'start={schema.from_epoch(start).isoformat()}'
+                    f'&end={schema.from_epoch(start + 365 * 86400).isoformat()}')
+            for fmt in ('json', 'arrow'):
+                connection = http.client.HTTPConnection(server.host, server.port)
+                started = time.perf_counter()
+                connection.request('GET', f"/observations?city={cities[0].replace(' ', '+')}&{year}&format={fmt}")
+                response = connection.getresponse()
+                size = len(response.read())
+                result[f'year_{fmt}'] = {'seconds': time.perf_counter() - started, 'mib': size / 2 ** 20,
+                                         'status': response.status}
+                connection.close()
+    result['peak_rss_mib'] = peak_rss_mib()
+    return result
+
+
+def _environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def bench_suite(rows: int = 1_000_000, n_cities: int = 10, years: float = 2, seed: int = 0, queries: int = 50,
+                repeats: int = 5, data_dir: str | None = None) -> dict:
+    """
+    Runs the reproducible benchmark suite on a synthetic database.
+
+    The database is generated by datagen (and reused from data_dir when it already holds one
+    generated with the same arguments). The suite measures the insert path and an ingestion cycle
+    against the mock API, the latency percentiles of range queries of a day to a year, the
+    analysis functions behind the GUI, the import time of the entry points (see bench_startup),
+    and the peak RSS after each stage.
+
+    Args:
+        rows (int, optional): The number of observations of the database. Defaults to 1,000,000.
+        n_cities (int, optional): The number of cities. Defaults to 10.
+        years (float, optional): The number of years covered. Defaults to 2.
+        seed (int, optional): The seed of the data and of the queries. Defaults to 0.
+        queries (int, optional): The number of queries per range span. Defaults to 50.
+        repeats (int, optional): The number of runs of each aggregation. Defaults to 5.
+        data_dir (str, optional): The directory keeping the generated databases. Defaults to a
+            temporary directory.
+
+    Returns:
+        dict: The environment, parameters and results, ready to be saved as JSON.
+    """
+    parameters = {'rows': rows, 'cities': n_cities, 'years': years, 'seed': seed, 'queries': queries,
+                  'repeats': repeats}
+    result = {'environment': _environment(), 'parameters': parameters}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(data_dir or tmp, f'synthetic-{rows}-{n_cities}-{years:g}y-{seed}.db')
+        if os.path.exists(db_path):
+            result['generate'] = {'reused': True}
+        else:
+            generated = datagen.generate(db_path, rows, n_cities, years, seed=seed)
+            result['generate'] = {'seconds': generated['seconds'], 'rows_per_sec': generated['rows_per_sec'],
+                                  'bytes_per_row': generated['bytes'] / rows}
+        result['generate']['peak_rss_mib'] = peak_rss_mib()
+
+        conn = schema.connect(db_path)
+        cities = [name for (name,) in conn.execute('SELECT name FROM city ORDER BY city_id')]
+        start, end = conn.execute('SELECT MIN(timestamp), MAX(timestamp) FROM observation').fetchone()
+        conn.close()
+        db_path_before = an.DB_PATH
+        an.DB_PATH = db_path
+        try:
+            result['ingest'] = _bench_ingest(min(rows, 100_000), 200, seed)
+            result['range_queries'] = _bench_range_queries(cities, start, end, queries, seed)
+            result['aggregations'] = _bench_aggregations(cities, start, end, repeats)
+        finally:
+            an.DB_PATH = db_path_before
+            an.query_cache.clear()
+    result['startup'] = bench_startup()
+    result['peak_rss_mib'] = peak_rss_mib()
+    return result
+
+
+def _flatten(result: dict, prefix: str = '') -> dict[str, float]:
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare_results(old: dict, new: dict, threshold: float = 0.1) -> list[tuple[str, float, float, float, bool]]:
+    """
+    Compares the metrics of two bench_suite results, e.g. of two commits.
+
+    Throughputs (`*_per_sec`) are better when higher, durations (`*_ms`, `seconds`) and memory
+    (`*_mib`) when lower; other values are not compared.
+
+    Args:
+        old (dict): The baseline result.
+        new (dict): The result to check.
+        threshold (float, optional): The relative change past which a worse metric is a
+            regression. Defaults to 0.1 (10%).
+
+    Returns:
+        list[tuple]: The (metric, old value, new value, relative change, regression) of the
+            metrics found in both results.
+    """
+    old_metrics, new_metrics = _flatten(old), _flatten(new)
+    comparison = []
+    for name, before in old_metrics.items():
+        if name.startswith(('parameters.', 'environment.')) or name not in new_metrics or not before:
+            continue
+        leaf = name.rsplit('.', 1)[-1]
+        if leaf.endswith('per_sec'):
+            higher_is_better = True
+        elif leaf.endswith(('_ms', '_mib')) or leaf == 'seconds':
+            higher_is_better = False
+        else:
+            continue
+        after = new_metrics[name]
+        change = (after - before) / before
+        regression = -change > threshold if higher_is_better else change > threshold
+        comparison.append((name, before, after, change, regression))
+    return comparison
+
+
+def main() -> None:
+    """
+    Command line entry point running the benchmarks and printing their results.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the weather pipeline.")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    writer_parser = subparsers.add_parser('writer', help="per-row inserts against the BatchWriter")
+    writer_parser.add_argument('--rows', type=int, default=5000)
+    writer_parser.add_argument('--batch-size', type=int, default=500)
+    query_parser = subparsers.add_parser('query', help="row-tuple query path against fetch_data_from_db")
+    query_parser.add_argument('--rows', type=int, default=10_000_000)
+    query_parser.add_argument('--db', help="synthetic database to reuse (created if missing)")
+    faults_parser = subparsers.add_parser('faults', help="ingestion against a mock API injecting faults")
+    faults_parser.add_argument('--cities', type=int, default=200)
+    faults_parser.add_argument('--latency', type=float, default=0.05)
+    faults_parser.add_argument('--error-rate', type=float, default=0.2)
+    faults_parser.add_argument('--hang-rate', type=float, default=0.02)
+    faults_parser.add_argument('--timeout', type=float, default=1)
+    group_parser = subparsers.add_parser('group', help="per-city vs group endpoint ingestion")
+    group_parser.add_argument('--cities', type=int, default=500)
+    group_parser.add_argument('--latency', type=float, default=0.1)
+    backfill_parser = subparsers.add_parser('backfill', help="JSONL bulk load")
+    backfill_parser.add_argument('--rows', type=int, default=1_000_000)
+    backfill_parser.add_argument('--batch-size', type=int, default=100_000)
+    supervisor_parser = subparsers.add_parser('supervisor', help="multi-process ingestion scaling")
+    supervisor_parser.add_argument('--cities', type=int, default=1000)
+    supervisor_parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    supervisor_parser.add_argument('--latency', type=float, default=0.02)
+    scheduler_parser = subparsers.add_parser('scheduler', help="burst cycles vs scheduled ticks")
+    scheduler_parser.add_argument('--cities', type=int, default=500)
+    scheduler_parser.add_argument('--interval', type=float, default=5, help="seconds")
+    suite_parser = subparsers.add_parser('suite', help="reproducible suite on a synthetic database, saved as JSON")
+    suite_parser.add_argument('--rows', type=int, default=1_000_000)
+    suite_parser.add_argument('--cities', type=int, default=10)
+    suite_parser.add_argument('--years', type=float, default=2)
+    suite_parser.add_argument('--seed', type=int, default=0)
+    suite_parser.add_argument('--queries', type=int, default=50, help="queries per range span")
+    suite_parser.add_argument('--repeats', type=int, default=5, help="runs of each aggregation")
+    suite_parser.add_argument('--data-dir', help="directory keeping the generated databases between runs")
+    suite_parser.add_argument('--output', help="JSON file to save the results to")
+    startup_parser = subparsers.add_parser('startup', help="import time of the entry points, exit 1 over budget")
+    startup_parser.add_argument('modules', nargs='*', default=STARTUP_MODULES, help="modules to import")
+    startup_parser.add_argument('--repeats', type=int, default=3)
+    startup_parser.add_argument('--budget', type=float, help="seconds of wall time allowed per module")
+    api_parser = subparsers.add_parser('api', help="concurrent clients against the HTTP query API")
+    api_parser.add_argument('--rows', type=int, default=1_000_000)
+    api_parser.add_argument('--cities', type=int, default=10)
+    api_parser.add_argument('--clients', type=int, default=8)
+    api_parser.add_argument('--requests', type=int, default=300, help="requests per pass")
+    api_parser.add_argument('--data-dir', help="directory keeping the generated databases between runs")
+    compare_parser = subparsers.add_parser('compare', help="compare two suite results, exit 1 on regressions")
+    compare_parser.add_argument('baseline', help="JSON results of the reference commit")
+    compare_parser.add_argument('candidate', help="JSON results to check")
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help="tolerated relative change (default: 0.1)")
+    args = parser.parse_args()
+
+    if args.benchmark == 'writer':
+        result = bench_writer(args.rows, args.batch_size)
+        print(f"per-row : {result['per_row_rows_per_sec']:>12,.0f} rows/s")
+        print(f"batched : {result['batched_rows_per_sec']:>12,.0f} rows/s ({result['speedup']:.1f}x)")
+    elif args.benchmark == 'query':
+        for name, result in bench_query(args.rows, args.db).items():
+            print(f"{name:<24}: {result['seconds']:8.2f}s {result['peak_mib']:10.1f} MiB peak "
+                  f"({result['rows']:,} rows)")
+    elif args.benchmark == 'faults':
+        result = bench_fetch_faults(args.cities, args.latency, args.error_rate, args.hang_rate, args.timeout)
+        for cycle in ('first_cycle', 'second_cycle'):
+            print(f"{cycle:<13}: {result[cycle]['seconds']:6.2f}s, {result[cycle]['new_observations']} new "
+                  f"observations, {result[cycle]['cities_per_sec']:,.0f} cities/s")
+        print(f"requests served: {result['requests_served']}, outcomes: {result['outcomes']}")
+    elif args.benchmark == 'backfill':
+        for run, result in bench_backfill(args.rows, batch_size=args.batch_size).items():
+            print(f"{run:<6}: {result['lines_per_sec']:10,.0f} lines/s, {result['inserted']:,} inserted")
+    elif args.benchmark == 'supervisor':
+        for n, result in bench_supervisor(args.cities, args.processes, args.latency).items():
+            print(f"{n:>2} processes: {result['seconds']:6.2f}s per cycle, {result['cities_per_sec']:8,.0f} cities/s")
+    elif args.benchmark == 'scheduler':
+        for mode, result in bench_scheduler(args.cities, args.interval).items():
+            print(f"{mode:<9}: {result['requests']:6} requests, peak/mean load {result['peak_to_mean']:5.2f}")
+    elif args.benchmark == 'suite':
+        result = bench_suite(args.rows, args.cities, args.years, args.seed, args.queries, args.repeats, args.data_dir)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(result, f, indent=2)
+        for name, value in _flatten(result).items():
+            if not name.startswith(('parameters.', 'environment.')):
+                print(f"{name:<64} {value:14,.2f}")
+    elif args.benchmark == 'startup':
+        result = bench_startup(args.modules, args.repeats)
+        for module, timing in result.items():
+            heaviest = ', '.join(f'{name} {ms:.0f}ms' for name, ms in timing['heaviest'].items())
+            print(f"{module:<12}: {timing['wall_ms']:7.0f}ms wall, {timing['import_ms']:7.0f}ms import "
+                  f"(heaviest: {heaviest}; heavy modules: {', '.join(timing['heavy_modules']) or 'none'})")
+        if args.budget is not None and any(timing['wall_ms'] > args.budget * 1000 for timing in result.values()):
+            sys.exit(1)
+    elif args.benchmark == 'api':
+        result = bench_api(args.rows, args.cities, args.clients, args.requests, data_dir=args.data_dir)
+        for name in ('first_pass', 'conditional_pass'):
+            print(f"{name:<16}: {result[name]['requests_per_sec']:8,.0f} req/s, p50 {result[name]['p50_ms']:6.1f}ms, "
+                  f"p99 {result[name]['p99_ms']:6.1f}ms, statuses {result[name]['statuses']}")
+        for fmt in ('json', 'arrow'):
+            print(f"year {fmt:<11}: {result[f'year_{fmt}']['seconds']:6.2f}s, {result[f'year_{fmt}']['mib']:6.1f} MiB")
+    elif args.benchmark == 'compare':
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.candidate, encoding='utf-8') as f:
+            candidate = json.load(f)
+        comparison = compare_results(baseline, candidate, args.threshold)
+        for name, before, after, change, regression in comparison:
+            print(f"{name:<64} {before:12,.2f} -> {after:12,.2f} {change:+7.1%}{'  REGRESSION' if regression else ''}")
+        if any(regression for *_, regression in comparison):
+            sys.exit(1)
+    elif args.benchmark == 'group':
+        for name, result in bench_group(args.cities, args.latency).items():
+            print(f"{name:<8}: {result['requests']:5} requests, {result['seconds']:6.2f}s, "
+                  f"{result['new_observations']} new observations")
+
+
+if __name__ == "__main__":
+    main()
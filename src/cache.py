@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import AbstractContextManager, contextmanager
+from functools import partial
+from typing import Any
+
+import schema
+from lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+
+def _size_of(value: Any) -> int:
+    """
+    Estimates the memory held by a cached value, in bytes.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, (tuple, list)):
+        return sum(_size_of(item) for item in value)
+    if isinstance(value, str):
+        return len(value)
+    return 64
+
+
+def _copy(value: Any) -> Any:
+    # shallow copies, so that callers adding or replacing columns do not alter the cached frame
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy(deep=False)
+    if isinstance(value, tuple):
+        return tuple(_copy(item) for item in value)
+    return value
+
+
+@contextmanager
+def _connection(db_path: str) -> Iterator[sqlite3.Connection]:
+    conn = schema.connect(db_path)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+class _Entry:
+    def __init__(self, value: Any, size: int, watermark: int, deletions: str | None, cities: tuple[str, ...],
+                 starting_ts: int, ending_ts: int) -> None:
+        self.value = value
+        self.size = size
+        self.watermark = watermark
+        self.deletions = deletions
+        self.cities = cities
+        self.starting_ts = starting_ts
+        self.ending_ts = ending_ts
+
+
+class QueryCache:
+    """
+    An LRU cache of query results, bounded by the memory held by the cached values.
+
+    Each entry remembers the observation rowid high-water mark at the time it was computed.
+    On lookup, only the observations inserted since then are checked: if one of them belongs
+    to a cached city and falls into the cached time range the entry is recomputed, otherwise
+    its high-water mark is advanced. Rowids can be reused once the latest observation is
+    deleted, so any deletion (see schema.count_deletion) invalidates every entry. Hit, miss,
+    invalidation and eviction counters help sizing the cache.
+
+    Args:
+        max_bytes (int, optional): The maximum memory held by cached values. Defaults to 256 MiB.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20) -> None:
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _marks(conn: sqlite3.Connection) -> tuple[int, str | None]:
+        return (conn.execute('SELECT IFNULL(MAX(rowid), 0) FROM observation').fetchone()[0],
+                schema.get_setting(conn, 'observation_deletions'))
+
+    @staticmethod
+    def _has_new_rows(conn: sqlite3.Connection, entry: _Entry, watermark: int) -> bool:
+        # the unary + keep the planner off the (city_id, timestamp) index, so that the rowid range
+        # scan only visits the rows inserted since the entry was computed
+        return conn.execute(
+            f'''SELECT EXISTS (
+                SELECT 1 FROM observation
+                WHERE rowid > ? AND rowid <= ? AND +timestamp BETWEEN ? AND ?
+                AND +city_id IN (SELECT city_id FROM city WHERE name IN ({', '.join('?' * len(entry.cities))}))
+            )''',
+            (entry.watermark, watermark, entry.starting_ts, entry.ending_ts, *entry.cities)
+            ).fetchone()[0] == 1
+
+    def get_or_compute(self, key: tuple, db_path: str, cities: Iterable[str], starting_ts: int, ending_ts: int,
+                       compute: Callable[[], Any],
+                       connect: Callable[[], AbstractContextManager[sqlite3.Connection]] | None = None) -> Any:
+        """
+        Returns the cached result for key, computing and caching it if missing or stale.
+
+        Args:
+            key (tuple): The cache key, e.g. the query kind, cities, range and aggregation.
+            db_path (str): The path of the database the result is computed from.
+            cities (Iterable[str]): The cities the result depends on.
+            starting_ts (int): The start, in epoch seconds, of the range the result depends on.
+            ending_ts (int): The end, in epoch seconds, of the range the result depends on (inclusive).
+            compute (callable): The function computing the result.
+            connect (callable, optional): A function returning a context manager lending a connection
+                to the database, e.g. ReadOnlyPool.connection. Defaults to opening one with schema.connect.
+
+        Returns:
+            The cached or freshly computed result (DataFrames are returned as shallow copies).
+        """
+        key = (db_path, *key)
+        with (connect or partial(_connection, db_path))() as conn:
+            # one read transaction, so that the rows checked are exactly those below the mark stored
+            conn.execute('BEGIN')
+            try:
+                watermark, deletions = self._marks(conn)
+                with self.lock:
+                    entry = self.entries.get(key)
+                fresh = (entry is not None and entry.deletions == deletions
+                         and not self._has_new_rows(conn, entry, watermark))
+            finally:
+                conn.execute('COMMIT')
+        if fresh:
+            with self.lock:
+                entry.watermark = max(entry.watermark, watermark)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                self.hits += 1
+            return _copy(entry.value)
+        if entry is not None:
+            with self.lock:
+                self.invalidations += 1
+
+        # the marks were read before compute, so that rows inserted or deleted meanwhile invalidate the entry later
+        value = compute()
+        entry = _Entry(value, _size_of(value), watermark, deletions, tuple(cities), starting_ts, ending_ts)
+        with self.lock:
+            self.misses += 1
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            if entry.size <= self.max_bytes:
+                self.entries[key] = entry
+                self.size += entry.size
+                while self.size > self.max_bytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= evicted.size
+                    self.evictions += 1
+        return _copy(value)
+
+    def clear(self) -> None:
+        """
+        Drops every cached entry (the counters are kept).
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        """
+        Returns the hit, miss, invalidation and eviction counters and the current size of the cache.
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+            }
@@ -0,0 +1,258 @@
+import argparse
+import hashlib
+import itertools
+import os
+import sqlite3
+import time
+from collections.abc import Iterator
+
+import numpy as np
+
+import schema
+from db_writer import configure_connection
+
+# (name, annual mean °C, seasonal amplitude °C, diurnal amplitude °C, mean humidity %); a negative
+# seasonal amplitude puts the summer in January (southern hemisphere)
+CLIMATES = [
+    ('Hong Kong', 23.5, 5.5, 3.0, 78), ('Tokyo', 16.5, 10.5, 4.0, 65), ('New York', 13.0, 12.5, 5.0, 63),
+    ('London', 11.5, 7.0, 4.5, 76), ('Paris', 12.5, 8.0, 5.0, 72), ('Berlin', 10.0, 9.5, 5.0, 74),
+    ('Moscow', 6.0, 13.5, 5.0, 76), ('Dubai', 28.5, 8.0, 6.0, 55), ('Mumbai', 27.5, 2.5, 4.0, 72),
+    ('Singapore', 27.5, 1.0, 3.5, 83), ('Sydney', 18.0, -4.5, 5.0, 66), ('Cape Town', 17.0, -4.0, 5.5, 71),
+    ('Buenos Aires', 18.0, -6.0, 5.0, 72), ('Sao Paulo', 20.0, -3.0, 5.0, 78), ('Los Angeles', 18.5, 4.0, 6.0, 64),
+    ('Chicago', 10.5, 14.0, 5.0, 70), ('Toronto', 9.0, 13.5, 5.0, 70), ('Mexico City', 17.0, 2.5, 8.0, 55),
+    ('Cairo', 22.5, 7.0, 7.0, 55), ('Lagos', 27.0, 1.5, 4.0, 82), ('Nairobi', 18.0, -1.0, 6.0, 65),
+    ('Delhi', 25.0, 8.5, 7.0, 60), ('Beijing', 13.0, 15.0, 6.0, 55), ('Seoul', 12.5, 14.0, 5.0, 63),
+    ('Bangkok', 28.5, 2.0, 4.5, 73), ('Jakarta', 27.5, 0.5, 4.0, 80), ('Reykjavik', 5.0, 5.5, 3.0, 78),
+    ('Anchorage', 2.5, 12.0, 4.0, 70), ('Honolulu', 25.5, 2.0, 3.5, 70), ('Auckland', 15.5, -4.0, 4.0, 79),
+]
+
+# (description, minimum humidity %, minimum temperature °C) from the wettest to the driest sky
+SKIES = [
+    ('thunderstorm', 93, 18), ('moderate rain', 90, -50), ('light rain', 84, -50), ('mist', 80, -50),
+    ('overcast clouds', 72, -50), ('broken clouds', 62, -50), ('scattered clouds', 50, -50),
+    ('few clouds', 40, -50), ('clear sky', -1, -50),
+]
+
+YEAR_SECONDS = 365.2425 * 86400
+
+
+def sky(humidity: float, temperature: float) -> str:
+    """
+    Returns the sky description of SKIES matching a humidity and a temperature, like generate_city.
+
+    Args:
+        humidity (float): The humidity in %.
+        temperature (float): The temperature in °C.
+
+    Returns:
+        str: The description, e.g. 'light rain'.
+    """
+    return next((description for description, min_humidity, min_temperature in SKIES
+                 if humidity >= min_humidity and temperature >= min_temperature), SKIES[-1][0])
+
+
+def city_climates(n_cities: int, seed: int = 0) -> list[tuple[str, float, float, float, float]]:
+    """
+    Returns the climate of n cities: the real cities of CLIMATES first, then made-up ones.
+
+    Args:
+        n_cities (int): The number of cities.
+        seed (int, optional): The seed of the made-up climates. Defaults to 0.
+
+    Returns:
+        list[tuple]: The (name, annual mean, seasonal amplitude, diurnal amplitude, mean humidity)
+            of each city.
+    """
+    climates = CLIMATES[:n_cities]
+    rng = np.random.default_rng([seed, n_cities])
+    for i in range(len(climates), n_cities):
+        latitude = rng.uniform(-60, 70)
+        mean = 28 - 0.35 * abs(latitude) + rng.normal(0, 2)
+        seasonal = np.sign(latitude) * (1 + 0.25 * abs(latitude)) * rng.uniform(0.7, 1.2)
+        climates.append((f'City {i:05d}', round(mean, 1), round(seasonal, 1), round(rng.uniform(3, 8), 1),
+                         round(rng.uniform(50, 85))))
+    return climates
+
+
+def generate_city(climate: tuple, timestamps: np.ndarray, seed: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Generates the observations of a city at the given times.
+
+    The temperature is the sum of the seasonal and diurnal cycles of the climate and of weather
+    fronts, a smooth random anomaly drifting over a few days. Humidity falls when the air warms
+    up during the day and rises with the fronts, and the sky description follows the humidity.
+    The observations only depend on the seed, the city and the timestamps, so a chunk can be
+    generated independently of the others.
+
+    Args:
+        climate (tuple): The climate of the city, see city_climates.
+        timestamps (np.ndarray): The epoch seconds of the observations.
+        seed (int): The seed of the random parts.
+
+    Returns:
+        tuple: The temperature (°C), humidity (%) and weather description arrays.
+    """
+    name, mean, seasonal, diurnal, humidity_mean = climate
+    city_seed = int.from_bytes(hashlib.md5(name.encode()).digest()[:4], 'little')
+    # the fronts are smooth noise interpolated between values drawn every 6 hours
+    knot = 6 * 3600
+    first, last = int(timestamps[0]) // knot, int(timestamps[-1]) // knot + 1
+    fronts = np.interp(timestamps / knot, np.arange(first, last + 1), _knot_values(seed, city_seed, first, last))
+    anomaly = 2.5 * fronts
+
+    season = np.cos(2 * np.pi * (timestamps / YEAR_SECONDS - 0.54))  # warmest in mid-July
+    day = np.cos(2 * np.pi * ((timestamps % 86400) / 86400 - 15 / 24))  # warmest at 15:00
+    rng = np.random.default_rng([seed, city_seed, int(timestamps[0])])
+    temperature = mean + seasonal * season + diurnal * day + anomaly + rng.normal(0, 0.3, len(timestamps))
+    humidity = humidity_mean - 12 * day + 6 * fronts + rng.normal(0, 4, len(timestamps))
+    humidity = np.clip(np.rint(humidity), 5, 100)
+
+    descriptions = np.array([sky for sky, _, _ in SKIES], dtype=object)
+    conditions = [(humidity >= min_humidity) & (temperature >= min_temperature)
+                  for _, min_humidity, min_temperature in SKIES]
+    weather = descriptions[np.argmax(np.array(conditions), axis=0)]
+    return temperature.round(2), humidity.astype(np.int64), weather
+
+
+def _knot_values(seed: int, city_seed: int, first: int, last: int) -> np.ndarray:
+    # knot k is drawn from a block of 64 knots seeded by k // 64, so its value does not depend
+    # on the chunk being generated
+    values = np.concatenate([np.random.default_rng([seed, city_seed, block]).normal(size=64)
+                             for block in range(first // 64, last // 64 + 1)])
+    return values[first % 64:first % 64 + last - first + 1]
+
+
+def _chunks(climates: list[tuple], rows: int, start: int, step: int, chunk_size: int,
+            seed: int) -> Iterator[tuple[str, np.ndarray, tuple]]:
+    per_city = np.full(len(climates), rows // len(climates))
+    per_city[:rows % len(climates)] += 1
+    for climate, count in zip(climates, per_city):
+        for offset in range(0, count, chunk_size):
+            timestamps = start + step * np.arange(offset, min(count, offset + chunk_size), dtype=np.int64)
+            yield climate[0], timestamps, generate_city(climate, timestamps, seed)
+
+
+def synthetic_rows(rows: int, cities: int = 3, step: int = 60, starting_date: str = '2024-01-01', seed: int = 0,
+                   chunk_size: int = 10_000) -> Iterator[tuple[str, dict]]:
+    """
+    Generates observations like generate, in memory, e.g. to feed a BatchWriter or build payloads.
+
+    Args:
+        rows (int): The number of observations.
+        cities (int, optional): The number of cities, see city_climates. Defaults to 3.
+        step (int, optional): The number of seconds between two observations of a city. Defaults to 60.
+        starting_date (str, optional): The date of the first observation. Defaults to '2024-01-01'.
+        seed (int, optional): The seed of the random parts. Defaults to 0.
+        chunk_size (int, optional): The number of observations of a city generated at once. Defaults to 10,000.
+
+    Yields:
+        tuple: (city, weather_data) pairs shaped like the output of parse_weather_data, in time
+            order, the cities taking turns.
+    """
+    climates = city_climates(cities, seed)
+    start = schema.to_epoch(starting_date)
+    for offset in range(0, -(-rows // cities), chunk_size):
+        chunks = []
+        for i, climate in enumerate(climates):
+            # the first rows % cities cities get one more observation, as in generate
+            count = min(rows // cities + (i < rows % cities), offset + chunk_size)
+            if count <= offset:
+                break
+            timestamps = start + step * np.arange(offset, count, dtype=np.int64)
+            temperature, humidity, weather = generate_city(climate, timestamps, seed)
+            chunks.append([(climate[0], {'timestamp': t, 'temperature': temp, 'humidity': h, 'weather': w})
+                           for t, temp, h, w in zip(timestamps.tolist(), temperature.tolist(), humidity.tolist(),
+                                                    weather.tolist())])
+        for turn in itertools.zip_longest(*chunks):
+            yield from (row for row in turn if row is not None)
+
+
+def generate(db_path: str, rows: int, cities: int = 10, years: float = 2, starting_date: str = '2022-01-01',
+             seed: int = 0, chunk_size: int = 1_000_000) -> dict:
+    """
+    Creates a database of realistic synthetic observations of several cities over several years.
+
+    The rows are spread evenly over the cities and regularly over the years, so the interval
+    between two observations of a city shrinks as rows grows (1k rows: a few days, 100M rows over
+    10 cities and 2 years: about 6 seconds, rounded to whole seconds). The same arguments always
+    produce the same database. Rows are inserted city by city in time order, one transaction per
+    chunk, with the rollups merged per chunk instead of by the trigger.
+
+    Args:
+        db_path (str): The path of the database to create; it must not exist.
+        rows (int): The number of observations.
+        cities (int, optional): The number of cities. Defaults to 10.
+        years (float, optional): The number of years covered. Defaults to 2.
+        starting_date (str, optional): The date of the first observation. Defaults to '2022-01-01'.
+        seed (int, optional): The seed of the random parts. Defaults to 0.
+        chunk_size (int, optional): The number of rows per transaction. Defaults to 1,000,000.
+
+    Returns:
+        dict: The rows, cities, seconds between observations of a city, first and last timestamp,
+            generation time, rows per second and file size in bytes.
+
+    Raises:
+        FileExistsError: If db_path exists.
+    """
+    if os.path.exists(db_path):
+        raise FileExistsError(db_path)
+    climates = city_climates(cities, seed)
+    start = schema.to_epoch(starting_date)
+    step = max(1, round(years * YEAR_SECONDS / max(1, -(-rows // cities))))
+
+    started = time.perf_counter()
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    configure_connection(conn)
+    conn.execute('PRAGMA synchronous=OFF')
+    schema.migrate(conn)
+    schema.drop_rollup_trigger(conn)
+    ids = {name: schema.city_id(conn, name) for name, *_ in climates}
+    description_ids = {sky: schema.description_id(conn, sky) for sky, _, _ in SKIES}
+    end = start
+    for name, timestamps, (temperature, humidity, weather) in _chunks(climates, rows, start, step, chunk_size, seed):
+        conn.execute('BEGIN')
+        last_rowid = conn.execute('SELECT IFNULL(MAX(rowid), 0) FROM observation').fetchone()[0]
+        conn.executemany('INSERT INTO observation (city_id, timestamp, temperature, humidity, description_id) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         zip([ids[name]] * len(timestamps), timestamps.tolist(), temperature.tolist(),
+                             humidity.tolist(), [description_ids[sky] for sky in weather.tolist()]))
+        schema.merge_into_rollups(conn, last_rowid)
+        conn.execute('COMMIT')
+        end = max(end, int(timestamps[-1]))
+    schema.create_rollup_trigger(conn)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+    seconds = time.perf_counter() - started
+    return {
+        'rows': rows,
+        'cities': cities,
+        'step': step,
+        'start': start,
+        'end': end,
+        'seconds': seconds,
+        'rows_per_sec': rows / seconds if seconds else 0,
+        'bytes': os.path.getsize(db_path),
+    }
+
+
+def main() -> None:
+    """
+    Command line entry point creating a synthetic observation database.
+    """
+    parser = argparse.ArgumentParser(description="Create a database of realistic synthetic weather observations.")
+    parser.add_argument('db', help="path of the database to create")
+    parser.add_argument('--rows', type=int, default=1_000_000, help="number of observations (default: 1000000)")
+    parser.add_argument('--cities', type=int, default=10, help="number of cities (default: 10)")
+    parser.add_argument('--years', type=float, default=2, help="number of years covered (default: 2)")
+    parser.add_argument('--start', default='2022-01-01', help="date of the first observation (default: 2022-01-01)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generator (default: 0)")
+    args = parser.parse_args()
+
+    result = generate(args.db, args.rows, args.cities, args.years, args.start, args.seed)
+    print(f"{result['rows']:,} observations of {result['cities']} cities every {result['step']}s "
+          f"({schema.from_epoch(result['start'])} to {schema.from_epoch(result['end'])}) in "
+          f"{result['seconds']:.1f}s, {result['rows_per_sec']:,.0f} rows/s, {result['bytes'] / 2 ** 20:,.1f} MiB.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import queue
+import sqlite3
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+import schema
+from schema import DB_PATH
+
+
+class ReadOnlyPool:
+    """
+    A bounded pool of read-only connections to a database, shared by the threads of a server.
+
+    Connections are opened on first need, at most size of them, and reused last-in first-out,
+    so the busiest ones keep their page cache warm. Being read-only, they never take the write
+    lock, and in WAL mode they read alongside the ingestion writer. A thread asking for a
+    connection while all of them are in use waits for one to be returned.
+
+    Args:
+        db_path (str, optional): The path of the SQLite database. Defaults to DB_PATH.
+        size (int, optional): The maximum number of connections. Defaults to 8.
+        mmap_size (int, optional): The number of bytes of the database each connection maps in
+            memory, 0 to read through the page cache only. Defaults to 256 MiB.
+    """
+
+    def __init__(self, db_path: str = DB_PATH, size: int = 8, mmap_size: int = 256 * 2 ** 20) -> None:
+        self.db_path = db_path
+        self.size = size
+        self.mmap_size = mmap_size
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = schema.connect_readonly(self.db_path, check_same_thread=False)
+        conn.execute(f'PRAGMA mmap_size={self.mmap_size}')
+        return conn
+
+    def acquire(self, timeout: float | None = None) -> sqlite3.Connection:
+        """
+        Takes a connection out of the pool, opening one if fewer than size are open.
+
+        Args:
+            timeout (float, optional): The number of seconds to wait for a connection. Defaults
+                to waiting indefinitely.
+
+        Returns:
+            sqlite3.Connection: The connection, to give back with release.
+
+        Raises:
+            queue.Empty: If no connection was returned within the timeout.
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if can_open:
+            try:
+                return self._open()
+            except BaseException:
+                with self.lock:
+                    self.opened -= 1
+                raise
+        return self.idle.get(timeout=timeout)
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        """
+        Gives a connection back to the pool.
+
+        Args:
+            conn (sqlite3.Connection): A connection taken with acquire.
+        """
+        if self.closed:
+            conn.close()
+            with self.lock:
+                self.opened -= 1
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        Lends a connection for the duration of a with block.
+
+        Yields:
+            sqlite3.Connection: The connection.
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        """
+        Closes the idle connections; connections in use are closed when they are released.
+        """
+        self.closed = True
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+            with self.lock:
+                self.opened -= 1
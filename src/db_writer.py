@@ -0,0 +1,221 @@
+import logging
+import sqlite3
+import threading
+import time
+
+import metrics
+import schema
+from schema import DB_PATH
+
+ROWS_WRITTEN = metrics.counter('weather_rows_written_total', "Observations flushed to SQLite (duplicates included).")
+COMMIT_SECONDS = metrics.histogram('weather_db_commit_seconds', "Duration of the write transactions of BatchWriter.")
+FLUSH_ERRORS = metrics.counter('weather_flush_errors_total', "Background flushes of BatchWriter that raised an exception.")
+BUFFERED_ROWS = metrics.gauge('weather_writer_buffered_rows', "Observations buffered by BatchWriter, not yet flushed.")
+
+
+def configure_connection(conn: sqlite3.Connection) -> None:
+    """
+    Applies the pragmas used by long-lived writer connections.
+
+    WAL mode lets readers (GUI, analysis) keep working while the writer commits, and
+    synchronous=NORMAL only syncs the WAL at checkpoints instead of on every commit.
+
+    Args:
+        conn (sqlite3.Connection): The connection to configure.
+    """
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-65536')
+    conn.execute('PRAGMA busy_timeout=5000')
+
+
+class BatchWriter:
+    """
+    A long-lived, single-connection writer that buffers observations and stores them in batches.
+
+    The buffer is flushed with one executemany transaction when it holds batch_size rows, or
+    by a background thread once the oldest buffered row is flush_interval seconds old. Rows
+    already stored for the same city and timestamp are ignored. The writer can be shared
+    between threads and should be closed to flush the remaining rows.
+
+    Args:
+        db_path (str, optional): The path of the SQLite database. Defaults to DB_PATH.
+        batch_size (int, optional): The number of buffered rows triggering a flush. Defaults to 500.
+        flush_interval (float, optional): The maximum number of seconds a row stays buffered.
+            Defaults to 1.
+    """
+
+    def __init__(self, db_path: str = DB_PATH, batch_size: int = 500, flush_interval: float = 1.0) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        configure_connection(self.conn)
+        schema.migrate(self.conn)
+        self.city_ids = {}
+        self.description_ids = {}
+        self.listeners = []
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.conn_lock = threading.Lock()
+        self.oldest = None
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_periodically, name='batch-writer', daemon=True)
+        self.flusher.start()
+
+    def add_listener(self, listener) -> None:
+        """
+        Registers a function called, after each committed flush, with the list of
+        (city, timestamp, temperature, humidity, weather) rows the flush inserted, i.e. without the
+        observations ignored as already stored or sealed, e.g. StreamingAggregator.on_flush.
+
+        Args:
+            listener (callable): The function to call.
+        """
+        self.listeners.append(listener)
+
+    def write(self, city: str, weather_data: dict) -> None:
+        """
+        Buffers one observation.
+
+        Args:
+            city (str): The name of the city.
+            weather_data (dict): The dictionary returned by parse_weather_data.
+        """
+        self.write_many([(city, weather_data)])
+
+    def write_many(self, rows: list[tuple[str, dict]]) -> None:
+        """
+        Buffers several observations, flushing if the buffer reaches batch_size.
+
+        Args:
+            rows (list): A list of (city, weather_data) pairs.
+        """
+        if self.closed.is_set():
+            raise RuntimeError("BatchWriter is closed")
+        records = [(city, wd['timestamp'], wd['temperature'], wd['humidity'], wd['weather']) for city, wd in rows]
+        with self.buffer_lock:
+            if not self.buffer:
+                self.oldest = time.monotonic()
+            self.buffer.extend(records)
+            full = len(self.buffer) >= self.batch_size
+            BUFFERED_ROWS.set(len(self.buffer))
+        if full:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Writes every buffered observation in a single transaction.
+
+        If the transaction fails, e.g. on a locked database or a full disk, the rows are put back
+        at the front of the buffer, to be written by the next flush.
+
+        Returns:
+            int: The number of rows written.
+        """
+        with self.buffer_lock:
+            batch, oldest, self.buffer, self.oldest = self.buffer, self.oldest, [], None
+            BUFFERED_ROWS.set(0)
+        if not batch:
+            return 0
+        try:
+            inserted, seconds = self._write(batch)
+        except BaseException:
+            with self.buffer_lock:
+                self.buffer[:0] = batch
+                self.oldest = oldest
+                BUFFERED_ROWS.set(len(self.buffer))
+            raise
+        COMMIT_SECONDS.observe(seconds)
+        ROWS_WRITTEN.inc(len(batch))
+        metrics.log_event('flush', rows=len(batch), seconds=round(seconds, 4))
+        for listener in self.listeners:
+            listener(inserted)
+        return len(batch)
+
+    def _write(self, batch: list[tuple]) -> tuple[list[tuple] | None, float]:
+        with self.conn_lock:
+            started = time.perf_counter()
+            with self.conn:
+                new_ids = {city: schema.city_id(self.conn, city)
+                           for city in {record[0] for record in batch} - self.city_ids.keys()}
+                ids = self.city_ids | new_ids
+                new_description_ids = {text: schema.description_id(self.conn, text)
+                                       for text in {record[4] for record in batch} - self.description_ids.keys()}
+                description_ids = self.description_ids | new_description_ids
+                if self.listeners:
+                    last_rowid = self.conn.execute('SELECT IFNULL(MAX(rowid), 0) FROM observation').fetchone()[0]
+                self.conn.executemany(schema.INSERT_OBSERVATION_SQL,
+                                      [(ids[city], *values, description_ids[text])
+                                       for city, *values, text in batch])
+                inserted = self._inserted(batch, ids, last_rowid) if self.listeners else None
+            # the caches only learn the ids once their rows are committed
+            self.city_ids = ids
+            self.description_ids = description_ids
+            return inserted, time.perf_counter() - started
+
+    def _inserted(self, batch: list[tuple], ids: dict[str, int], last_rowid: int) -> list[tuple]:
+        # the rows of the batch that were not ignored as duplicates or sealed: the first of each
+        # (city, timestamp) found among the rows added to the table
+        added = set(self.conn.execute('SELECT city_id, timestamp FROM observation WHERE rowid > ?',
+                                      (last_rowid,)).fetchall())
+        inserted = []
+        for record in batch:
+            key = (ids[record[0]], record[1])
+            if key in added:
+                added.discard(key)
+                inserted.append(record)
+        return inserted
+
+    def owm_ids(self, cities: list[str]) -> dict[str, int]:
+        """
+        Returns the OpenWeatherMap ids already recorded for some cities.
+
+        Args:
+            cities (list[str]): The names of the cities.
+
+        Returns:
+            dict[str, int]: The ids by city name, unresolved cities being left out.
+        """
+        with self.conn_lock:
+            return schema.owm_ids(self.conn, cities)
+
+    def set_owm_ids(self, ids: dict[str, int]) -> None:
+        """
+        Records the OpenWeatherMap ids of some cities in a single transaction.
+
+        Args:
+            ids (dict[str, int]): The ids by city name.
+        """
+        with self.conn_lock:
+            with self.conn:
+                schema.set_owm_ids(self.conn, ids)
+
+    def _flush_periodically(self) -> None:
+        while not self.closed.wait(min(self.flush_interval, 0.1)):
+            oldest = self.oldest
+            if oldest is not None and time.monotonic() - oldest >= self.flush_interval:
+                # the rows stay buffered, and the thread alive to try again
+                try:
+                    self.flush()
+                except Exception as error:
+                    FLUSH_ERRORS.inc()
+                    metrics.log_event('flush_error', level=logging.ERROR, rows=len(self.buffer), error=repr(error))
+
+    def close(self) -> None:
+        """
+        Stops the background flusher, flushes the remaining rows and closes the connection.
+        """
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+        with self.conn_lock:
+            self.conn.close()
+
+    def __enter__(self) -> 'BatchWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import random
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable
+from typing import Any
+
+import metrics
+from lazy import lazy_import
+
+requests = lazy_import('requests')
+
+# statuses worth retrying: rate limiting and server-side failures
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+FETCH_SECONDS = metrics.histogram('weather_fetch_seconds', "Duration of single API request attempts.")
+HTTP_RESPONSES = metrics.counter('weather_http_responses_total',
+                                 "API responses by HTTP status, 'error' for connection errors and timeouts.",
+                                 ('status',))
+FETCH_OUTCOMES = metrics.counter('weather_fetch_outcomes_total', "Outcomes of fetches and of their attempts.",
+                                 ('outcome',))
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing upstream for a while instead of piling up requests on it.
+
+    After failure_threshold consecutive failures the breaker opens and rejects calls for
+    reset_timeout seconds. It then lets one trial call through (half-open): a success closes
+    it, a failure opens it again.
+
+    Args:
+        failure_threshold (int, optional): The consecutive failures opening the breaker. Defaults to 5.
+        reset_timeout (float, optional): The number of seconds the breaker stays open. Defaults to 60.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """
+        The state of the breaker: 'closed', 'open' or 'half-open'.
+        """
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    def allow(self) -> bool:
+        """
+        Returns whether a call may go through, reserving the trial call when half-open.
+        """
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """
+        Closes the breaker after a successful call.
+        """
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self) -> None:
+        """
+        Counts a failed call, opening the breaker past the threshold or after a failed trial.
+        """
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+class ResilientFetcher:
+    """
+    Fetches weather payloads with timeouts, retries, per-city circuit breakers and change detection.
+
+    Requests share a keep-alive session. Connection errors, timeouts and retryable statuses are
+    retried with full-jitter exponential backoff (honouring Retry-After). Payloads are only
+    returned when they carry new data: a 304 answer to a conditional request, or a payload
+    whose `dt` equals the last one seen for the city, is reported as unchanged. Outcomes are
+    counted in the stats Counter.
+
+    Args:
+        timeout (float, optional): The connect and read timeout of a request, in seconds. Defaults to 10.
+        retries (int, optional): The number of retries after a failed attempt. Defaults to 3.
+        backoff_base (float, optional): The base delay of the exponential backoff, in seconds. Defaults to 0.5.
+        backoff_cap (float, optional): The maximum delay between two attempts, in seconds. Defaults to 30.
+        failure_threshold (int, optional): The consecutive failures opening the breaker of a city.
+            Defaults to 5.
+        reset_timeout (float, optional): The number of seconds a breaker stays open. Defaults to 60.
+        pool_size (int, optional): The number of keep-alive connections kept per host. Defaults to 64.
+    """
+
+    def __init__(self, timeout: float = 10, retries: int = 3, backoff_base: float = 0.5, backoff_cap: float = 30,
+                 failure_threshold: int = 5, reset_timeout: float = 60, pool_size: int = 64) -> None:
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.breakers = {}
+        self.validators = {}
+        self.last_dt = {}
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def breaker(self, key: str) -> CircuitBreaker:
+        """
+        Returns the circuit breaker of a city, creating it on first use.
+        """
+        with self.lock:
+            if key not in self.breakers:
+                self.breakers[key] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self.breakers[key]
+
+    def _count(self, outcome: str) -> None:
+        with self.lock:
+            self.stats[outcome] += 1
+        FETCH_OUTCOMES.inc(outcome=outcome)
+
+    def _backoff(self, attempt: int, retry_after: str | None) -> float:
+        if retry_after and retry_after.isdigit():
+            return min(self.backoff_cap, float(retry_after))
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def get(self, key: str, url: str, check: Callable[[requests.Response], Any] | None = None
+            ) -> requests.Response | None:
+        """
+        Sends a conditional GET with retries behind the circuit breaker of key.
+
+        A 200 response that check rejects counts as a failed attempt, like a retryable status: it
+        is retried, and neither its validators nor a breaker success are recorded.
+
+        Args:
+            key (str): The key of the breaker and of the cached validators, e.g. the city name.
+            url (str): The URL to fetch.
+            check (callable, optional): A function called with a 200 response, raising ValueError,
+                KeyError, IndexError or TypeError if its body is unusable. Defaults to None.
+
+        Returns:
+            requests.Response or None: The final response (200 or 304), or None if every attempt
+                failed or the breaker is open.
+        """
+        breaker = self.breaker(key)
+        if not breaker.allow():
+            self._count('short_circuited')
+            return None
+        headers = dict(self.validators.get(key, {}))
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count('retries')
+            retry_after = None
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except requests.RequestException as error:
+                FETCH_SECONDS.observe(time.perf_counter() - started)
+                HTTP_RESPONSES.inc(status='error')
+                self._count('errors')
+                metrics.log_event('fetch_error', key=key, attempt=attempt, error=type(error).__name__)
+            else:
+                FETCH_SECONDS.observe(time.perf_counter() - started)
+                HTTP_RESPONSES.inc(status=response.status_code)
+                if response.status_code in (200, 304) and self._usable(key, attempt, response, check):
+                    breaker.record_success()
+                    validators = {}
+                    if response.headers.get('ETag'):
+                        validators['If-None-Match'] = response.headers['ETag']
+                    if response.headers.get('Last-Modified'):
+                        validators['If-Modified-Since'] = response.headers['Last-Modified']
+                    if validators:
+                        self.validators[key] = validators
+                    return response
+                if response.status_code != 200:
+                    self._count(f'status_{response.status_code}')
+                    if response.status_code not in RETRYABLE_STATUSES:
+                        break
+                    retry_after = response.headers.get('Retry-After')
+            if attempt < self.retries:
+                time.sleep(self._backoff(attempt, retry_after))
+        breaker.record_failure()
+        self._count('failed')
+        metrics.log_event('fetch_failed', key=key, attempts=attempt + 1, breaker=breaker.state)
+        return None
+
+    def _usable(self, key: str, attempt: int, response: requests.Response,
+                check: Callable[[requests.Response], Any] | None) -> bool:
+        if response.status_code != 200 or check is None:
+            return True
+        try:
+            check(response)
+        except (ValueError, KeyError, IndexError, TypeError) as error:
+            self._count('invalid_payloads')
+            metrics.log_event('fetch_error', key=key, attempt=attempt, error=f'invalid payload: {error!r}')
+            return False
+        return True
+
+    def fetch_json(self, key: str, url: str, check: Callable[[dict], Any] | None = None) -> dict | None:
+        """
+        Fetches and decodes a payload, if it changed since the last fetch of key.
+
+        A body that is not JSON, or that check rejects, counts as a failed attempt (see get).
+
+        Args:
+            key (str): The key of the breaker and of the cached validators.
+            url (str): The URL to fetch.
+            check (callable, optional): A function called with the decoded payload, raising
+                KeyError, IndexError, TypeError or ValueError if it lacks fields the caller needs,
+                e.g. parse_weather_data. Defaults to None.
+
+        Returns:
+            dict or None: The decoded payload, or None if the fetch failed or the server answered
+                304 Not Modified.
+        """
+        decoded = {}
+
+        def decode(response: requests.Response) -> None:
+            decoded['payload'] = data = response.json()
+            if not isinstance(data, dict):
+                raise TypeError(f'expected a JSON object, got {type(data).__name__}')
+            if check is not None:
+                check(data)
+
+        response = self.get(key, url, decode)
+        if response is None:
+            return None
+        if response.status_code == 304:
+            self._count('not_modified')
+            return None
+        return decoded['payload']
+
+    def is_new(self, city: str, data: dict) -> bool:
+        """
+        Tells whether a payload holds a new observation of a city, i.e. whether its `dt` differs
+        from the last one seen, and remembers it.
+
+        Args:
+            city (str): The name of the city.
+            data (dict): The current weather payload of the city.
+
+        Returns:
+            bool: True if the observation is new.
+        """
+        dt = data.get('dt')
+        with self.lock:
+            new = dt is None or self.last_dt.get(city) != dt
+            self.last_dt[city] = dt
+        self._count('ok' if new else 'unchanged')
+        return new
+
+    def fetch(self, city: str, url: str, check: Callable[[dict], Any] | None = None) -> dict | None:
+        """
+        Fetches the current weather payload of a city, if it changed since the last fetch.
+
+        Args:
+            city (str): The name of the city.
+            url (str): The API URL of the city.
+            check (callable, optional): A function validating the decoded payload, see fetch_json.
+                Defaults to None.
+
+        Returns:
+            dict or None: The decoded payload, or None if the fetch failed or the upstream
+                observation (`dt`) has not changed.
+        """
+        data = self.fetch_json(city, url, check)
+        if data is None or not self.is_new(city, data):
+            return None
+        return data
+
+    def close(self) -> None:
+        """
+        Closes the HTTP session.
+        """
+        self.session.close()
@@ -1,8 +1,164 @@
+from __future__ import annotations
 from tkinter import messagebox, ttk
 from tkinter.scrolledtext import ScrolledText
 import tkinter as tk
+import logging
+import os
 import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
 import weather_data_analysis as an
+from lazy import lazy_import
+
+# matplotlib and pandas load with the first query rather than before the window appears
+backend_tkagg = lazy_import('matplotlib.backends.backend_tkagg')
+mpl_figure = lazy_import('matplotlib.figure')
+pd = lazy_import('pandas')
+
+# queries run on a single background worker so that the Tk main loop never blocks
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gui-worker')
+current_job = None
+
+# the chart window and its figure are created once and reused by every plot
+chart_window = None
+chart_figure = None
+chart_canvas = None
+CHART_SIZE = (8, 4.5)
+# the width of the chart in pixels (at the default 100 dpi), which bounds the points drawn per line
+CHART_WIDTH = int(CHART_SIZE[0] * 100)
+
+
+class Job:
+    """
+    A query running on the background worker, which can be cancelled and report progress.
+
+    Args:
+        description (str): The text shown in the status bar while the job runs.
+    """
+
+    def __init__(self, description: str) -> None:
+        self.description = description
+        self.cancelled = threading.Event()
+        self.progress_text = description
+
+    def check(self) -> None:
+        """
+        Raises CancelledJob if the job has been cancelled; called by the task between steps.
+        """
+        if self.cancelled.is_set():
+            raise CancelledJob()
+
+    def progress(self, text: str) -> None:
+        """
+        Updates the progress text shown in the status bar (safe to call from the worker).
+        """
+        self.progress_text = text
+
+
+class CancelledJob(Exception):
+    """
+    Raised inside a task when its job has been cancelled.
+    """
+
+
+def run_in_background(description: str, task, on_success) -> None:
+    """
+    Runs task(job) on the background worker and calls on_success(result) on the Tk main thread.
+
+    Any job still running is cancelled first. The result is marshalled back by polling the
+    future with root.after, as Tk widgets must only be touched from the main thread.
+
+    Args:
+        description (str): The text shown in the status bar while the job runs.
+        task (callable): The function computing the result, called with the Job.
+        on_success (callable): The function receiving the result on the main thread.
+    """
+    global current_job
+    cancel_job()
+    job = current_job = Job(description)
+    future = executor.submit(task, job)
+    progress_bar.start(10)
+    cancel_button.config(state='normal')
+    root.after(50, poll_job, job, future, on_success)
+
+
+def poll_job(job: Job, future: Future, on_success) -> None:
+    """
+    Checks whether a job is done, updating the status bar until it is.
+    """
+    if not future.done():
+        status_label.config(text=job.progress_text)
+        root.after(50, poll_job, job, future, on_success)
+        return
+    if job is current_job:
+        finish_job('')
+    if job.cancelled.is_set():
+        return
+    # this runs in a Tk after callback, where an exception would only be printed to stderr
+    try:
+        result = future.result()
+    except (TypeError, AttributeError, ValueError, KeyError):
+        text_area.insert(1.0, "Input Error" + "\n")
+        return
+    except Exception as error:
+        show_error(job, error)
+        return
+    try:
+        on_success(result)
+    except Exception as error:
+        show_error(job, error)
+
+
+def show_error(job: Job, error: Exception) -> None:
+    """
+    Reports a failed job in the status bar and a message box, e.g. a locked or missing database.
+    """
+    metrics.log_event('gui_error', level=logging.ERROR, job=job.description, error=repr(error))
+    status_label.config(text=f"Error: {type(error).__name__}")
+    messagebox.showerror(title="Error", message=f"{type(error).__name__}: {error}")
+
+
+def finish_job(status: str) -> None:
+    """
+    Resets the progress bar, the cancel button and the status bar.
+    """
+    global current_job
+    current_job = None
+    progress_bar.stop()
+    cancel_button.config(state='disabled')
+    status_label.config(text=status)
+
+
+def cancel_job() -> None:
+    """
+    Cancels the running job, if any; its result is discarded.
+    """
+    if current_job is not None:
+        current_job.cancelled.set()
+        finish_job('Cancelled')
+
+
+def show_chart(draw) -> None:
+    """
+    Draws a chart in the chart window, creating the window and its figure on first use.
+
+    Args:
+        draw (callable): The function drawing the chart, called with the cleared Axes.
+    """
+    global chart_window, chart_figure, chart_canvas
+    if chart_window is None or not chart_window.winfo_exists():
+        chart_window = tk.Toplevel(root)
+        chart_window.title("Temperature Trends")
+        chart_figure = mpl_figure.Figure(figsize=CHART_SIZE)
+        chart_canvas = backend_tkagg.FigureCanvasTkAgg(chart_figure, master=chart_window)
+        backend_tkagg.NavigationToolbar2Tk(chart_canvas, chart_window)
+        chart_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+    chart_figure.clear()
+    draw(chart_figure.add_subplot())
+    chart_figure.tight_layout()
+    chart_canvas.draw_idle()
+    chart_window.lift()
 
 # a function to link button for temperature trend for all cities available to the corresponding function
 def date_combiner() -> tuple[str, str]:
@@ -36,16 +192,21 @@ def on_button_click_plot_graph() -> None:
     """
     Handles the button click event for plotting the temperature trends graph.
 
-    Retrieves the starting and ending timestamps from user input, then calls the
-    mean_temperature_per_hr_comp_diff_city function to plot the graph.
+    Retrieves the starting and ending timestamps from user input, then computes the mean
+    temperature of every city available in the background and plots it in the chart window.
     """
     starting_date, ending_date = date_combiner()
 
-    try:
-        an.mean_temperature_per_hr_comp_diff_city(starting_date, ending_date)
-    except (TypeError, AttributeError, ValueError):
-        text="Input Error" + "\n"
-        text_area.insert(1.0, text)
+    def task(job: Job) -> tuple[pd.DataFrame, str]:
+        grain = an.rollup_grain(starting_date, ending_date, CHART_WIDTH)
+        return an.mean_temperature_by_city(starting_date, ending_date, grain=grain), grain
+
+    def on_success(result: tuple[pd.DataFrame, str]) -> None:
+        temperature_mean, grain = result
+        show_chart(lambda ax: an.plot_mean_temperature_by_city(ax, temperature_mean, grain, starting_date, ending_date,
+                                                               CHART_WIDTH))
+
+    run_in_background("Computing mean temperatures...", task, on_success)
 
 
 def clear_text_area() -> None:
@@ -118,153 +279,185 @@ def on_button_click_print_data_or_plot_graph() -> None:
         city = city_combo.get()
         # Execute the print function if selected one
         if re.match(r'\bPrint\b', function):
-           df = an.fetch_data_from_db(city, starting_date, ending_date)
-           text_area.insert(1.0, df) 
-        
+            def task(job: Job) -> str:
+                chunks, rows = [], 0
+                for chunk in an.iter_data_from_db(city, starting_date, ending_date):
+                    job.check()
+                    chunks.append(chunk)
+                    rows += len(chunk)
+                    job.progress(f"Loading weather data... {rows:,} rows")
+                if not chunks:
+                    return str(None)
+                return str(pd.concat(chunks).astype({'city': 'category', 'weather': 'category'}))
+
+            run_in_background("Loading weather data...", task, lambda text: text_area.insert(1.0, text))
+
         else:
-            an.temperature_trends_graph(city, starting_date, ending_date)
+            def draw(result: tuple[pd.DataFrame, str]) -> None:
+                df, grain = result
+                show_chart(lambda ax: an.plot_temperature_trends(ax, df, grain, starting_date, ending_date,
+                                                                 CHART_WIDTH))
+
+            run_in_background("Computing temperature trends...",
+                              lambda job: an.temperature_trends(city, starting_date, ending_date, CHART_WIDTH), draw)
     else:
         text = 'Input Error' +'\n'
         text_area.insert(1.0, text)
 
 
-# initialize the root
-root = tk.Tk()
-root.title("Weather Data Analysis GUI") # title at top
-root.geometry("435x400") # size of window
-
-# interval label
-label_interval = tk.Label(root, text="Please enter the interval: ")
-label_interval.grid(row=0, column=0)
-
-# entry for starting year
-starting_year_entry = tk.Entry(root, width=4)
-starting_year_entry.place(x=135, y=0)
-starting_year_entry.insert(0, 'yyyy')
-starting_year_entry.config(fg='gray')
-starting_year_entry.bind("<FocusIn>", clear_default_text)
-
-# entry for starting month
-starting_month_entry = tk.Entry(root, width=4)
-starting_month_entry.place(x=165, y=0)
-starting_month_entry.insert(0, 'mm')
-starting_month_entry.config(fg='gray')
-starting_month_entry.bind("<FocusIn>", clear_default_text)
-
-# entry for starting day
-starting_day_entry = tk.Entry(root, width=3)
-starting_day_entry.place(x=195, y=0)
-starting_day_entry.insert(0, 'dd')
-starting_day_entry.config(fg='gray')
-starting_day_entry.bind("<FocusIn>", clear_default_text)
-
-# entry for starting hour
-starting_hour_entry = tk.Entry(root, width=3)
-starting_hour_entry.place(x=219, y=0)
-starting_hour_entry.insert(0, 'HH')
-starting_hour_entry.config(fg='gray')
-starting_hour_entry.bind("<FocusIn>", clear_default_text)
-
-# entry for starting minute
-starting_minute_entry = tk.Entry(root, width=4)
-starting_minute_entry.place(x=243, y=0)
-starting_minute_entry.insert(0, 'MM')
-starting_minute_entry.config(fg='gray')
-starting_minute_entry.bind("<FocusIn>", clear_default_text)
-
-# to
-label_to = tk.Label(root,text="to")
-label_to.place(x=275, y=0)
-
-# entry for ending year
-ending_year_entry = tk.Entry(root, width=4)
-ending_year_entry.place(x=296, y=0)
-ending_year_entry.insert(0, 'yyyy')
-ending_year_entry.config(fg='gray')
-ending_year_entry.bind("<FocusIn>", clear_default_text)
-
-# entry for ending month
-ending_month_entry = tk.Entry(root, width=4)
-ending_month_entry.place(x=325, y=0)
-ending_month_entry.insert(0, 'mm')
-ending_month_entry.config(fg='gray')
-ending_month_entry.bind("<FocusIn>", clear_default_text)
-
-# entry for ending day
-ending_day_entry = tk.Entry(root, width=3)
-ending_day_entry.place(x=354, y=0)
-ending_day_entry.insert(0, 'dd')
-ending_day_entry.config(fg='gray')
-ending_day_entry.bind("<FocusIn>", clear_default_text)
-
-# entry for ending hour
-ending_hour_entry = tk.Entry(root, width=3)
-ending_hour_entry.place(x=376, y=0)
-ending_hour_entry.insert(0, 'HH')
-ending_hour_entry.config(fg='gray')
-ending_hour_entry.bind("<FocusIn>", clear_default_text)
-
-# entry for ending minute
-ending_minute_entry = tk.Entry(root, width=4)
-ending_minute_entry.place(x=400, y=0)
-ending_minute_entry.insert(0, 'MM')
-ending_minute_entry.config(fg='gray')
-ending_minute_entry.bind("<FocusIn>", clear_default_text)
-
-# separator betweeen timestamp section and other section
-separator1 = ttk.Separator(root, orient='horizontal')
-separator1.place(x=0, y=25, relwidth=1)
-
-# label for the plot of temperature trend for all cities available
-all_city_plot_label = tk.Label(root, text="Plot the temperature trend for all cities available")
-all_city_plot_label.place(x=85, y=30)
-
-# button for temperature trend for all cities available
-plot_graph_button = ttk.Button(text="Plot Graph", command=on_button_click_plot_graph)
-plot_graph_button.place(x=180, y=60)
-
-
-# label for city selection
-city_label = tk.Label(root, text="City")
-city_label.place(x=90, y=100)
-
-# combobox for city selection
-city_combo = ttk.Combobox(
-    state="readonly",
-    values=["Hong Kong", "New York", "Tokyo"]
-)
-city_combo.place(x=35, y=130)
-
-# separator betweeen city section and function senction
-separator2 = ttk.Separator(root, orient='vertical')
-separator2.place(x=220, y=95, relheight=0.18)
-
-# label for function selection
-function_label = tk.Label(root, text="function")
-function_label.place(x=300, y=100)
-
-
-# combobox for function selection
-function_combo = ttk.Combobox(
-    state="readonly",
-    values=["Print weather data", "Plot temperature graph"]
-)
-function_combo.place(x=260, y=130)
-
-# separator for all city trend graph and other section
-separator3 = ttk.Separator(root, orient='horizontal')
-separator3.place(x=0, y=95, relwidth=1)
-
-# button for the confirmation of the input of city and function
-enter_button = ttk.Button(text="Enter", command=on_button_click_print_data_or_plot_graph)
-enter_button.place(x=330, y=360)
-
-# text area to show the weather data or error messages
-text_area = ScrolledText(root, width=45, height=11)
-text_area.place(x=30, y=170)
-
-# button to clear the messages on the text area
-clear_button = ttk.Button(text="Clear", command=clear_text_area)
-clear_button.place(x=20, y=360)
-
-root.mainloop()
+if __name__ == "__main__":
+    # expose the query metrics when METRICS_PORT is set
+    if os.environ.get('METRICS_PORT'):
+        metrics.start_metrics_server(int(os.environ['METRICS_PORT']))
+
+    # initialize the root
+    root = tk.Tk()
+    root.title("Weather Data Analysis GUI") # title at top
+    root.geometry("435x420") # size of window
+
+    # interval label
+    label_interval = tk.Label(root, text="Please enter the interval: ")
+    label_interval.grid(row=0, column=0)
+
+    # entry for starting year
+    starting_year_entry = tk.Entry(root, width=4)
+    starting_year_entry.place(x=135, y=0)
+    starting_year_entry.insert(0, 'yyyy')
+    starting_year_entry.config(fg='gray')
+    starting_year_entry.bind("<FocusIn>", clear_default_text)
+
+    # entry for starting month
+    starting_month_entry = tk.Entry(root, width=4)
+    starting_month_entry.place(x=165, y=0)
+    starting_month_entry.insert(0, 'mm')
+    starting_month_entry.config(fg='gray')
+    starting_month_entry.bind("<FocusIn>", clear_default_text)
+
+    # entry for starting day
+    starting_day_entry = tk.Entry(root, width=3)
+    starting_day_entry.place(x=195, y=0)
+    starting_day_entry.insert(0, 'dd')
+    starting_day_entry.config(fg='gray')
+    starting_day_entry.bind("<FocusIn>", clear_default_text)
+
+    # entry for starting hour
+    starting_hour_entry = tk.Entry(root, width=3)
+    starting_hour_entry.place(x=219, y=0)
+    starting_hour_entry.insert(0, 'HH')
+    starting_hour_entry.config(fg='gray')
+    starting_hour_entry.bind("<FocusIn>", clear_default_text)
+
+    # entry for starting minute
+    starting_minute_entry = tk.Entry(root, width=4)
+    starting_minute_entry.place(x=243, y=0)
+    starting_minute_entry.insert(0, 'MM')
+    starting_minute_entry.config(fg='gray')
+    starting_minute_entry.bind("<FocusIn>", clear_default_text)
+
+    # to
+    label_to = tk.Label(root,text="to")
+    label_to.place(x=275, y=0)
+
+    # entry for ending year
+    ending_year_entry = tk.Entry(root, width=4)
+    ending_year_entry.place(x=296, y=0)
+    ending_year_entry.insert(0, 'yyyy')
+    ending_year_entry.config(fg='gray')
+    ending_year_entry.bind("<FocusIn>", clear_default_text)
+
+    # entry for ending month
+    ending_month_entry = tk.Entry(root, width=4)
+    ending_month_entry.place(x=325, y=0)
+    ending_month_entry.insert(0, 'mm')
+    ending_month_entry.config(fg='gray')
+    ending_month_entry.bind("<FocusIn>", clear_default_text)
+
+    # entry for ending day
+    ending_day_entry = tk.Entry(root, width=3)
+    ending_day_entry.place(x=354, y=0)
+    ending_day_entry.insert(0, 'dd')
+    ending_day_entry.config(fg='gray')
+    ending_day_entry.bind("<FocusIn>", clear_default_text)
+
+    # entry for ending hour
+    ending_hour_entry = tk.Entry(root, width=3)
+    ending_hour_entry.place(x=376, y=0)
+    ending_hour_entry.insert(0, 'HH')
+    ending_hour_entry.config(fg='gray')
+    ending_hour_entry.bind("<FocusIn>", clear_default_text)
+
+    # entry for ending minute
+    ending_minute_entry = tk.Entry(root, width=4)
+    ending_minute_entry.place(x=400, y=0)
+    ending_minute_entry.insert(0, 'MM')
+    ending_minute_entry.config(fg='gray')
+    ending_minute_entry.bind("<FocusIn>", clear_default_text)
+
+    # separator betweeen timestamp section and other section
+    separator1 = ttk.Separator(root, orient='horizontal')
+    separator1.place(x=0, y=25, relwidth=1)
+
+    # label for the plot of temperature trend for all cities available
+    all_city_plot_label = tk.Label(root, text="Plot the temperature trend for all cities available")
+    all_city_plot_label.place(x=85, y=30)
+
+    # button for temperature trend for all cities available
+    plot_graph_button = ttk.Button(text="Plot Graph", command=on_button_click_plot_graph)
+    plot_graph_button.place(x=180, y=60)
+
+
+    # label for city selection
+    city_label = tk.Label(root, text="City")
+    city_label.place(x=90, y=100)
+
+    # combobox for city selection
+    city_combo = ttk.Combobox(
+        state="readonly",
+        values=an.list_cities()
+    )
+    city_combo.place(x=35, y=130)
+
+    # separator betweeen city section and function senction
+    separator2 = ttk.Separator(root, orient='vertical')
+    separator2.place(x=220, y=95, relheight=0.18)
+
+    # label for function selection
+    function_label = tk.Label(root, text="function")
+    function_label.place(x=300, y=100)
+
+
+    # combobox for function selection
+    function_combo = ttk.Combobox(
+        state="readonly",
+        values=["Print weather data", "Plot temperature graph"]
+    )
+    function_combo.place(x=260, y=130)
+
+    # separator for all city trend graph and other section
+    separator3 = ttk.Separator(root, orient='horizontal')
+    separator3.place(x=0, y=95, relwidth=1)
+
+    # button for the confirmation of the input of city and function
+    enter_button = ttk.Button(text="Enter", command=on_button_click_print_data_or_plot_graph)
+    enter_button.place(x=330, y=360)
+
+    # text area to show the weather data or error messages
+    text_area = ScrolledText(root, width=45, height=11)
+    text_area.place(x=30, y=170)
+
+    # button to clear the messages on the text area
+    clear_button = ttk.Button(text="Clear", command=clear_text_area)
+    clear_button.place(x=20, y=360)
+
+    # progress bar and status of the running query
+    progress_bar = ttk.Progressbar(root, mode='indeterminate', length=140)
+    progress_bar.place(x=105, y=362)
+    status_label = tk.Label(root, text="", fg='gray')
+    status_label.place(x=20, y=392)
+
+    # button to cancel the running query
+    cancel_button = ttk.Button(text="Cancel", command=cancel_job, state='disabled')
+    cancel_button.place(x=250, y=360)
+
+    root.mainloop()
+    executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,457 @@
+import argparse
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+from db_writer import BatchWriter
+from fetcher import ResilientFetcher
+from scheduler import TickScheduler
+from schedule import (API_BASE_URL, GROUP_SIZE, api_url_constructor, city_name, create_table,
+                      group_url_constructor, parse_weather_data)
+
+CYCLE_SECONDS = metrics.histogram('weather_cycle_seconds', "Duration of the ingestion cycles fetching every city.")
+CYCLE_OVERRUNS = metrics.counter('weather_cycle_overruns_total', "Ingestion cycles lasting longer than the interval.")
+PENDING_FETCHES = metrics.gauge('weather_pending_fetches', "Scheduled fetches queued or running in the thread pool.")
+INGEST_ERRORS = metrics.counter('weather_ingest_errors_total', "Fetches of a city or group that raised an exception.")
+
+
+class RateLimiter:
+    """
+    A thread-safe token bucket limiting how many requests are started per second.
+
+    Args:
+        rate (float): The number of requests allowed per second. A rate of 0 disables the limit.
+        burst (int, optional): The maximum number of requests that can be started back to back.
+            Defaults to the rate rounded up to at least 1.
+    """
+
+    def __init__(self, rate: float, burst: int | None = None) -> None:
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Blocks until a token is available and consumes it.
+        """
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def load_cities(path: str) -> list[str]:
+    """
+    Reads a city list from a text file with one city per line.
+
+    Blank lines and lines starting with '#' are ignored.
+
+    Args:
+        path (str): The path of the city list file.
+
+    Returns:
+        list[str]: The city names in file order.
+    """
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+class IngestionEngine:
+    """
+    Fetches the current weather for many cities concurrently and stores it in the database.
+
+    Every cycle submits one request per city to a bounded thread pool sharing a pooled HTTP
+    session, so the wall time of a cycle is governed by the slowest request rather than by
+    the number of cities. Requests are throttled by a RateLimiter to stay within the API quota
+    and go through a ResilientFetcher (timeouts, retries, circuit breakers); observations whose
+    upstream `dt` did not change since the previous cycle are not written again. An exception
+    raised while fetching one city is logged and counted in errors, and the other cities of the
+    cycle are still stored.
+
+    Args:
+        cities (list[str]): The names of the cities to track.
+        interval (float, optional): The number of minutes between two cycles. Defaults to 1.
+        max_workers (int, optional): The maximum number of concurrent requests. Defaults to 64.
+        rate_limit (float, optional): The maximum number of requests per second, 0 for no limit.
+            Defaults to 50.
+        timeout (float, optional): The timeout in seconds of a single request. Defaults to 10.
+        writer (BatchWriter, optional): The writer storing the observations. Defaults to a new
+            BatchWriter owned, and closed, by the engine.
+        fetcher (ResilientFetcher, optional): The fetcher sending the requests. Defaults to a new
+            ResilientFetcher with the given timeout.
+        base_url (str, optional): The root URL of the API. Defaults to API_BASE_URL.
+    """
+
+    def __init__(self, cities: list[str], interval: float = 1, max_workers: int = 64,
+                 rate_limit: float = 50, timeout: float = 10, writer: BatchWriter | None = None,
+                 fetcher: ResilientFetcher | None = None, base_url: str = API_BASE_URL) -> None:
+        self.cities = list(dict.fromkeys(cities))
+        self.interval = interval
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        self.fetcher = fetcher if fetcher is not None else ResilientFetcher(timeout=timeout, pool_size=max_workers)
+        self.base_url = base_url
+        self.urls = {city: api_url_constructor(city, base_url)[0] for city in self.cities}
+        self.owns_writer = writer is None
+        self.writer = writer if writer is not None else BatchWriter()
+        self.scheduler = None
+        self.errors = Counter()
+        self.errors_lock = threading.Lock()
+
+    def _record_error(self, key: str, error: BaseException) -> None:
+        with self.errors_lock:
+            self.errors[key] += 1
+        INGEST_ERRORS.inc()
+        metrics.log_event('ingest_error', level=logging.ERROR, key=key, error=repr(error))
+
+    def _isolate(self, key: str, function, *args, default=None):
+        try:
+            return function(*args)
+        except Exception as error:
+            self._record_error(key, error)
+            return default
+
+    def fetch_city(self, city: str) -> tuple[str, dict] | None:
+        """
+        Fetches and parses the current weather of one city.
+
+        Args:
+            city (str): The name of the city.
+
+        Returns:
+            tuple or None: A (city, weather_data) pair, or None if the request failed or the
+                observation did not change.
+        """
+        self.rate_limiter.acquire()
+        data = self.fetcher.fetch(city, self.urls[city], check=_parse)
+        if data is None:
+            return None
+        return city_name(city), _parse(data)
+
+    def run_cycle(self) -> int:
+        """
+        Fetches every city once and hands the results to the writer.
+
+        Returns:
+            int: The number of observations fetched.
+        """
+        with CYCLE_SECONDS.time():
+            rows = self.executor.map(lambda city: self._isolate(city, self.fetch_city, city), self.cities)
+            rows = [row for row in rows if row is not None]
+            self.writer.write_many(rows)
+        return len(rows)
+
+    def run_forever(self) -> None:
+        """
+        Runs a cycle every interval until interrupted.
+        """
+        print(f"Ingestion started for {len(self.cities)} cities every {self.interval} minute(s).")
+        next_run = time.monotonic()
+        while True:
+            started = time.monotonic()
+            stored = self.run_cycle()
+            seconds = time.monotonic() - started
+            print(f"{stored}/{len(self.cities)} new observations in {seconds:.2f}s.")
+            metrics.log_event('cycle', cities=len(self.cities), stored=stored, seconds=round(seconds, 3),
+                              overrun=seconds > self.interval * 60)
+            if seconds > self.interval * 60:
+                CYCLE_OVERRUNS.inc()
+            next_run += self.interval * 60
+            time.sleep(max(0.0, next_run - time.monotonic()))
+
+    def store_city(self, city: str) -> None:
+        """
+        Fetches one city and hands its observation, if new, to the writer.
+
+        Args:
+            city (str): The name of the city.
+        """
+        row = self.fetch_city(city)
+        if row is not None:
+            self.writer.write_many([row])
+
+    def scheduled_jobs(self) -> dict:
+        """
+        Returns the jobs run by run_scheduled, one per city, each submitting a fetch to the thread pool.
+        """
+        return {city: lambda city, tick: self.submit(self.store_city, city) for city in self.cities}
+
+    def submit(self, function, key: str) -> None:
+        """
+        Runs function(key) in the thread pool, counting it in the pending fetches gauge, and
+        logging and counting its exception, if any, against key.
+        """
+        def done(future: Future) -> None:
+            PENDING_FETCHES.dec()
+            if not future.cancelled() and future.exception() is not None:
+                self._record_error(key, future.exception())
+
+        PENDING_FETCHES.inc()
+        self.executor.submit(function, key).add_done_callback(done)
+
+    def run_scheduled(self, catch_up: bool = False) -> None:
+        """
+        Fetches each city every interval at its own phase until interrupted.
+
+        Unlike run_forever, which fetches every city at once, the cities are spread evenly over
+        the interval by a TickScheduler, so requests and writes arrive at a flat rate, and the
+        ticks are aligned to the wall clock, so slow fetches do not delay later ones.
+
+        Args:
+            catch_up (bool, optional): Whether to fetch a city immediately when its tick was
+                missed, instead of waiting for the next one. Defaults to False.
+        """
+        print(f"Ingestion started for {len(self.cities)} cities every {self.interval} minute(s), "
+              "spread over the interval.")
+        self.scheduler = TickScheduler(self.scheduled_jobs(), self.interval * 60, catch_up)
+        self.scheduler.run()
+
+    def close(self) -> None:
+        """
+        Shuts down the thread pool, closes the HTTP session and flushes the writer.
+        """
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        self.executor.shutdown(wait=True)
+        self.fetcher.close()
+        if self.owns_writer:
+            self.writer.close()
+
+
+def _parse(data: dict) -> dict:
+    # timestamped with the dt of the payload, as in backfill, so that an observation recorded and
+    # replayed is a duplicate of the one ingested live
+    return parse_weather_data(data, data['dt'])
+
+
+def _check_group(data: dict) -> None:
+    for item in data['list']:
+        _parse(item)
+
+
+class GroupIngestionEngine(IngestionEngine):
+    """
+    An IngestionEngine fetching up to group_size cities per request from the group endpoint.
+
+    City names are resolved to OpenWeatherMap ids once: the first single-city fetch of a city
+    records the id found in its payload in the city table, and later runs reuse the stored ids.
+    Resolved cities are fetched group_size at a time and each group payload is fanned out into
+    one row per city, so a cycle costs about len(cities) / group_size requests instead of
+    len(cities). Cities not resolved yet keep being fetched one by one.
+
+    Args:
+        cities (list[str]): The names of the cities to track.
+        group_size (int, optional): The maximum number of cities per request. Defaults to GROUP_SIZE.
+        **kwargs: The other arguments of IngestionEngine.
+    """
+
+    def __init__(self, cities: list[str], group_size: int = GROUP_SIZE, **kwargs) -> None:
+        super().__init__(cities, **kwargs)
+        self.group_size = group_size
+        # the ids are stored under the normalized names, see city_name
+        stored = self.writer.owm_ids(list({city_name(city) for city in self.cities}))
+        self.owm_ids = {city: stored[city_name(city)] for city in self.cities if city_name(city) in stored}
+        self.ids_lock = threading.Lock()
+        self.groups = self._make_groups()
+
+    def _make_groups(self) -> list[tuple[str, str]]:
+        cities_by_id = {}
+        for city, owm_id in self.owm_ids.items():
+            cities_by_id.setdefault(owm_id, []).append(city)
+        ids = list(cities_by_id)
+        groups = []
+        for i in range(0, len(ids), self.group_size):
+            chunk = ids[i:i + self.group_size]
+            groups.append((f'group:{chunk[0]}-{chunk[-1]}', group_url_constructor(chunk, self.base_url)))
+        self.cities_by_id = cities_by_id
+        return groups
+
+    def resolve_city(self, city: str) -> tuple[tuple[str, dict] | None, int | None]:
+        """
+        Fetches one city with the single-city endpoint, keeping the id found in its payload.
+
+        Args:
+            city (str): The name of the city.
+
+        Returns:
+            tuple: The (city, weather_data) pair or None, and the OpenWeatherMap id or None.
+        """
+        self.rate_limiter.acquire()
+        data = self.fetcher.fetch_json(city, self.urls[city], check=_parse)
+        if data is None:
+            return None, None
+        row = (city_name(city), _parse(data)) if self.fetcher.is_new(city, data) else None
+        return row, data.get('id')
+
+    def fetch_group(self, group: tuple[str, str]) -> list[tuple[str, dict]]:
+        """
+        Fetches a group of cities in one request and fans the payload out into rows.
+
+        Args:
+            group (tuple[str, str]): The key of the group and its URL.
+
+        Returns:
+            list: The (city, weather_data) pairs of the cities with a new observation.
+        """
+        key, url = group
+        self.rate_limiter.acquire()
+        data = self.fetcher.fetch_json(key, url, check=_check_group)
+        if data is None:
+            return []
+        rows = []
+        for item in data.get('list', []):
+            for city in self.cities_by_id.get(item.get('id'), ()):
+                if self.fetcher.is_new(city, item):
+                    rows.append((city_name(city), _parse(item)))
+        return rows
+
+    def run_cycle(self) -> int:
+        """
+        Fetches every group once, resolves the remaining cities and hands the results to the writer.
+
+        Returns:
+            int: The number of observations fetched.
+        """
+        with CYCLE_SECONDS.time():
+            unresolved = [city for city in self.cities if city not in self.owm_ids]
+            grouped = self.executor.map(lambda group: self._isolate(group[0], self.fetch_group, group, default=[]),
+                                        self.groups)
+            single = self.executor.map(lambda city: self._isolate(city, self.resolve_city, city, default=(None, None)),
+                                       unresolved)
+            rows = [row for group_rows in grouped for row in group_rows]
+            resolved = {}
+            for city, (row, owm_id) in zip(unresolved, single):
+                if row is not None:
+                    rows.append(row)
+                if owm_id is not None:
+                    resolved[city] = owm_id
+            self._record_ids(resolved)
+            self.writer.write_many(rows)
+        return len(rows)
+
+    def _record_ids(self, resolved: dict[str, int]) -> None:
+        if not resolved:
+            return
+        self.writer.set_owm_ids({city_name(city): owm_id for city, owm_id in resolved.items()})
+        with self.ids_lock:
+            self.owm_ids.update(resolved)
+            self.groups = self._make_groups()
+        if self.scheduler is not None:
+            self.scheduler.set_jobs(self.scheduled_jobs())
+
+    def store_group(self, key: str) -> None:
+        """
+        Fetches one group of cities and hands the new observations to the writer.
+
+        Args:
+            key (str): The key of the group.
+        """
+        url = dict(self.groups).get(key)
+        if url is not None:
+            self.writer.write_many(self.fetch_group((key, url)))
+
+    def store_city(self, city: str) -> None:
+        """
+        Fetches one unresolved city, recording its id and handing its observation to the writer.
+
+        Args:
+            city (str): The name of the city.
+        """
+        row, owm_id = self.resolve_city(city)
+        if row is not None:
+            self.writer.write_many([row])
+        if owm_id is not None:
+            self._record_ids({city: owm_id})
+
+    def scheduled_jobs(self) -> dict:
+        """
+        Returns the jobs run by run_scheduled, one per group and one per unresolved city.
+        """
+        with self.ids_lock:
+            jobs = {key: lambda key, tick: self.submit(self.store_group, key) for key, _ in self.groups}
+            jobs.update({city: lambda city, tick: self.submit(self.store_city, city)
+                         for city in self.cities if city not in self.owm_ids})
+        return jobs
+
+    def run_scheduled(self, catch_up: bool = False) -> None:
+        """
+        Resolves the city ids with one cycle, then fetches each group every interval at its own phase.
+
+        Args:
+            catch_up (bool, optional): Whether to fetch a group immediately when its tick was
+                missed, instead of waiting for the next one. Defaults to False.
+        """
+        self.run_cycle()
+        super().run_scheduled(catch_up)
+
+
+def main() -> None:
+    """
+    Command line entry point of the ingestion engine.
+
+    Cities can be passed with --city (repeatable) and/or --cities-file.
+    """
+    parser = argparse.ArgumentParser(description="Fetch weather data for many cities concurrently.")
+    parser.add_argument('--city', action='append', default=[], help="city to track (repeatable)")
+    parser.add_argument('--cities-file', help="file with one city per line")
+    parser.add_argument('--interval', type=float, default=1, help="minutes between cycles (default: 1)")
+    parser.add_argument('--workers', type=int, default=64, help="maximum concurrent requests (default: 64)")
+    parser.add_argument('--rate-limit', type=float, default=50,
+                        help="maximum requests per second, 0 for unlimited (default: 50)")
+    parser.add_argument('--timeout', type=float, default=10, help="timeout of a request in seconds (default: 10)")
+    parser.add_argument('--base-url', default=API_BASE_URL, help=f"root URL of the API (default: {API_BASE_URL})")
+    parser.add_argument('--group-size', type=int, default=0,
+                        help=f"fetch up to this many cities per request from the group endpoint (at most {GROUP_SIZE}), "
+                        "0 to fetch cities one by one (default: 0)")
+    parser.add_argument('--burst', action='store_true',
+                        help="fetch every city at once each interval instead of spreading them over the interval")
+    parser.add_argument('--catch-up', action='store_true', help="fetch immediately the cities whose tick was missed")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="serve Prometheus metrics on this local port, 0 to disable (default: 0)")
+    parser.add_argument('--json-logs', action='store_true', help="log cycles, flushes and failures as JSON lines")
+    args = parser.parse_args()
+
+    cities = list(args.city)
+    if args.cities_file:
+        cities += load_cities(args.cities_file)
+    if not cities:
+        parser.error("no city given, use --city or --cities-file")
+
+    if args.metrics_port:
+        metrics.start_metrics_server(args.metrics_port)
+    if args.json_logs:
+        metrics.enable_json_logs()
+    create_table()
+    if args.group_size > 0:
+        engine = GroupIngestionEngine(cities, min(args.group_size, GROUP_SIZE), interval=args.interval,
+                                      max_workers=args.workers, rate_limit=args.rate_limit, timeout=args.timeout,
+                                      base_url=args.base_url)
+    else:
+        engine = IngestionEngine(cities, args.interval, args.workers, args.rate_limit, args.timeout,
+                                 base_url=args.base_url)
+    try:
+        if args.burst:
+            engine.run_forever()
+        else:
+            engine.run_scheduled(args.catch_up)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import importlib
+import importlib.util
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    A stand-in for a module that is only imported when one of its attributes is first used.
+
+    After the import, the attributes of the module are copied onto the stand-in, so later
+    accesses cost no more than on the module itself.
+
+    Args:
+        name (str): The absolute name of the module, e.g. 'matplotlib.pyplot'.
+    """
+
+    def __getattr__(self, attr: str):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __dir__(self) -> list[str]:
+        return dir(importlib.import_module(self.__name__))
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    Returns a module if it is already imported, or a LazyModule importing it on first use.
+
+    Heavy libraries (pandas, matplotlib, requests...) are bound with it at module level, so that
+    entry points only pay for the libraries they actually use. Annotations naming their types
+    must then not be evaluated at definition time (`from __future__ import annotations`).
+
+    Args:
+        name (str): The absolute name of the module, e.g. 'pandas'.
+
+    Returns:
+        types.ModuleType: The module or its stand-in.
+    """
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
+
+
+def is_available(name: str) -> bool:
+    """
+    Tells whether a top-level module can be imported, without importing it.
+
+    Args:
+        name (str): The name of the module, e.g. 'pyarrow'.
+
+    Returns:
+        bool: True if the module is installed.
+    """
+    return importlib.util.find_spec(name) is not None
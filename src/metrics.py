@@ -0,0 +1,310 @@
+import json
+import logging
+import sys
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+
+# upper bounds, in seconds, of the histogram buckets: from fast SQLite commits to slow HTTP requests
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger('weather')
+# until JSON logs are enabled the events go nowhere, not even to the last resort handler that
+# prints warnings and errors to stderr
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects the labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}'
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}', *self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """
+    A monotonically increasing count, e.g. of requests or rows written.
+    """
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """
+        Increments the count of the given label values.
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, e.g. a queue depth.
+
+    A gauge may be given a function returning its current value, or a dict of values keyed by
+    label value tuples, which is called at each scrape instead of storing values.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 function: Callable[[], float | dict] | None = None) -> None:
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value: float, **labels) -> None:
+        """
+        Sets the value of the given label values.
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """
+        Adds amount (possibly negative) to the value of the given label values.
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        """
+        Subtracts amount from the value of the given label values.
+        """
+        self.inc(-amount, **labels)
+
+    def samples(self) -> Iterator[str]:
+        if self.function is None:
+            yield from super().samples()
+            return
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}'
+
+
+class Histogram(_Metric):
+    """
+    Counts observations, e.g. durations, into cumulative buckets, with their sum and count.
+
+    Args:
+        name (str): The name of the metric.
+        documentation (str): The help text of the metric.
+        labels (tuple[str, ...], optional): The label names. Defaults to none.
+        buckets (tuple[float, ...], optional): The bucket upper bounds. Defaults to DEFAULT_BUCKETS.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels) -> None:
+        """
+        Records one observation for the given label values.
+        """
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+                    break
+            counts[1] += value
+            counts[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """
+        Context manager observing the duration of its block, in seconds.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            items = sorted((key, ([*counts[0]], counts[1], counts[2])) for key, counts in self.values.items())
+        for key, (buckets, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, buckets):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(self.labels, key)} {count}'
+
+
+class Registry:
+    """
+    The set of metrics exposed by a process.
+    """
+
+    def __init__(self) -> None:
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get_or_create(self, cls: type, name: str, *args, **kwargs) -> _Metric:
+        """
+        Returns the metric registered under name, creating it if needed.
+        """
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already registered as a {metric.kind}")
+            return metric
+
+    def render(self) -> str:
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labels: tuple[str, ...] = ()) -> Counter:
+    """
+    Returns the counter registered under name, creating it if needed.
+    """
+    return REGISTRY.get_or_create(Counter, name, documentation, labels)
+
+
+def gauge(name: str, documentation: str, labels: tuple[str, ...] = (),
+          function: Callable[[], float | dict] | None = None) -> Gauge:
+    """
+    Returns the gauge registered under name, creating it if needed.
+    """
+    return REGISTRY.get_or_create(Gauge, name, documentation, labels, function)
+
+
+def histogram(name: str, documentation: str, labels: tuple[str, ...] = (),
+              buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    """
+    Returns the histogram registered under name, creating it if needed.
+    """
+    return REGISTRY.get_or_create(Histogram, name, documentation, labels, buckets)
+
+
+def start_metrics_server(port: int, host: str = '127.0.0.1', registry: Registry = REGISTRY) -> 'ThreadingHTTPServer':
+    """
+    Serves the metrics of the process at http://host:port/metrics from a background thread.
+
+    Args:
+        port (int): The port to listen on.
+        host (str, optional): The interface to listen on. Defaults to localhost only.
+        registry (Registry, optional): The metrics to serve. Defaults to REGISTRY.
+
+    Returns:
+        ThreadingHTTPServer: The running server, stopped with shutdown().
+    """
+    # imported here: most processes never serve their metrics
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as one JSON object per line, with the fields passed to log_event.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'ts': round(record.created, 3), 'level': record.levelname.lower(), 'event': record.getMessage(),
+                 'process': record.process}
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+
+def enable_json_logs(stream=None) -> None:
+    """
+    Writes the events passed to log_event as JSON lines.
+
+    Args:
+        stream (file, optional): The stream to write to. Defaults to sys.stderr.
+    """
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def log_event(event: str, level: int = logging.INFO, **fields) -> None:
+    """
+    Logs a structured event, a no-op unless JSON logs are enabled (see enable_json_logs), at
+    any level.
+
+    Args:
+        event (str): The name of the event, e.g. 'cycle'.
+        level (int, optional): The logging level. Defaults to logging.INFO.
+        **fields: The fields of the event.
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
@@ -0,0 +1,252 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import datagen
+
+# the group endpoint rejects requests for more cities
+MAX_GROUP_IDS = 20
+
+
+def city_id_of(name: str) -> int:
+    """
+    Returns the stable numeric id the mock gives to a city name.
+    """
+    return zlib.crc32(name.lower().encode()) % 10_000_000
+
+
+def weather_payload(name: str, dt: int, owm_id: int | None = None) -> dict:
+    """
+    Builds a payload shaped like the OpenWeatherMap current weather response.
+
+    Values are derived from the city id and the observation time, so they are stable for a given dt.
+    The sky description follows the humidity and temperature as in datagen.
+
+    Args:
+        name (str): The name of the city.
+        dt (int): The time of the observation in epoch seconds.
+        owm_id (int, optional): The id of the city. Defaults to city_id_of(name).
+
+    Returns:
+        dict: The payload.
+    """
+    seed = owm_id if owm_id is not None else city_id_of(name)
+    rng = random.Random(seed * 1_000_003 + dt)
+    temperature = 15 + seed % 20 + 6 * math.sin(2 * math.pi * (dt % 86400) / 86400) + rng.uniform(-0.5, 0.5)
+    humidity = rng.randint(30, 100)
+    return observation_payload(name, {'timestamp': dt, 'temperature': round(temperature, 2), 'humidity': humidity,
+                                      'weather': datagen.sky(humidity, temperature)}, seed)
+
+
+def observation_payload(name: str, weather_data: dict, owm_id: int | None = None) -> dict:
+    """
+    Builds the current weather payload of an observation, the reverse of parse_weather_data.
+
+    Args:
+        name (str): The name of the city.
+        weather_data (dict): The observation, e.g. one generated by datagen.synthetic_rows.
+        owm_id (int, optional): The id of the city. Defaults to city_id_of(name).
+
+    Returns:
+        dict: The payload.
+    """
+    return {
+        'id': owm_id if owm_id is not None else city_id_of(name),
+        'name': name,
+        'dt': weather_data['timestamp'],
+        'main': {'temp': weather_data['temperature'], 'humidity': weather_data['humidity']},
+        'weather': [{'description': weather_data['weather']}],
+    }
+
+
+class MockWeatherAPI:
+    """
+    A local stand-in for the OpenWeatherMap API, injecting latency and faults.
+
+    It serves /data/2.5/weather?q=<city> and /data/2.5/group?id=<id>,<id>... with generated
+    payloads whose `dt` advances every update_interval seconds, or with recorded payloads of
+    the real API, which are served as is. It answers conditional requests (ETag/If-None-Match)
+    with 304, and can be told to add latency, fail a fraction of the requests with 500/503/429,
+    or hang some of them.
+
+    Args:
+        port (int, optional): The port to listen on, 0 for any free port. Defaults to 0.
+        latency (float, optional): The delay added to every response, in seconds. Defaults to 0.
+        error_rate (float, optional): The fraction of requests answered with an error status. Defaults to 0.
+        hang_rate (float, optional): The fraction of requests hanging for hang_seconds. Defaults to 0.
+        hang_seconds (float, optional): How long hanging requests hang, in seconds. Defaults to 30.
+        update_interval (int, optional): The number of seconds between two observations. Defaults to 600.
+        recorded (list[dict], optional): Recorded current weather payloads, served instead of
+            generated ones for their cities. Defaults to None.
+    """
+
+    def __init__(self, port: int = 0, latency: float = 0, error_rate: float = 0, hang_rate: float = 0,
+                 hang_seconds: float = 30, update_interval: int = 600, recorded: list[dict] | None = None) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.update_interval = update_interval
+        self.recorded = {payload['name'].lower(): payload for payload in recorded or []}
+        self.names = {payload['id']: payload['name'] for payload in recorded or []}
+        self.requests = 0
+        self.request_times = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        """
+        The root URL to pass as base_url to the ingestion components.
+        """
+        return f'http://127.0.0.1:{self.server.server_address[1]}/data/2.5'
+
+    def _handler(self) -> type:
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self) -> None:
+                with api.lock:
+                    api.requests += 1
+                    api.request_times.append(time.time())
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                roll = random.random()
+                if roll < api.hang_rate:
+                    time.sleep(api.hang_seconds)
+                elif api.latency:
+                    time.sleep(api.latency)
+                if roll > 1 - api.error_rate:
+                    status = random.choice([500, 503, 429])
+                    self._send(status, {'cod': status, 'message': 'injected fault'}, {'Retry-After': '0'})
+                    return
+                handler = api.routes().get(url.path)
+                if handler is None:
+                    self._send(404, {'cod': 404, 'message': 'not found'})
+                    return
+                status, payload = handler(query)
+                etag = f'"{zlib.crc32(json.dumps(payload, sort_keys=True).encode()):08x}"'
+                if status == 200 and self.headers.get('If-None-Match') == etag:
+                    self._send(304, None, {'ETag': etag})
+                    return
+                self._send(status, payload, {'ETag': etag} if status == 200 else {})
+
+            def _send(self, status: int, payload: dict | None, headers: dict | None = None) -> None:
+                body = json.dumps(payload).encode() if payload is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up on a hanging request
+                    self.close_connection = True
+
+            def log_message(self, *args) -> None:
+                pass
+
+        return Handler
+
+    def current_dt(self) -> int:
+        """
+        Returns the time of the current observation, which advances every update_interval seconds.
+        """
+        now = int(time.time())
+        return now - now % self.update_interval
+
+    def routes(self) -> dict:
+        """
+        Maps the served paths to functions turning a parsed query string into (status, payload).
+        """
+        return {'/data/2.5/weather': self._weather, '/data/2.5/group': self._group}
+
+    def payload(self, name: str, owm_id: int | None = None) -> dict:
+        """
+        Returns the current payload of a city, the recorded one if any.
+        """
+        recorded = self.recorded.get(name.lower())
+        if recorded is not None:
+            return recorded
+        return weather_payload(name, self.current_dt(), owm_id)
+
+    def _weather(self, query: dict) -> tuple[int, dict]:
+        if 'q' not in query:
+            return 400, {'cod': 400, 'message': 'nothing to geocode'}
+        payload = self.payload(query['q'][0])
+        with self.lock:
+            self.names[payload['id']] = payload['name']
+        return 200, payload
+
+    def _group(self, query: dict) -> tuple[int, dict]:
+        try:
+            ids = [int(owm_id) for owm_id in query['id'][0].split(',')]
+        except (KeyError, ValueError):
+            return 400, {'cod': '400', 'message': 'invalid id list'}
+        if len(ids) > MAX_GROUP_IDS:
+            return 400, {'cod': '400', 'message': 'too many ids'}
+        payloads = [self.payload(self.names.get(owm_id, f'City {owm_id}'), owm_id) for owm_id in ids]
+        return 200, {'cnt': len(payloads), 'list': payloads}
+
+    def start(self) -> 'MockWeatherAPI':
+        """
+        Starts serving in a background thread.
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mock-api', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops the server.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> 'MockWeatherAPI':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def main() -> None:
+    """
+    Command line entry point serving the mock API until interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Serve a local mock of the OpenWeatherMap API.")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help="seconds added to every response")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests failing")
+    parser.add_argument('--hang-rate', type=float, default=0, help="fraction of requests hanging")
+    parser.add_argument('--recorded', help="JSON file with a list of recorded payloads, or a recorded group response")
+    args = parser.parse_args()
+
+    recorded = None
+    if args.recorded:
+        with open(args.recorded, encoding='utf-8') as f:
+            recorded = json.load(f)
+        if isinstance(recorded, dict):
+            recorded = recorded['list']
+    api = MockWeatherAPI(args.port, args.latency, args.error_rate, args.hang_rate, recorded=recorded)
+    print(f"Serving {api.base_url}")
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        api.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+
+matplotlib.use('Agg')  # before pyplot is imported by weather_data_analysis: no display is needed
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import schema
+import weather_data_analysis as an
+from ingest import load_cities
+from schema import DB_PATH
+
+# records the data fingerprint of every rendered chart, in the output directory
+MANIFEST = 'manifest.json'
+
+# bumped when the drawing code changes, so that every chart is rendered again
+RENDERER_VERSION = 2
+
+# the figure of the current worker process, created by _init_worker and reused by every chart
+_figure = None
+# whether the worker reduces the lines to one point per pixel with lttb
+_lttb = False
+
+
+def _slug(value: str) -> str:
+    return re.sub(r'[^A-Za-z0-9]+', '-', value).strip('-').lower()
+
+
+def chart_jobs(cities: list[str], ranges: list[tuple[str, str]], formats: list[str],
+               compare_size: int = 0) -> list[dict]:
+    """
+    Lists the charts to render: the temperature trends of each city and, optionally, the mean
+    temperatures of groups of cities side by side, for each range and format.
+
+    Args:
+        cities (list[str]): The cities.
+        ranges (list[tuple[str, str]]): The (starting_date, ending_date) ranges in ISO format.
+        formats (list[str]): The image formats, e.g. ['png', 'svg'].
+        compare_size (int, optional): The number of cities per comparison chart, 0 for none. Defaults to 0.
+
+    Returns:
+        list[dict]: One job per chart, with its kind ('trends' or 'compare'), cities, range and file name.
+    """
+    jobs = []
+    for starting_date, ending_date in ranges:
+        # the tick labels need full timestamps
+        starting_date = schema.from_epoch(schema.to_epoch(starting_date)).isoformat()
+        ending_date = schema.from_epoch(schema.to_epoch(ending_date)).isoformat()
+        period = f'{_slug(starting_date)}_{_slug(ending_date)}'
+        for fmt in formats:
+            for city in cities:
+                jobs.append({'kind': 'trends', 'cities': [city], 'starting_date': starting_date,
+                             'ending_date': ending_date, 'file': f'{_slug(city)}_{period}.{fmt}'})
+            for i in range(0, len(cities) if compare_size else 0, compare_size or 1):
+                jobs.append({'kind': 'compare', 'cities': cities[i:i + compare_size], 'starting_date': starting_date,
+                             'ending_date': ending_date, 'file': f'compare-{i // compare_size + 1:03d}_{period}.{fmt}'})
+    return jobs
+
+
+def data_fingerprint(conn: sqlite3.Connection, cities: list[str], starting_date: str, ending_date: str,
+                     grain: str) -> str:
+    """
+    Returns a digest of the hourly rollups a chart is drawn from, which changes whenever an
+    observation of its cities and buckets is added, removed or modified.
+
+    The first and last buckets of the chart extend past its range, so the hourly rollups are
+    read over the whole buckets of its grain (see bucket_range).
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        cities (list[str]): The cities of the chart.
+        starting_date (str): The start of the range in ISO format.
+        ending_date (str): The end of the range in ISO format.
+        grain (str): The grain the chart is drawn at, 'h', 'D' or 'W'.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    start, end = an.bucket_range(schema.to_epoch(starting_date), schema.to_epoch(ending_date), grain)
+    rows = conn.execute(
+        f"""SELECT city.name, COUNT(*), TOTAL(temp_count), TOTAL(temp_sum), TOTAL(temp_sumsq),
+                   MIN(temp_min), MAX(temp_max), MAX(bucket)
+        FROM rollup_hourly JOIN city USING (city_id)
+        WHERE city.name IN ({', '.join('?' * len(cities))}) AND bucket BETWEEN ? AND ?
+        GROUP BY city_id ORDER BY city.name""",
+        (*cities, start, end)
+        ).fetchall()
+    return hashlib.sha1(repr((RENDERER_VERSION, cities, grain, rows)).encode()).hexdigest()
+
+
+def _init_worker(db_path: str, size: tuple[float, float], dpi: int, lttb: bool) -> None:
+    global _figure, _lttb
+    an.DB_PATH = db_path
+    _lttb = lttb
+    _figure = Figure(figsize=size, dpi=dpi)
+    FigureCanvasAgg(_figure)
+
+
+def render_chart(job: dict, output_dir: str) -> str:
+    """
+    Draws one chart on the figure of the worker and saves it.
+
+    The grain is picked from the range and the pixel width of the figure (see rollup_grain).
+
+    Args:
+        job (dict): The job, see chart_jobs.
+        output_dir (str): The directory to save the chart to.
+
+    Returns:
+        str or None: The path of the saved chart, None if there is no data to draw.
+    """
+    starting_date, ending_date = job['starting_date'], job['ending_date']
+    width = int(_figure.get_figwidth() * _figure.dpi)
+    grain = an.rollup_grain(starting_date, ending_date, width)
+    max_points = width if _lttb else None
+    _figure.clear()
+    ax = _figure.add_subplot()
+    if job['kind'] == 'trends':
+        df = an.fetch_temperature_rollup(job['cities'][0], starting_date, ending_date, grain)
+        if df is None:
+            return None
+        an.plot_temperature_trends(ax, df, grain, starting_date, ending_date, max_points)
+        ax.set_title(f"Temperature Trends in {job['cities'][0]}")
+    else:
+        means = an.mean_temperature_by_city(starting_date, ending_date, job['cities'], grain)
+        if means.empty:
+            return None
+        an.plot_mean_temperature_by_city(ax, means, grain, starting_date, ending_date, max_points)
+        ax.set_title('Mean Temperatures')
+    _figure.tight_layout()
+    path = os.path.join(output_dir, job['file'])
+    # written next to the target and renamed, so that a chart is never seen half-written
+    temporary = f'{path}.{os.getpid()}.tmp{os.path.splitext(path)[1]}'
+    _figure.savefig(temporary)
+    os.replace(temporary, path)
+    return path
+
+
+def _load_manifest(path: str) -> dict:
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save_manifest(path: str, manifest: dict) -> None:
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(f'{path}.tmp', path)
+
+
+def render_reports(jobs: list[dict], output_dir: str, db_path: str = DB_PATH, workers: int | None = None,
+                   size: tuple[float, float] = (10, 5), dpi: int = 100, lttb: bool = False,
+                   force: bool = False) -> dict:
+    """
+    Renders charts in parallel across processes, skipping those whose data has not changed.
+
+    Each worker process draws all its charts on a single Agg figure. The data fingerprint of
+    every chart (see data_fingerprint) is recorded in the manifest of the output directory, and
+    charts whose file exists with an unchanged fingerprint are not rendered again.
+
+    Args:
+        jobs (list[dict]): The charts to render, see chart_jobs.
+        output_dir (str): The directory to save the charts to, created if needed.
+        db_path (str, optional): The path of the SQLite database. Defaults to DB_PATH.
+        workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+        size (tuple[float, float], optional): The size of the figures in inches. Defaults to (10, 5).
+        dpi (int, optional): The resolution of raster images. Defaults to 100.
+        lttb (bool, optional): Whether to reduce every line to one point per pixel with lttb.
+            Defaults to False.
+        force (bool, optional): Whether to render every chart, changed or not. Defaults to False.
+
+    Returns:
+        dict: The numbers of charts rendered, skipped as unchanged and without data, the errors
+            of the other failed charts and the number of seconds taken.
+    """
+    started = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    manifest = _load_manifest(manifest_path)
+    options = (size, dpi, lttb)
+
+    # the pixel width of the figures of the workers, from which render_chart picks the grain
+    width = int(size[0] * dpi)
+    conn = schema.connect(db_path)
+    pending = []
+    for job in jobs:
+        grain = an.rollup_grain(job['starting_date'], job['ending_date'], width)
+        fingerprint = data_fingerprint(conn, job['cities'], job['starting_date'], job['ending_date'], grain)
+        fingerprint = f'{fingerprint}:{options}'
+        if (not force and manifest.get(job['file']) == fingerprint
+                and os.path.exists(os.path.join(output_dir, job['file']))):
+            continue
+        pending.append((job, fingerprint))
+    conn.close()
+
+    result = {'rendered': 0, 'skipped': len(jobs) - len(pending), 'empty': 0, 'errors': {}}
+    if pending:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(db_path, size, dpi, lttb)) as executor:
+            futures = {executor.submit(render_chart, job, output_dir): (job, fingerprint)
+                       for job, fingerprint in pending}
+            for future in as_completed(futures):
+                job, fingerprint = futures[future]
+                try:
+                    path = future.result()
+                except Exception as error:
+                    result['errors'][job['file']] = repr(error)
+                    continue
+                if path is None:
+                    result['empty'] += 1
+                    manifest.pop(job['file'], None)
+                    continue
+                manifest[job['file']] = fingerprint
+                result['rendered'] += 1
+        _save_manifest(manifest_path, manifest)
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def main() -> None:
+    """
+    Command line entry point rendering the charts of a list of cities without a display.
+    """
+    parser = argparse.ArgumentParser(description="Render temperature charts to image files, without a display.")
+    parser.add_argument('--city', action='append', default=[], help="city to chart (repeatable)")
+    parser.add_argument('--cities-file', help="file with one city per line")
+    parser.add_argument('--range', action='append', nargs=2, metavar=('START', 'END'), required=True,
+                        help="ISO start and end of a chart, e.g. 2024-10-01 2024-10-08 (repeatable)")
+    parser.add_argument('--format', nargs='+', default=['png'], choices=['png', 'svg', 'pdf'],
+                        help="image formats (default: png)")
+    parser.add_argument('--compare', type=int, default=0, metavar='N',
+                        help="also chart the mean temperatures of the cities side by side, N per chart")
+    parser.add_argument('--output-dir', default='charts', help="directory of the charts (default: charts)")
+    parser.add_argument('--workers', type=int, help="worker processes (default: number of CPUs)")
+    parser.add_argument('--size', type=float, nargs=2, default=[10, 5], metavar=('WIDTH', 'HEIGHT'),
+                        help="figure size in inches (default: 10 5)")
+    parser.add_argument('--dpi', type=int, default=100, help="resolution of PNG charts (default: 100)")
+    parser.add_argument('--lttb', action='store_true', help="draw at most one point per pixel (LTTB downsampling)")
+    parser.add_argument('--force', action='store_true', help="render the charts whose data has not changed too")
+    parser.add_argument('--db', default=DB_PATH, help=f"path of the database (default: {DB_PATH})")
+    args = parser.parse_args()
+
+    cities = args.city + (load_cities(args.cities_file) if args.cities_file else [])
+    if not cities:
+        conn = schema.connect(args.db)
+        cities = [name for (name,) in conn.execute('SELECT name FROM city ORDER BY name')]
+        conn.close()
+    cities = list(dict.fromkeys(cities))
+    jobs = chart_jobs(cities, [tuple(dates) for dates in args.range], args.format, args.compare)
+    result = render_reports(jobs, args.output_dir, args.db, args.workers, tuple(args.size), args.dpi, args.lttb,
+                            args.force)
+    print(f"{result['rendered']} charts rendered, {result['skipped']} unchanged, {result['empty']} without data "
+          f"in {result['seconds']:.1f}s.")
+    for file, error in result['errors'].items():
+        print(f"{file}: {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+import argparse
+import sqlite3
+import time
+
+import metrics
+import schema
+from db_writer import configure_connection
+from schema import DB_PATH
+
+DAY = 86400
+
+
+def storage_report(conn: sqlite3.Connection) -> dict:
+    """
+    Measures the size of the database and what each stored observation costs.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+
+    Returns:
+        dict: The size in bytes, the bytes held by free pages, the number of observations, the
+            bytes per observation and, where SQLite is built with the dbstat table, the bytes of
+            each table and index.
+    """
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    size = conn.execute('PRAGMA page_count').fetchone()[0] * page_size
+    free = conn.execute('PRAGMA freelist_count').fetchone()[0] * page_size
+    rows = conn.execute('SELECT COUNT(*) FROM observation').fetchone()[0]
+    try:
+        tables = dict(conn.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY name').fetchall())
+    except sqlite3.OperationalError:  # SQLite built without SQLITE_ENABLE_DBSTAT_VTAB
+        tables = {}
+    return {
+        'bytes': size,
+        'free_bytes': free,
+        'observations': rows,
+        'bytes_per_observation': size / rows if rows else None,
+        'tables': tables,
+    }
+
+
+def _in_batches(conn: sqlite3.Connection, sql: str, params: tuple, pause: float) -> int:
+    """
+    Runs a DELETE limited to one batch until it deletes nothing more, one transaction per batch.
+    """
+    deleted = 0
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            count = conn.execute(sql, params).rowcount
+            if count:
+                schema.count_deletion(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        deleted += count
+        if not count:
+            return deleted
+        # lets the writers take the lock between two batches
+        time.sleep(pause)
+
+
+def prune_observations(conn: sqlite3.Connection, before_ts: int, batch_size: int = 10_000,
+                       pause: float = 0.05) -> int:
+    """
+    Deletes the raw observations older than a timestamp, city by city, in small transactions.
+
+    Their temperatures stay in the hourly and daily rollups, which are only updated on insert.
+    Each city is sealed at before_ts first (see schema.seal), so that a deleted observation
+    backfilled or ingested again is skipped instead of being counted twice in the rollups.
+
+    Args:
+        conn (sqlite3.Connection): A connection in autocommit mode (isolation_level=None).
+        before_ts (int): The epoch seconds before which observations are deleted.
+        batch_size (int, optional): The number of observations deleted per transaction. Defaults to 10,000.
+        pause (float, optional): The number of seconds to wait between two transactions. Defaults to 0.05.
+
+    Returns:
+        int: The number of observations deleted.
+    """
+    deleted = 0
+    for (city_id,) in conn.execute('SELECT city_id FROM city ORDER BY city_id').fetchall():
+        if not conn.execute('SELECT 1 FROM observation WHERE city_id = ? AND timestamp < ? LIMIT 1',
+                            (city_id, before_ts)).fetchone():
+            continue
+        schema.seal(conn, city_id, before_ts)
+        deleted += _in_batches(
+            conn,
+            '''DELETE FROM observation WHERE rowid IN (
+                SELECT rowid FROM observation WHERE city_id = ? AND timestamp < ? LIMIT ?
+            )''',
+            (city_id, before_ts, batch_size), pause)
+    return deleted
+
+
+def thin_observations(conn: sqlite3.Connection, after_ts: int, before_ts: int, seconds: int,
+                      batch_size: int = 10_000, pause: float = 0.05) -> int:
+    """
+    Downsamples the raw observations of a time range to the first one of each city per interval.
+
+    Each city is processed in windows of whole intervals holding about batch_size observations,
+    one transaction per window, and gaps without observations are skipped through the
+    (city_id, timestamp) index. Running it again on a thinned range deletes nothing. The rollups
+    keep the statistics of the deleted observations; each city thinned is sealed at before_ts
+    first (see schema.seal), so that they are not inserted and counted again.
+
+    Args:
+        conn (sqlite3.Connection): A connection in autocommit mode (isolation_level=None).
+        after_ts (int): The epoch seconds from which observations are thinned.
+        before_ts (int): The epoch seconds before which observations are thinned; rounded down
+            to a whole interval, so that no interval is thinned partially.
+        seconds (int): The interval, in seconds, keeping one observation, e.g. 600.
+        batch_size (int, optional): The number of observations read per transaction. Defaults to 10,000.
+        pause (float, optional): The number of seconds to wait between two transactions. Defaults to 0.05.
+
+    Returns:
+        int: The number of observations deleted.
+    """
+    before_ts -= before_ts % seconds
+    deleted = 0
+    for (city_id,) in conn.execute('SELECT city_id FROM city ORDER BY city_id').fetchall():
+        oldest, rows = conn.execute(
+            'SELECT MIN(timestamp), COUNT(*) FROM observation WHERE city_id = ? AND timestamp >= ? AND timestamp < ?',
+            (city_id, after_ts, before_ts)
+            ).fetchone()
+        if not rows:
+            continue
+        schema.seal(conn, city_id, before_ts)
+        window = seconds * max(1, round(batch_size * (before_ts - oldest) / rows / seconds))
+        start = after_ts
+        while True:
+            following = conn.execute('SELECT MIN(timestamp) FROM observation WHERE city_id = ? AND timestamp >= ?',
+                                     (city_id, start)).fetchone()[0]
+            if following is None or following >= before_ts:
+                break
+            start = following - following % seconds
+            end = min(start + window, before_ts)
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                count = conn.execute(
+                    '''DELETE FROM observation WHERE city_id = ? AND timestamp >= ? AND timestamp < ?
+                    AND timestamp NOT IN (
+                        SELECT MIN(timestamp) FROM observation WHERE city_id = ? AND timestamp >= ? AND timestamp < ?
+                        GROUP BY timestamp - timestamp % ?
+                    )''',
+                    (city_id, max(start, after_ts), end, city_id, max(start, after_ts), end, seconds)
+                    ).rowcount
+                if count:
+                    schema.count_deletion(conn)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            deleted += count
+            start = end
+            if count:
+                time.sleep(pause)
+    return deleted
+
+
+def incremental_vacuum(conn: sqlite3.Connection, pages_per_step: int = 2048, pause: float = 0.05) -> int | None:
+    """
+    Gives the free pages of the database back to the file system, a few at a time.
+
+    Args:
+        conn (sqlite3.Connection): A connection in autocommit mode (isolation_level=None).
+        pages_per_step (int, optional): The number of pages freed per transaction. Defaults to 2048.
+        pause (float, optional): The number of seconds to wait between two transactions. Defaults to 0.05.
+
+    Returns:
+        int or None: The number of pages freed, None if the database is not in incremental
+            auto-vacuum mode (see enable_incremental_vacuum).
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return None
+    freed = 0
+    while free := conn.execute('PRAGMA freelist_count').fetchone()[0]:
+        # execute() would free a single page, the pragma only runs to completion in a script
+        conn.executescript(f'PRAGMA incremental_vacuum({pages_per_step});')
+        step = free - conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if step <= 0:  # the writers reuse the free pages as fast
+            break
+        freed += step
+        time.sleep(pause)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return freed
+
+
+def enable_incremental_vacuum(conn: sqlite3.Connection) -> bool:
+    """
+    Switches a database created before schema version 5 to incremental auto-vacuum.
+
+    This rebuilds the whole file with VACUUM: it needs as much free disk space as the database
+    and blocks writers while it runs, so it is a one-off, e.g. during a maintenance window.
+
+    Args:
+        conn (sqlite3.Connection): A connection in autocommit mode (isolation_level=None).
+
+    Returns:
+        bool: True if the database was switched, False if it already was.
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return False
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    return True
+
+
+def analyze(conn: sqlite3.Connection) -> None:
+    """
+    Refreshes the statistics of the query planner, sampling large indexes to keep it short.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+    """
+    conn.execute('PRAGMA analysis_limit = 1000')
+    conn.execute('ANALYZE')
+
+
+def apply_retention(db_path: str = DB_PATH, raw_days: float | None = 90, thin_days: float | None = None,
+                    thin_seconds: int = 600, batch_size: int = 10_000, pause: float = 0.05) -> dict:
+    """
+    Applies the retention policy to the database, then vacuums and analyzes it.
+
+    Raw observations older than thin_days are downsampled to one per city every thin_seconds and
+    those older than raw_days are deleted. Charts are unaffected, as they are drawn from the
+    rollups, which keep the statistics of every observation ever inserted. Every deletion runs in
+    short transactions separated by a pause, so ingestion keeps writing meanwhile. Query results
+    already cached by a running process (see cache.py) are not invalidated by deletions.
+
+    Args:
+        db_path (str, optional): The path of the SQLite database. Defaults to DB_PATH.
+        raw_days (float, optional): The age, in days, past which raw observations are deleted,
+            None to keep them. Defaults to 90.
+        thin_days (float, optional): The age, in days, past which raw observations are thinned,
+            None not to thin them. Defaults to None.
+        thin_seconds (int, optional): The interval keeping one observation when thinning. Defaults to 600.
+        batch_size (int, optional): The number of observations deleted per transaction. Defaults to 10,000.
+        pause (float, optional): The number of seconds to wait between two transactions. Defaults to 0.05.
+
+    Returns:
+        dict: The storage reports before and after (see storage_report), the numbers of
+            observations thinned and pruned, of pages vacuumed (None when incremental vacuum
+            is disabled) and the number of seconds taken.
+    """
+    started = time.perf_counter()
+    now = int(time.time())
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    configure_connection(conn)
+    schema.migrate(conn)
+    before = storage_report(conn)
+
+    prune_ts = now - int(raw_days * DAY) if raw_days is not None else None
+    thinned = pruned = 0
+    if thin_days is not None:
+        thinned = thin_observations(conn, prune_ts or 0, now - int(thin_days * DAY), thin_seconds, batch_size, pause)
+    if prune_ts is not None:
+        pruned = prune_observations(conn, prune_ts, batch_size, pause)
+    vacuumed = incremental_vacuum(conn, pause=pause)
+    analyze(conn)
+
+    result = {'before': before, 'after': storage_report(conn), 'thinned': thinned, 'pruned': pruned,
+              'vacuumed_pages': vacuumed, 'seconds': time.perf_counter() - started}
+    conn.close()
+    metrics.log_event('retention', thinned=thinned, pruned=pruned, vacuumed_pages=vacuumed,
+                      bytes=result['after']['bytes'], seconds=round(result['seconds'], 2))
+    return result
+
+
+def _print_report(title: str, report: dict) -> None:
+    per_row = report['bytes_per_observation']
+    print(f"{title}: {report['bytes'] / 2 ** 20:,.1f} MiB ({report['free_bytes'] / 2 ** 20:,.1f} MiB free), "
+          f"{report['observations']:,} observations, "
+          f"{f'{per_row:,.1f}' if per_row is not None else '-'} bytes per observation")
+    for name, size in report['tables'].items():
+        print(f"  {name:<40} {size / 2 ** 20:10,.1f} MiB")
+
+
+def main() -> None:
+    """
+    Command line entry point applying the retention policy, once or periodically.
+    """
+    parser = argparse.ArgumentParser(description="Prune old raw observations, vacuum and analyze the database.")
+    parser.add_argument('--db', default=DB_PATH, help=f"path of the database (default: {DB_PATH})")
+    parser.add_argument('--raw-days', type=float, default=90,
+                        help="delete raw observations older than this many days (default: 90)")
+    parser.add_argument('--keep-raw', action='store_true', help="never delete raw observations")
+    parser.add_argument('--thin-after', type=float, metavar='DAYS',
+                        help="keep one raw observation per city and interval past this many days")
+    parser.add_argument('--thin-to', type=int, default=600, metavar='SECONDS',
+                        help="interval keeping one observation when thinning (default: 600)")
+    parser.add_argument('--batch-size', type=int, default=10_000, help="observations per transaction (default: 10000)")
+    parser.add_argument('--pause', type=float, default=0.05, help="seconds between two transactions (default: 0.05)")
+    parser.add_argument('--interval', type=float, metavar='HOURS', help="run again every HOURS instead of once")
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help="one-off VACUUM switching a database created before schema version 5 to "
+                             "incremental auto-vacuum")
+    parser.add_argument('--report', action='store_true', help="only print the storage report")
+    parser.add_argument('--json-logs', action='store_true', help="log each run as JSON lines on stderr")
+    args = parser.parse_args()
+
+    if args.json_logs:
+        metrics.enable_json_logs()
+    if args.report or args.enable_incremental_vacuum:
+        conn = sqlite3.connect(args.db, isolation_level=None)
+        schema.migrate(conn)
+        if args.enable_incremental_vacuum:
+            switched = enable_incremental_vacuum(conn)
+            print("Switched to incremental auto-vacuum." if switched else "Incremental auto-vacuum already enabled.")
+        _print_report('storage', storage_report(conn))
+        conn.close()
+        return
+
+    while True:
+        result = apply_retention(args.db, None if args.keep_raw else args.raw_days, args.thin_after, args.thin_to,
+                                 args.batch_size, args.pause)
+        _print_report('before', result['before'])
+        _print_report('after', result['after'])
+        vacuumed = result['vacuumed_pages']
+        print(f"{result['thinned']:,} observations thinned, {result['pruned']:,} pruned, "
+              f"{'incremental vacuum disabled' if vacuumed is None else f'{vacuumed:,} pages vacuumed'} "
+              f"in {result['seconds']:.1f}s.")
+        if args.interval is None:
+            return
+        try:
+            time.sleep(args.interval * 3600)
+        except KeyboardInterrupt:
+            return
+
+
+if __name__ == "__main__":
+    main()
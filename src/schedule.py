@@ -1,31 +1,101 @@
-import requests
-import schedule
+import string
 import time
-from datetime import datetime
-import sqlite3
-from dotenv import load_dotenv
+from functools import cache
 import os
+import schema
+from lazy import lazy_import
+from schema import DB_PATH
 
+# only the legacy fetch_weather_data and api_key need them
+requests = lazy_import('requests')
+dotenv = lazy_import('dotenv')
 
-def api_url_constructor(city: str) -> tuple[str, str]:
+API_BASE_URL = 'http://api.openweathermap.org/data/2.5'
+
+# maximum number of city ids accepted by the group endpoint
+GROUP_SIZE = 20
+
+
+@cache
+def api_key() -> str | None:
+    """
+    Returns the API key, loading the .env file on first use only.
+    """
+    dotenv.load_dotenv()
+    return os.environ.get('API_KEY')
+
+
+def api_url_constructor(city: str, base_url: str = API_BASE_URL) -> tuple[str, str]:
     """
     Constructs the API URL for fetching weather data based on the provided city.
 
     Args:
         city (str): The name of the city for which weather data is requested.
+        base_url (str, optional): The root URL of the API, e.g. a local mock. Defaults to API_BASE_URL.
 
     Returns:
         tuple: A tuple containing the constructed API URL and the API key.
             - API_URL (str): The complete URL for querying weather data.
             - API_KEY (str): The API key required for authentication.
     """
-    load_dotenv()
-    API_KEY = os.environ.get('API_KEY') # Task 0 .Replace with your API key
+    API_KEY = api_key() # Task 0 .Replace with your API key
     your_city = city
-    API_URL = f'http://api.openweathermap.org/data/2.5/weather?q={your_city}&appid={API_KEY}&units=metric'
+    API_URL = f'{base_url}/weather?q={your_city}&appid={API_KEY}&units=metric'
     return API_URL, API_KEY
 
 
+def group_url_constructor(owm_ids: list[int], base_url: str = API_BASE_URL) -> str:
+    """
+    Constructs the API URL fetching the current weather of several cities in one request.
+
+    Args:
+        owm_ids (list[int]): The OpenWeatherMap ids of the cities, at most GROUP_SIZE.
+        base_url (str, optional): The root URL of the API, e.g. a local mock. Defaults to API_BASE_URL.
+
+    Returns:
+        str: The URL of the group endpoint.
+    """
+    ids = ','.join(str(owm_id) for owm_id in owm_ids)
+    return f'{base_url}/group?id={ids}&appid={api_key()}&units=metric'
+
+
+def city_name(name: str) -> str:
+    """
+    Normalizes a city name into the name it is stored under.
+
+    Live ingestion names observations after the configured city, backfill after the `name` of
+    the payload; both go through this function, so that 'tokyo,jp' and 'Tokyo' are one city and
+    their observations deduplicated.
+
+    Args:
+        name (str): The name, possibly followed by a country code, e.g. 'new york,us'.
+
+    Returns:
+        str: The name without the country code, capitalized word by word, e.g. 'New York'.
+    """
+    return string.capwords(name.split(',')[0])
+
+
+def parse_weather_data(data: dict, timestamp: int | None = None) -> dict:
+    """
+    Extracts the fields stored in the weather table from an OpenWeatherMap response.
+
+    Args:
+        data (dict): The decoded JSON payload returned by the weather endpoint.
+        timestamp (int, optional): The time of the observation in epoch seconds, e.g. the `dt` of
+            a recorded payload. Defaults to now.
+
+    Returns:
+        dict: A dictionary with the timestamp (epoch seconds), temperature, humidity and weather description.
+    """
+    return {
+        'timestamp': int(time.time()) if timestamp is None else int(timestamp),
+        'temperature': data['main']['temp'],
+        'humidity': data['main']['humidity'],
+        'weather': data['weather'][0]['description'],
+    }
+
+
 def fetch_weather_data(API_URL: str, API_KEY: str, city: str) -> None:
     """
     Fetches weather data from the specified API URL, processes it, and adds it to the database.
@@ -37,21 +107,18 @@ def fetch_weather_data(API_URL: str, API_KEY: str, city: str) -> None:
 
     """
 
-    response = requests.get(API_URL.format(API_KEY))
-    if response.status_code == 200:
+    response = requests.get(API_URL.format(API_KEY), timeout=10)
+    if response.status_code != 200:
+        print(f"{city}: unexpected status {response.status_code}")
+    else:
         data = response.json()
-        weather_data = {
-            'timestamp': datetime.now().isoformat(),
-            'temperature': data['main']['temp'],
-            'humidity': data['main']['humidity'],
-            'weather': data['weather'][0]['description'],
-        }
+        weather_data = parse_weather_data(data, data['dt'])
         print(weather_data)
 
-        conn = sqlite3.connect('openweathermap.db')
+        conn = schema.connect(DB_PATH)
         cursor = conn.cursor()
-        cursor.execute('INSERT INTO weather (city, timestamp, temperature, humidity, weather) VALUES (?, ?, ?, ?, ?)', 
-                   (city, weather_data['timestamp'], weather_data['temperature'], weather_data['humidity'], weather_data['weather']))
+        cursor.execute(schema.INSERT_OBSERVATION_SQL,
+                   (schema.city_id(conn, city), weather_data['timestamp'], weather_data['temperature'], weather_data['humidity'], schema.description_id(conn, weather_data['weather'])))
         conn.commit()
         conn.close()
         print(f"weather data added successfully.")
@@ -60,24 +127,12 @@ def fetch_weather_data(API_URL: str, API_KEY: str, city: str) -> None:
 # Create sqlite table
 def create_table() -> None:
     """
-    Creates an SQLite table to store weather data.
+    Creates the SQLite tables storing weather data, or upgrades them to the current schema.
 
-    The table schema includes columns for city, timestamp, temperature, humidity, and weather.
+    Observations are keyed by city and timestamp, see schema.py for the layout and migrations.
 
     """
-    conn = sqlite3.connect('openweathermap.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS weather (
-        city TEXT, NOT NULL
-        timestamp DATE NOT NULL,
-        temperature REAL,
-        humidity INTEGER,
-        weather TEXT,
-        PRIMARY KEY (timestamp)
-    )
-    ''')
-    conn.commit()
+    conn = schema.connect(DB_PATH)
     conn.close()
 
 
@@ -86,25 +141,27 @@ def main() -> None:
     Main function to set up weather data fetching and scheduling.
 
     1. Creates the weather table in the database.
-    2. Asks the user for the city (Hong Kong/New York/Tokyo).
-    3. Constructs the API URL and retrieves the API key.
-    4. Sets the data fetching interval (default is 1 minute).
-    5. Schedules the weather data fetching job.
-    6. Runs the scheduler indefinitely.
+    2. Asks the user for the cities, separated by commas (e.g. Hong Kong, New York, Tokyo).
+    3. Sets the data fetching interval (default is 1 minute).
+    4. Starts an IngestionEngine fetching every city once per interval, the cities being spread
+       evenly over the interval.
     """
+    from ingest import IngestionEngine
+
     create_table()
-    city = input("Enter the city (Hong Kong/New York/Tokyo): ")
-    API_URL, API_KEY = api_url_constructor(city)
+    cities = input("Enter the cities, separated by commas (e.g. Hong Kong, New York, Tokyo): ")
+    cities = [city.strip() for city in cities.split(',') if city.strip()]
     interval = input("Enter the interval in minutes (default is 1): ")
     interval = int(interval) if interval.isdigit() else 1
 
-    schedule.every(interval).minutes.do(fetch_weather_data(API_URL, API_KEY, city))
-    
-    print(f"Scheduler started. Fetching weather data every {interval} minute(s).")
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    engine = IngestionEngine(cities, interval)
+    try:
+        engine.run_scheduled()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.close()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
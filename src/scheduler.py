@@ -0,0 +1,139 @@
+import hashlib
+import heapq
+import math
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import Callable
+
+import metrics
+
+TICK_LATENESS = metrics.histogram('weather_tick_lateness_seconds', "Delay between scheduled ticks and their run.")
+MISSED_TICKS = metrics.counter('weather_missed_ticks_total', "Scheduled ticks skipped because they ran too late.")
+
+
+def phase_offsets(keys: list[str], interval: float) -> dict[str, float]:
+    """
+    Spreads keys evenly over an interval with deterministic phase offsets.
+
+    Keys are ranked by a hash of their name and the key of rank i gets the offset
+    i * interval / len(keys), so the offsets of a given set of keys never change between runs
+    and the keys are evenly spaced whatever their names.
+
+    Args:
+        keys (list[str]): The keys, e.g. city names.
+        interval (float): The interval in seconds.
+
+    Returns:
+        dict[str, float]: The offset of each key within the interval, in seconds.
+    """
+    ranked = sorted(dict.fromkeys(keys), key=lambda key: hashlib.md5(key.encode()).digest())
+    return {key: i * interval / len(ranked) for i, key in enumerate(ranked)}
+
+
+class TickScheduler:
+    """
+    Runs one job per key at fixed wall-clock ticks, each key at its own phase within the interval.
+
+    The ticks of a key are the instants k * interval + offset in epoch seconds, so they do not
+    drift however long the jobs take and stay aligned across restarts, and the keys fire one
+    after the other rather than all at once (see phase_offsets). A tick running more than
+    `grace` seconds late, e.g. after a stall or a suspended machine, is recorded as missed and
+    skipped; with catch_up the most recent missed tick of each key is run immediately instead.
+
+    Jobs are called with the key and the tick (epoch seconds) from the scheduler thread, so they
+    should hand long work to a thread pool.
+
+    Args:
+        jobs (dict[str, callable]): The job of each key.
+        interval (float): The number of seconds between two ticks of a key.
+        catch_up (bool, optional): Whether to run the last missed tick of a key. Defaults to False.
+        grace (float, optional): The lateness in seconds past which a tick is missed. Defaults to
+            a tenth of the interval.
+        clock (callable, optional): The wall clock. Defaults to time.time.
+    """
+
+    def __init__(self, jobs: dict[str, Callable[[str, int], None]], interval: float, catch_up: bool = False,
+                 grace: float | None = None, clock: Callable[[], float] = time.time) -> None:
+        self.interval = interval
+        self.catch_up = catch_up
+        self.grace = grace if grace is not None else interval / 10
+        self.clock = clock
+        self.missed = Counter()
+        self.missed_ticks = deque(maxlen=10_000)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.generation = 0
+        self.set_jobs(jobs)
+
+    def next_tick(self, offset: float, after: float) -> float:
+        """
+        Returns the first tick of phase offset at or after a given time.
+        """
+        return math.ceil((after - offset) / self.interval) * self.interval + offset
+
+    def set_jobs(self, jobs: dict[str, Callable[[str, int], None]]) -> None:
+        """
+        Replaces the jobs, e.g. when keys are added, recomputing the phase of every key.
+
+        Args:
+            jobs (dict[str, callable]): The job of each key.
+        """
+        offsets = phase_offsets(list(jobs), self.interval) if jobs else {}
+        now = self.clock()
+        with self.lock:
+            self.jobs = dict(jobs)
+            self.heap = [(self.next_tick(offset, now), key) for key, offset in offsets.items()]
+            heapq.heapify(self.heap)
+            self.generation += 1
+        self.wakeup.set()
+
+    def _pop_due(self) -> tuple[float, str, Callable[[str, int], None], int] | float | None:
+        # returns the due (tick, key, job, generation), or the number of seconds to wait (None: no job)
+        with self.lock:
+            if not self.heap:
+                return None
+            tick, key = self.heap[0]
+            wait = tick - self.clock()
+            if wait > 0:
+                return wait
+            heapq.heappop(self.heap)
+            return tick, key, self.jobs[key], self.generation
+
+    def run(self) -> None:
+        """
+        Runs the jobs at their ticks until stop is called.
+        """
+        while not self.stopped.is_set():
+            due = self._pop_due()
+            if not isinstance(due, tuple):
+                self.wakeup.wait(due)
+                self.wakeup.clear()
+                continue
+            tick, key, job, generation = due
+            late = self.clock() - tick
+            TICK_LATENESS.observe(late)
+            if late > self.grace:
+                ticks = [tick + i * self.interval for i in range(int(late // self.interval) + 1)]
+                self.missed[key] += len(ticks)
+                self.missed_ticks.extend((key, int(missed)) for missed in ticks)
+                MISSED_TICKS.inc(len(ticks))
+                metrics.log_event('missed_ticks', key=key, ticks=len(ticks), late=round(late, 3),
+                                  catch_up=self.catch_up)
+                if self.catch_up:
+                    job(key, int(ticks[-1]))
+                tick = ticks[-1]
+            else:
+                job(key, int(tick))
+            with self.lock:
+                # set_jobs has already rescheduled every key if it was called meanwhile
+                if generation == self.generation:
+                    heapq.heappush(self.heap, (tick + self.interval, key))
+
+    def stop(self) -> None:
+        """
+        Stops the scheduler loop.
+        """
+        self.stopped.set()
+        self.wakeup.set()
@@ -0,0 +1,593 @@
+import argparse
+import os
+import sqlite3
+from datetime import datetime, timezone
+from urllib.request import pathname2url
+
+DB_PATH = 'openweathermap.db'
+
+# Name given to the rows of a legacy `weather` table created before the city column existed
+LEGACY_CITY = 'Hong Kong'
+
+
+def to_epoch(value: str | datetime) -> int:
+    """
+    Converts an ISO timestamp or a datetime into integer epoch seconds.
+
+    Naive values are interpreted as UTC, which is how every timestamp is stored.
+
+    Args:
+        value (str or datetime): The timestamp (e.g., '2024-10-01T10:00:00').
+
+    Returns:
+        int: The number of seconds since 1970-01-01T00:00:00 UTC.
+    """
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def from_epoch(value: int) -> datetime:
+    """
+    Converts integer epoch seconds into a naive UTC datetime.
+
+    Args:
+        value (int): The number of seconds since 1970-01-01T00:00:00 UTC.
+
+    Returns:
+        datetime: The corresponding naive datetime.
+    """
+    return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None)
+
+
+def _legacy_epoch(value: str) -> int | None:
+    # naive values are read as local time, offsets are honoured; None for a value that is not a date
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+
+def _migrate_to_1(conn: sqlite3.Connection, legacy_city: str) -> None:
+    """
+    Creates the keyed schema and moves the rows of any legacy table into it.
+
+    Observations are keyed by (city_id, timestamp) with integer epoch timestamps and city names
+    normalized into the city table. Legacy layouts are the `weather` table (with or without a
+    city column) and the per-city `<city>_weather` tables. A `weather` view keeps exposing the
+    old column layout for ad hoc queries.
+
+    The legacy timestamps were written with datetime.now().isoformat(), in the local time of
+    the host recording them, so they are converted to UTC in the local timezone of the host
+    migrating them (the TZ environment variable can set another one).
+    """
+    conn.create_function('legacy_epoch', 1, _legacy_epoch, deterministic=True)
+    legacy_tables = [name for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND (name = 'weather' OR name LIKE '%\\_weather' ESCAPE '\\')"
+    )]
+    conn.execute('''
+    CREATE TABLE city (
+        city_id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE observation (
+        city_id INTEGER NOT NULL REFERENCES city (city_id),
+        timestamp INTEGER NOT NULL,
+        temperature REAL,
+        humidity INTEGER,
+        weather TEXT,
+        UNIQUE (city_id, timestamp)
+    )
+    ''')
+
+    for table in legacy_tables:
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+        if 'city' in columns:
+            city_expr, params = 't.city', ()
+        else:
+            # e.g. new_york_weather holds the rows of New York
+            city = legacy_city if table == 'weather' else table[:-len('_weather')].replace('_', ' ').title()
+            city_expr, params = '?', (city,)
+        conn.execute(f'INSERT OR IGNORE INTO city (name) SELECT DISTINCT {city_expr} FROM "{table}" AS t', params)
+        conn.execute(f'''
+        INSERT OR IGNORE INTO observation (city_id, timestamp, temperature, humidity, weather)
+        SELECT city.city_id, legacy_epoch(t.timestamp), t.temperature, t.humidity, t.weather
+        FROM "{table}" AS t JOIN city ON city.name = {city_expr}
+        WHERE legacy_epoch(t.timestamp) IS NOT NULL
+        ''', params)
+        conn.execute(f'DROP TABLE "{table}"')
+
+    conn.execute('''
+    CREATE VIEW weather AS
+    SELECT city.name AS city,
+           strftime('%Y-%m-%dT%H:%M:%S', observation.timestamp, 'unixepoch') AS timestamp,
+           observation.temperature, observation.humidity, observation.weather
+    FROM observation JOIN city USING (city_id)
+    ''')
+
+
+# Rollup tables keyed by grain, with the width of their buckets in seconds
+ROLLUPS = {'h': ('rollup_hourly', 3600), 'D': ('rollup_daily', 86400)}
+
+
+def _migrate_to_2(conn: sqlite3.Connection, legacy_city: str) -> None:
+    """
+    Adds the hourly and daily temperature rollups and the trigger maintaining them.
+
+    Each rollup row holds the count, sum, min, max and sum of squares of the temperatures of
+    one city over one bucket, which is enough to derive the mean and standard deviation. The
+    trigger fires once per observation actually inserted, so rows ignored as duplicates are
+    not counted twice.
+    """
+    for table, _ in ROLLUPS.values():
+        conn.execute(f'''
+        CREATE TABLE {table} (
+            city_id INTEGER NOT NULL REFERENCES city (city_id),
+            bucket INTEGER NOT NULL,
+            temp_count INTEGER NOT NULL,
+            temp_sum REAL NOT NULL,
+            temp_min REAL NOT NULL,
+            temp_max REAL NOT NULL,
+            temp_sumsq REAL NOT NULL,
+            PRIMARY KEY (city_id, bucket)
+        ) WITHOUT ROWID
+        ''')
+    create_rollup_trigger(conn)
+    rebuild_rollups(conn)
+
+
+def create_rollup_trigger(conn: sqlite3.Connection) -> None:
+    """
+    Creates the trigger folding every inserted observation into the rollups.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+    """
+    updates = []
+    for table, width in ROLLUPS.values():
+        updates.append(f'''
+            INSERT INTO {table} (city_id, bucket, temp_count, temp_sum, temp_min, temp_max, temp_sumsq)
+            VALUES (NEW.city_id, NEW.timestamp - NEW.timestamp % {width}, 1,
+                    NEW.temperature, NEW.temperature, NEW.temperature, NEW.temperature * NEW.temperature)
+            ON CONFLICT (city_id, bucket) DO UPDATE SET
+                temp_count = temp_count + 1,
+                temp_sum = temp_sum + excluded.temp_sum,
+                temp_min = min(temp_min, excluded.temp_min),
+                temp_max = max(temp_max, excluded.temp_max),
+                temp_sumsq = temp_sumsq + excluded.temp_sumsq;''')
+    conn.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS observation_rollup AFTER INSERT ON observation
+    WHEN NEW.temperature IS NOT NULL
+    BEGIN{''.join(updates)}
+    END
+    ''')
+
+
+def drop_rollup_trigger(conn: sqlite3.Connection) -> None:
+    """
+    Drops the rollup trigger, so that bulk loads can insert observations and call
+    rebuild_rollups once instead of updating the rollups row by row. The trigger must be
+    recreated with create_rollup_trigger in the same transaction.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+    """
+    conn.execute('DROP TRIGGER IF EXISTS observation_rollup')
+
+
+def rebuild_rollups(conn: sqlite3.Connection, city_id: int | None = None,
+                    starting_ts: int | None = None, ending_ts: int | None = None) -> None:
+    """
+    Recomputes the rollup buckets overlapping a time range from the raw observations.
+
+    Used to fill the rollups of existing data and after bulk loads bypassing the trigger. Buckets
+    whose raw observations were pruned by retention.py would lose them, so the range should not
+    reach back past the retention cutoff.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        city_id (int, optional): Restricts the rebuild to one city. Defaults to all cities.
+        starting_ts (int, optional): The start of the range in epoch seconds. Defaults to the beginning.
+        ending_ts (int, optional): The end of the range in epoch seconds. Defaults to the end.
+    """
+    for table, width in ROLLUPS.values():
+        conditions, params = [], []
+        if city_id is not None:
+            conditions.append('city_id = ?')
+            params.append(city_id)
+        if starting_ts is not None:
+            conditions.append('{column} >= ?')
+            params.append(starting_ts - starting_ts % width)
+        if ending_ts is not None:
+            conditions.append('{column} < ?')
+            params.append(ending_ts - ending_ts % width + width)
+        where = ' AND '.join(conditions) or '1'
+        conn.execute(f'DELETE FROM {table} WHERE {where.format(column="bucket")}', params)
+        conn.execute(f'''
+        INSERT INTO {table} (city_id, bucket, temp_count, temp_sum, temp_min, temp_max, temp_sumsq)
+        SELECT city_id, timestamp - timestamp % {width}, COUNT(temperature), SUM(temperature),
+               MIN(temperature), MAX(temperature), SUM(temperature * temperature)
+        FROM observation
+        WHERE temperature IS NOT NULL AND {where.format(column="timestamp")}
+        GROUP BY city_id, timestamp - timestamp % {width}
+        ''', params)
+
+
+def merge_into_rollups(conn: sqlite3.Connection, after_rowid: int) -> None:
+    """
+    Folds the observations inserted after a rowid into the rollups, one bucket at a time.
+
+    Used after bulk loads bypassing the trigger: the result is the same as if the trigger had
+    run, but each touched bucket is updated once rather than once per observation, and only the
+    new rows are read.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        after_rowid (int): The largest observation rowid before the load.
+    """
+    for table, width in ROLLUPS.values():
+        conn.execute(f'''
+        INSERT INTO {table} (city_id, bucket, temp_count, temp_sum, temp_min, temp_max, temp_sumsq)
+        SELECT city_id, timestamp - timestamp % {width}, COUNT(temperature), SUM(temperature),
+               MIN(temperature), MAX(temperature), SUM(temperature * temperature)
+        FROM observation
+        WHERE rowid > ? AND temperature IS NOT NULL
+        GROUP BY city_id, timestamp - timestamp % {width}
+        ON CONFLICT (city_id, bucket) DO UPDATE SET
+            temp_count = temp_count + excluded.temp_count,
+            temp_sum = temp_sum + excluded.temp_sum,
+            temp_min = min(temp_min, excluded.temp_min),
+            temp_max = max(temp_max, excluded.temp_max),
+            temp_sumsq = temp_sumsq + excluded.temp_sumsq
+        ''', (after_rowid,))
+
+
+def _migrate_to_3(conn: sqlite3.Connection, legacy_city: str) -> None:
+    """
+    Adds the OpenWeatherMap id of each city, resolved once so that cities can be fetched in groups.
+    """
+    conn.execute('ALTER TABLE city ADD COLUMN owm_id INTEGER')
+
+
+def _migrate_to_4(conn: sqlite3.Connection, legacy_city: str) -> None:
+    """
+    Adds the checkpoints of the backfill tool, committed with the rows they account for.
+    """
+    conn.execute('''
+    CREATE TABLE backfill_checkpoint (
+        source TEXT PRIMARY KEY,
+        offset INTEGER NOT NULL,
+        lines INTEGER NOT NULL,
+        inserted INTEGER NOT NULL
+    )
+    ''')
+
+
+def _migrate_to_5(conn: sqlite3.Connection, legacy_city: str) -> None:
+    """
+    Dictionary-encodes the weather descriptions: the few distinct texts move to a description
+    table and each observation keeps a small integer description_id instead of repeating them.
+
+    The observation table is rebuilt with its rowids, which the query cache uses as a high-water
+    mark. The trigger and the `weather` view are recreated, the view joining the texts back.
+    """
+    conn.execute('''
+    CREATE TABLE description (
+        description_id INTEGER PRIMARY KEY,
+        text TEXT NOT NULL UNIQUE
+    )
+    ''')
+    conn.execute('INSERT INTO description (text) SELECT DISTINCT weather FROM observation WHERE weather IS NOT NULL')
+    conn.execute('DROP VIEW weather')
+    conn.execute('''
+    CREATE TABLE observation_encoded (
+        city_id INTEGER NOT NULL REFERENCES city (city_id),
+        timestamp INTEGER NOT NULL,
+        temperature REAL,
+        humidity INTEGER,
+        description_id INTEGER REFERENCES description (description_id),
+        UNIQUE (city_id, timestamp)
+    )
+    ''')
+    conn.execute('''
+    INSERT INTO observation_encoded (rowid, city_id, timestamp, temperature, humidity, description_id)
+    SELECT observation.rowid, city_id, timestamp, temperature, humidity, description_id
+    FROM observation LEFT JOIN description ON description.text = observation.weather
+    ORDER BY observation.rowid
+    ''')
+    conn.execute('DROP TABLE observation')
+    conn.execute('ALTER TABLE observation_encoded RENAME TO observation')
+    create_rollup_trigger(conn)
+    conn.execute('''
+    CREATE VIEW weather AS
+    SELECT city.name AS city,
+           strftime('%Y-%m-%dT%H:%M:%S', observation.timestamp, 'unixepoch') AS timestamp,
+           observation.temperature, observation.humidity, description.text AS weather
+    FROM observation JOIN city USING (city_id) LEFT JOIN description USING (description_id)
+    ''')
+
+
+def _migrate_to_6(conn: sqlite3.Connection, legacy_city: str) -> None:
+    """
+    Adds the settings of the database, e.g. the location of its Parquet archive, so that every
+    tool opening the database finds them whatever its working directory.
+    """
+    conn.execute('''
+    CREATE TABLE setting (
+        name TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    ) WITHOUT ROWID
+    ''')
+
+
+def _migrate_to_7(conn: sqlite3.Connection, legacy_city: str) -> None:
+    """
+    Adds the time before which the observations of each city are sealed (see seal), and the
+    trigger skipping the inserts below it.
+    """
+    conn.execute('ALTER TABLE city ADD COLUMN sealed_before INTEGER')
+    conn.execute('''
+    CREATE TRIGGER observation_sealed BEFORE INSERT ON observation
+    WHEN NEW.timestamp < (SELECT sealed_before FROM city WHERE city_id = NEW.city_id)
+    BEGIN
+        SELECT RAISE(IGNORE);
+    END
+    ''')
+
+
+MIGRATIONS = [_migrate_to_1, _migrate_to_2, _migrate_to_3, _migrate_to_4, _migrate_to_5, _migrate_to_6,
+              _migrate_to_7]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    """
+    Returns the schema version recorded in the database (0 for a new or legacy database).
+    """
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection, legacy_city: str = LEGACY_CITY) -> int:
+    """
+    Upgrades the database schema in place to SCHEMA_VERSION.
+
+    Each migration runs in its own transaction and bumps PRAGMA user_version, so an interrupted
+    upgrade resumes from the last completed step.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database to upgrade.
+        legacy_city (str, optional): The city of the rows of a legacy `weather` table without a
+            city column. Defaults to LEGACY_CITY.
+
+    Returns:
+        int: The schema version before the upgrade.
+    """
+    initial = schema_version(conn)
+    if initial > SCHEMA_VERSION:
+        raise RuntimeError(f"database schema version {initial} is newer than supported version {SCHEMA_VERSION}")
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        if initial == 0 and not conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0]:
+            # lets retention.py give freed pages back; once in WAL mode a VACUUM is needed to apply it,
+            # instant on an empty database (see retention.py for existing ones)
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            try:
+                conn.execute('VACUUM')
+            except sqlite3.OperationalError:  # another connection is creating the database too
+                pass
+        for version in range(initial, SCHEMA_VERSION):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # another process may have migrated the database meanwhile
+                if schema_version(conn) == version:
+                    MIGRATIONS[version](conn, legacy_city)
+                    conn.execute(f'PRAGMA user_version = {version + 1}')
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+    finally:
+        conn.isolation_level = isolation_level
+    return initial
+
+
+def connect(db_path: str = DB_PATH) -> sqlite3.Connection:
+    """
+    Opens the database and upgrades its schema if needed.
+
+    Args:
+        db_path (str, optional): The path of the SQLite database. Defaults to DB_PATH.
+
+    Returns:
+        sqlite3.Connection: The open connection.
+    """
+    conn = sqlite3.connect(db_path)
+    if schema_version(conn) != SCHEMA_VERSION:
+        migrate(conn)
+    return conn
+
+
+def connect_readonly(db_path: str = DB_PATH, check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    Opens the database read-only, e.g. for the connections of a server answering queries.
+
+    The database must exist and be at the current schema version, since it cannot be upgraded
+    through a read-only connection.
+
+    Args:
+        db_path (str, optional): The path of the SQLite database. Defaults to DB_PATH.
+        check_same_thread (bool, optional): Whether only the opening thread may use the connection,
+            as for sqlite3.connect. Defaults to True.
+
+    Returns:
+        sqlite3.Connection: The open connection.
+
+    Raises:
+        sqlite3.OperationalError: If the database does not exist.
+        RuntimeError: If the database is not at SCHEMA_VERSION.
+    """
+    uri = f'file:{pathname2url(os.path.abspath(db_path))}?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread)
+    version = schema_version(conn)
+    if version != SCHEMA_VERSION:
+        conn.close()
+        raise RuntimeError(f"database schema version {version} is not the current version {SCHEMA_VERSION}, "
+                           f"upgrade it with 'python src/schema.py --db {db_path}'")
+    return conn
+
+
+INSERT_OBSERVATION_SQL = (
+    'INSERT OR IGNORE INTO observation (city_id, timestamp, temperature, humidity, description_id) '
+    'VALUES (?, ?, ?, ?, ?)'
+)
+
+
+def city_id(conn: sqlite3.Connection, name: str) -> int:
+    """
+    Returns the id of a city, adding it to the city table if needed.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        name (str): The name of the city.
+
+    Returns:
+        int: The city_id of the city.
+    """
+    conn.execute('INSERT OR IGNORE INTO city (name) VALUES (?)', (name,))
+    return conn.execute('SELECT city_id FROM city WHERE name = ?', (name,)).fetchone()[0]
+
+
+def description_id(conn: sqlite3.Connection, text: str | None) -> int | None:
+    """
+    Returns the id of a weather description, adding it to the description table if needed.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        text (str or None): The description, e.g. 'light rain'.
+
+    Returns:
+        int or None: The description_id of the description, None for a missing description.
+    """
+    if text is None:
+        return None
+    conn.execute('INSERT OR IGNORE INTO description (text) VALUES (?)', (text,))
+    return conn.execute('SELECT description_id FROM description WHERE text = ?', (text,)).fetchone()[0]
+
+
+def get_setting(conn: sqlite3.Connection, name: str) -> str | None:
+    """
+    Returns a setting of the database.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        name (str): The name of the setting, e.g. 'archive_dir'.
+
+    Returns:
+        str or None: The value of the setting, None if it was never set.
+    """
+    row = conn.execute('SELECT value FROM setting WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+
+def set_setting(conn: sqlite3.Connection, name: str, value: str) -> None:
+    """
+    Records a setting of the database, replacing its previous value.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        name (str): The name of the setting.
+        value (str): Its value.
+    """
+    conn.execute('INSERT OR REPLACE INTO setting (name, value) VALUES (?, ?)', (name, value))
+
+
+def count_deletion(conn: sqlite3.Connection) -> None:
+    """
+    Counts a deletion of observations, in the transaction deleting them.
+
+    Rowids are not AUTOINCREMENT, so once the latest observation is deleted its rowid can be
+    given to the next one inserted; readers tracking the rowid high-water mark (see
+    cache.QueryCache) compare this count instead to notice deletions.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+    """
+    conn.execute('''INSERT INTO setting (name, value) VALUES ('observation_deletions', '1')
+                 ON CONFLICT (name) DO UPDATE SET value = CAST(value AS INTEGER) + 1''')
+
+
+def seal(conn: sqlite3.Connection, city_id: int, before_ts: int) -> None:
+    """
+    Seals the observations of a city before a time: inserts below it are skipped from then on.
+
+    Ranges whose raw observations left the table (archived or pruned) are sealed first, as the
+    UNIQUE constraint no longer guards them: an observation ingested or backfilled again would
+    otherwise be stored twice, and counted twice in the rollups. Seals only move forward.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        city_id (int): The id of the city.
+        before_ts (int): The time, in epoch seconds, before which inserts are skipped.
+    """
+    conn.execute('UPDATE city SET sealed_before = MAX(IFNULL(sealed_before, ?), ?) WHERE city_id = ?',
+                 (before_ts, before_ts, city_id))
+
+
+def owm_ids(conn: sqlite3.Connection, names: list[str]) -> dict[str, int]:
+    """
+    Returns the OpenWeatherMap ids already resolved for some cities.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        names (list[str]): The names of the cities.
+
+    Returns:
+        dict[str, int]: The ids by city name, cities without a resolved id being left out.
+    """
+    if not names:
+        return {}
+    return dict(conn.execute(
+        f'SELECT name, owm_id FROM city WHERE owm_id IS NOT NULL AND name IN ({", ".join("?" * len(names))})',
+        tuple(names)
+        ).fetchall())
+
+
+def set_owm_ids(conn: sqlite3.Connection, ids: dict[str, int]) -> None:
+    """
+    Records the OpenWeatherMap ids of some cities, adding the cities if needed.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        ids (dict[str, int]): The ids by city name.
+    """
+    conn.executemany('INSERT OR IGNORE INTO city (name) VALUES (?)', [(name,) for name in ids])
+    conn.executemany('UPDATE city SET owm_id = ? WHERE name = ?', [(owm_id, name) for name, owm_id in ids.items()])
+
+
+def main() -> None:
+    """
+    Command line entry point upgrading a database to the current schema.
+    """
+    parser = argparse.ArgumentParser(description="Upgrade the weather database to the current schema.")
+    parser.add_argument('--db', default=DB_PATH, help=f"path of the database (default: {DB_PATH})")
+    parser.add_argument('--legacy-city', default=LEGACY_CITY,
+                        help=f"city of the rows of a legacy weather table without a city column (default: {LEGACY_CITY})")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    initial = migrate(conn, args.legacy_city)
+    rows = conn.execute('SELECT COUNT(*) FROM observation').fetchone()[0]
+    conn.close()
+    if initial == SCHEMA_VERSION:
+        print(f"{args.db} is already at schema version {SCHEMA_VERSION}.")
+    else:
+        print(f"{args.db} upgraded from schema version {initial} to {SCHEMA_VERSION} ({rows} observations).")
+
+
+if __name__ == "__main__":
+    main()
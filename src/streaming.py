@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import schema
+from lazy import lazy_import
+from schema import DB_PATH
+
+pd = lazy_import('pandas')
+
+HOUR = 3600
+
+
+class StreamingAggregator:
+    """
+    Keeps sliding-window hourly temperature statistics per city in memory.
+
+    The aggregator is primed once from the hourly rollup, then fed either by a BatchWriter
+    (register on_flush with BatchWriter.add_listener) or by tailing the observations inserted
+    since the last seen rowid. Either way a refresh only costs the new observations, whatever
+    the window size. Only one of the two feeds should be used, otherwise rows are counted twice.
+
+    Args:
+        window_hours (int, optional): The number of hourly buckets kept per city. Defaults to 24.
+        db_path (str, optional): The path of the SQLite database. Defaults to DB_PATH.
+    """
+
+    def __init__(self, window_hours: int = 24, db_path: str = DB_PATH) -> None:
+        self.window_hours = window_hours
+        self.db_path = db_path
+        self.buckets = {}
+        self.city_names = {}
+        self.last_rowid = 0
+        self.lock = threading.Lock()
+
+    def _window_start(self) -> int:
+        now = int(time.time())
+        return now - now % HOUR - (self.window_hours - 1) * HOUR
+
+    def prime(self) -> None:
+        """
+        Loads the current window from the hourly rollup and remembers the last observation rowid.
+        """
+        start = self._window_start()
+        conn = schema.connect(self.db_path)
+        conn.isolation_level = None
+        try:
+            # one read transaction, so that the rowid matches the rollup snapshot
+            conn.execute('BEGIN')
+            rows = conn.execute(
+                '''SELECT city.name, bucket, temp_count, temp_sum, temp_min, temp_max
+                FROM rollup_hourly JOIN city USING (city_id) WHERE bucket >= ?''',
+                (start,)
+                ).fetchall()
+            last_rowid = conn.execute('SELECT IFNULL(MAX(rowid), 0) FROM observation').fetchone()[0]
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        with self.lock:
+            self.buckets = {}
+            for city, bucket, count, total, minimum, maximum in rows:
+                self.buckets.setdefault(city, {})[bucket] = [count, total, minimum, maximum]
+            self.last_rowid = last_rowid
+
+    def add(self, city: str, timestamp: int, temperature: float | None) -> None:
+        """
+        Folds one observation into the hourly bucket of its city.
+
+        Args:
+            city (str): The name of the city.
+            timestamp (int): The time of the observation in epoch seconds.
+            temperature (float or None): The temperature; missing temperatures are ignored.
+        """
+        if temperature is None:
+            return
+        bucket = timestamp - timestamp % HOUR
+        with self.lock:
+            stats = self.buckets.setdefault(city, {}).get(bucket)
+            if stats is None:
+                self.buckets[city][bucket] = [1, temperature, temperature, temperature]
+            else:
+                stats[0] += 1
+                stats[1] += temperature
+                stats[2] = min(stats[2], temperature)
+                stats[3] = max(stats[3], temperature)
+
+    def on_flush(self, records: list[tuple]) -> None:
+        """
+        BatchWriter listener folding the rows of a flushed batch into the aggregator.
+
+        Args:
+            records (list[tuple]): The (city, timestamp, temperature, humidity, weather) rows inserted
+                by the flush, as passed by BatchWriter.
+        """
+        for city, timestamp, temperature, *_ in records:
+            self.add(city, timestamp, temperature)
+
+    def tail(self) -> int:
+        """
+        Folds the observations inserted since the last seen rowid into the aggregator.
+
+        Returns:
+            int: The number of new observations.
+        """
+        conn = schema.connect(self.db_path)
+        try:
+            rows = conn.execute(
+                '''SELECT observation.rowid, city_id, timestamp, temperature FROM observation
+                WHERE observation.rowid > ? ORDER BY observation.rowid''',
+                (self.last_rowid,)
+                ).fetchall()
+            unknown = {row[1] for row in rows} - self.city_names.keys()
+            if unknown:
+                self.city_names.update(conn.execute(
+                    f'SELECT city_id, name FROM city WHERE city_id IN ({", ".join("?" * len(unknown))})',
+                    tuple(unknown)
+                    ).fetchall())
+        finally:
+            conn.close()
+        start = self._window_start()
+        for _, city_id, timestamp, temperature in rows:
+            if timestamp >= start:
+                self.add(self.city_names[city_id], timestamp, temperature)
+        if rows:
+            self.last_rowid = rows[-1][0]
+        return len(rows)
+
+    def snapshot(self, city: str) -> pd.DataFrame:
+        """
+        Returns the hourly statistics of a city over the window, dropping expired buckets.
+
+        Args:
+            city (str): The name of the city.
+
+        Returns:
+            pd.DataFrame: A DataFrame indexed by hour with count, mean, min and max columns, laid
+                out like fetch_temperature_rollup, empty hours being NaN.
+        """
+        start = self._window_start()
+        with self.lock:
+            for buckets in self.buckets.values():
+                for bucket in [bucket for bucket in buckets if bucket < start]:
+                    del buckets[bucket]
+            items = sorted(self.buckets.get(city, {}).items())
+        df = pd.DataFrame([(bucket, count, total / count, minimum, maximum)
+                           for bucket, (count, total, minimum, maximum) in items],
+                          columns=['bucket', 'count', 'mean', 'min', 'max'])
+        index = pd.date_range(pd.to_datetime(start, unit='s'), periods=self.window_hours, freq='h', name='date')
+        df.index = pd.to_datetime(df['bucket'], unit='s').rename('date')
+        return df[['count', 'mean', 'min', 'max']].reindex(index)
@@ -0,0 +1,387 @@
+import argparse
+import bisect
+import hashlib
+import logging
+import multiprocessing as mp
+import os
+import queue
+import signal
+import sys
+import time
+
+import metrics
+import schema
+from db_writer import BatchWriter
+from ingest import GroupIngestionEngine, IngestionEngine, load_cities
+from schedule import API_BASE_URL, GROUP_SIZE
+from schema import DB_PATH
+
+QUEUE_DEPTH = metrics.gauge('weather_writer_queue_depth', "Batches waiting in the queue of the writer process.")
+RESTARTS = metrics.counter('weather_process_restarts_total', "Crashed ingestion processes restarted.", ('process',))
+SHARD_CYCLE_SECONDS = metrics.histogram('weather_shard_cycle_seconds', "Duration of the cycles of each worker process.")
+
+
+class HashRing:
+    """
+    A consistent hash ring mapping keys (city names) to nodes (worker indexes).
+
+    Each node is placed at `replicas` points of the ring and a key belongs to the first node
+    point following its hash, so changing the number of nodes only moves about 1/n of the keys.
+
+    Args:
+        nodes (list): The nodes of the ring.
+        replicas (int, optional): The number of points per node. Defaults to 64.
+    """
+
+    def __init__(self, nodes: list, replicas: int = 64) -> None:
+        self.points = sorted((self._hash(f'{node}#{i}'), node) for node in nodes for i in range(replicas))
+        self.hashes = [point for point, _ in self.points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def node_for(self, key: str):
+        """
+        Returns the node owning a key.
+        """
+        i = bisect.bisect(self.hashes, self._hash(key)) % len(self.points)
+        return self.points[i][1]
+
+
+def shard_cities(cities: list[str], n_shards: int) -> list[list[str]]:
+    """
+    Splits a city list into n_shards shards by consistent hashing.
+
+    Args:
+        cities (list[str]): The names of the cities.
+        n_shards (int): The number of shards.
+
+    Returns:
+        list[list[str]]: The cities of each shard, in input order.
+    """
+    ring = HashRing(list(range(n_shards)))
+    shards = [[] for _ in range(n_shards)]
+    for city in dict.fromkeys(cities):
+        shards[ring.node_for(city)].append(city)
+    return shards
+
+
+class QueueWriter:
+    """
+    Stands in for the BatchWriter of an engine running in a worker process, shipping its rows
+    and resolved city ids to the writer process over a queue.
+
+    Args:
+        rows_queue (multiprocessing.Queue): The queue read by the writer process.
+        db_path (str): The path of the SQLite database, read for the already resolved city ids.
+    """
+
+    def __init__(self, rows_queue: mp.Queue, db_path: str) -> None:
+        self.rows_queue = rows_queue
+        self.db_path = db_path
+
+    def write_many(self, rows: list[tuple[str, dict]]) -> None:
+        """
+        Ships a list of (city, weather_data) pairs to the writer process.
+        """
+        if rows:
+            self.rows_queue.put(('rows', rows))
+
+    def owm_ids(self, cities: list[str]) -> dict[str, int]:
+        """
+        Returns the OpenWeatherMap ids already recorded for some cities.
+        """
+        conn = schema.connect(self.db_path)
+        try:
+            return schema.owm_ids(conn, cities)
+        finally:
+            conn.close()
+
+    def set_owm_ids(self, ids: dict[str, int]) -> None:
+        """
+        Ships resolved OpenWeatherMap ids to the writer process.
+        """
+        self.rows_queue.put(('owm_ids', ids))
+
+
+def _setup_telemetry(metrics_port: int, json_logs: bool) -> None:
+    if metrics_port:
+        metrics.start_metrics_server(metrics_port)
+    if json_logs:
+        metrics.enable_json_logs()
+
+
+def _store(writer: BatchWriter, message: tuple[str, object]) -> int:
+    kind, payload = message
+    if kind == 'rows':
+        writer.write_many(payload)
+        return len(payload)
+    writer.set_owm_ids(payload)
+    return 0
+
+
+def _run_writer(rows_queue: mp.Queue, db_path: str, batch_size: int, metrics_port: int, json_logs: bool) -> None:
+    # the supervisor handles Ctrl+C and sends the stop sentinel (None)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _setup_telemetry(metrics_port, json_logs)
+    writer = BatchWriter(db_path, batch_size)
+    try:
+        while (message := rows_queue.get()) is not None:
+            _store(writer, message)
+    finally:
+        try:
+            writer.close()
+        finally:
+            # a failed flush keeps its rows buffered, they are lost with the process
+            if writer.buffer:
+                print(f"writer failed with {len(writer.buffer)} observations buffered, dropping them.")
+                metrics.log_event('rows_dropped', level=logging.ERROR, rows=len(writer.buffer))
+
+
+def _run_worker(index: int, cities: list[str], rows_queue: mp.Queue, events: mp.Queue, stopping: mp.Event,
+                db_path: str, interval: float, first_cycle: int, cycles: int | None, engine_options: dict,
+                metrics_port: int, json_logs: bool) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _setup_telemetry(metrics_port, json_logs)
+    writer = QueueWriter(rows_queue, db_path)
+    group_size = engine_options.pop('group_size', 0)
+    if group_size:
+        engine = GroupIngestionEngine(cities, group_size, interval=interval, writer=writer, **engine_options)
+    else:
+        engine = IngestionEngine(cities, interval, writer=writer, **engine_options)
+    try:
+        cycle = first_cycle
+        next_run = time.monotonic()
+        # the cycle under way when the supervisor stops is completed and its rows queued
+        while (cycles is None or cycle < cycles) and not stopping.is_set():
+            started = time.monotonic()
+            stored = engine.run_cycle()
+            seconds = time.monotonic() - started
+            events.put((index, cycle, seconds, stored))
+            metrics.log_event('cycle', worker=index, cycle=cycle, cities=len(cities), stored=stored,
+                              seconds=round(seconds, 3))
+            cycle += 1
+            next_run += interval * 60
+            if cycles is None or cycle < cycles:
+                stopping.wait(max(0.0, next_run - time.monotonic()))
+    finally:
+        engine.close()
+
+
+class Supervisor:
+    """
+    Runs the ingestion across several worker processes feeding one writer process.
+
+    The cities are sharded across the workers by consistent hashing. Each worker runs its own
+    IngestionEngine (or GroupIngestionEngine when group_size is set), so JSON decoding and row
+    building are spread over the cores instead of contending for one GIL. The parsed rows are
+    shipped over a queue to a single process owning the BatchWriter, which keeps SQLite
+    writes serialized. Workers or writer exiting with an error are restarted after
+    restart_delay seconds, with the same shard; rows already queued are kept. On stop, the
+    workers finish their current cycle and exit on their own, so that none is killed while
+    writing to the queue.
+
+    Args:
+        cities (list[str]): The names of the cities to track.
+        workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+        interval (float, optional): The number of minutes between two cycles. Defaults to 1.
+        db_path (str, optional): The path of the SQLite database. Defaults to DB_PATH.
+        batch_size (int, optional): The batch size of the writer. Defaults to 500.
+        restart_delay (float, optional): The number of seconds before restarting a crashed
+            process. Defaults to 1.
+        metrics_port (int, optional): The port serving the metrics of the supervisor, 0 to disable.
+            The writer uses the next port and worker i the port metrics_port + 2 + i. Defaults to 0.
+        json_logs (bool, optional): Whether every process logs its events as JSON lines. Defaults to False.
+        stop_timeout (float, optional): The number of seconds stop waits for the workers to exit
+            before terminating them. Defaults to 30.
+        **engine_options: Options of the engines (max_workers, rate_limit, timeout, base_url,
+            group_size). rate_limit is the total, split evenly across the workers.
+    """
+
+    def __init__(self, cities: list[str], workers: int | None = None, interval: float = 1, db_path: str = DB_PATH,
+                 batch_size: int = 500, restart_delay: float = 1, metrics_port: int = 0, json_logs: bool = False,
+                 stop_timeout: float = 30, **engine_options) -> None:
+        n_workers = workers or os.cpu_count() or 1
+        self.shards = [shard for shard in shard_cities(cities, n_workers) if shard]
+        self.interval = interval
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.restart_delay = restart_delay
+        self.metrics_port = metrics_port
+        self.json_logs = json_logs
+        self.stop_timeout = stop_timeout
+        self.engine_options = dict(engine_options)
+        if self.engine_options.get('rate_limit'):
+            self.engine_options['rate_limit'] /= len(self.shards)
+        self.context = mp.get_context('spawn')
+        self.rows_queue = self.context.Queue()
+        self.events = self.context.Queue()
+        self.stopping = self.context.Event()
+        self.workers = []
+        self.writer = None
+        self.restarts = 0
+        self.cycle_stats = {}
+
+    def _start_writer(self) -> None:
+        port = self.metrics_port + 1 if self.metrics_port else 0
+        self.writer = self.context.Process(target=_run_writer, name='ingest-writer',
+                                           args=(self.rows_queue, self.db_path, self.batch_size, port, self.json_logs))
+        self.writer.start()
+
+    def _start_worker(self, index: int, cycles: int | None) -> mp.Process:
+        # a restarted worker carries on with the cycle following the last one it reported
+        first_cycle = max((cycle + 1 for cycle, stats in self.cycle_stats.items() if index in stats), default=0)
+        port = self.metrics_port + 2 + index if self.metrics_port else 0
+        process = self.context.Process(
+            target=_run_worker, name=f'ingest-worker-{index}',
+            args=(index, self.shards[index], self.rows_queue, self.events, self.stopping, self.db_path, self.interval,
+                  first_cycle, cycles, dict(self.engine_options), port, self.json_logs)
+            )
+        process.start()
+        return process
+
+    def _collect_events(self) -> None:
+        while True:
+            try:
+                index, cycle, seconds, stored = self.events.get_nowait()
+            except queue.Empty:
+                return
+            SHARD_CYCLE_SECONDS.observe(seconds)
+            stats = self.cycle_stats.setdefault(cycle, {})
+            stats[index] = (seconds, stored)
+            if len(stats) == len(self.shards):
+                print(f"cycle {cycle}: {sum(s for _, s in stats.values())} new observations, "
+                      f"slowest shard {max(s for s, _ in stats.values()):.2f}s.")
+
+    def run(self, cycles: int | None = None) -> None:
+        """
+        Starts the processes and supervises them until interrupted, or until every worker has
+        run the given number of cycles.
+
+        Args:
+            cycles (int, optional): The number of cycles each worker runs. Defaults to running forever.
+        """
+        schema.connect(self.db_path).close()
+        _setup_telemetry(self.metrics_port, self.json_logs)
+        print(f"Ingestion started for {sum(map(len, self.shards))} cities in {len(self.shards)} processes.")
+        self.stopping.clear()
+        self._start_writer()
+        self.workers = [self._start_worker(index, cycles) for index in range(len(self.shards))]
+        crashed = {}
+        try:
+            while True:
+                self._collect_events()
+                try:
+                    QUEUE_DEPTH.set(self.rows_queue.qsize())
+                except NotImplementedError:  # macOS
+                    pass
+                now = time.monotonic()
+                for index, process in enumerate(self.workers):
+                    if process.exitcode not in (None, 0) and index not in crashed:
+                        print(f"{process.name} exited with code {process.exitcode}, restarting.")
+                        crashed[index] = now
+                    if index in crashed and now - crashed[index] >= self.restart_delay:
+                        del crashed[index]
+                        self.restarts += 1
+                        RESTARTS.inc(process='worker')
+                        self.workers[index] = self._start_worker(index, cycles)
+                if self.writer.exitcode is not None:
+                    print(f"writer exited with code {self.writer.exitcode}, restarting.")
+                    self.restarts += 1
+                    RESTARTS.inc(process='writer')
+                    time.sleep(self.restart_delay)
+                    self._start_writer()
+                if cycles is not None and all(process.exitcode == 0 for process in self.workers):
+                    break
+                time.sleep(0.1)
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        """
+        Stops the workers, then lets the writer store the queued rows and exit.
+
+        The workers are asked to exit after their current cycle; those still running after
+        stop_timeout seconds are terminated. If the writer is dead, or dies while storing the
+        queued rows, the supervisor stores what is left in the queue itself.
+        """
+        self.stopping.set()
+        deadline = time.monotonic() + self.stop_timeout
+        for process in self.workers:
+            process.join(max(0.0, deadline - time.monotonic()))
+        for process in self.workers:
+            if process.is_alive():
+                print(f"{process.name} did not stop within {self.stop_timeout}s, terminating it.")
+                process.terminate()
+                process.join()
+        self._collect_events()
+        if self.writer is None:
+            return
+        if self.writer.is_alive():
+            self.rows_queue.put(None)
+            self.writer.join()
+        if self.writer.exitcode != 0:
+            self._drain()
+
+    def _drain(self) -> None:
+        # the writer died: the rows still queued are stored from here instead of being lost
+        stored = 0
+        with BatchWriter(self.db_path, self.batch_size) as writer:
+            while True:
+                try:
+                    message = self.rows_queue.get(timeout=0.1)
+                except queue.Empty:
+                    break
+                if message is not None:
+                    stored += _store(writer, message)
+        print(f"writer exited with code {self.writer.exitcode}, {stored} queued observations stored on stop.")
+        metrics.log_event('writer_drained', level=logging.WARNING, exitcode=self.writer.exitcode, rows=stored)
+
+
+def main() -> None:
+    """
+    Command line entry point of the multi-process ingestion.
+    """
+    parser = argparse.ArgumentParser(description="Fetch weather data for many cities across several processes.")
+    parser.add_argument('--city', action='append', default=[], help="city to track (repeatable)")
+    parser.add_argument('--cities-file', help="file with one city per line")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument('--interval', type=float, default=1, help="minutes between cycles (default: 1)")
+    parser.add_argument('--workers', type=int, default=64,
+                        help="maximum concurrent requests per process (default: 64)")
+    parser.add_argument('--rate-limit', type=float, default=50,
+                        help="maximum requests per second in total, 0 for unlimited (default: 50)")
+    parser.add_argument('--timeout', type=float, default=10, help="timeout of a request in seconds (default: 10)")
+    parser.add_argument('--base-url', default=API_BASE_URL, help=f"root URL of the API (default: {API_BASE_URL})")
+    parser.add_argument('--group-size', type=int, default=0,
+                        help=f"fetch up to this many cities per request (at most {GROUP_SIZE}), 0 to fetch cities "
+                        "one by one (default: 0)")
+    parser.add_argument('--db', default=DB_PATH, help=f"path of the database (default: {DB_PATH})")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="serve Prometheus metrics of the supervisor on this port, of the writer on the next "
+                        "one and of the workers on the following ones; 0 to disable (default: 0)")
+    parser.add_argument('--json-logs', action='store_true', help="log cycles, flushes and failures as JSON lines")
+    args = parser.parse_args()
+
+    cities = list(args.city)
+    if args.cities_file:
+        cities += load_cities(args.cities_file)
+    if not cities:
+        parser.error("no city given, use --city or --cities-file")
+
+    supervisor = Supervisor(cities, args.processes, args.interval, args.db, metrics_port=args.metrics_port,
+                            json_logs=args.json_logs, max_workers=args.workers,
+                            rate_limit=args.rate_limit, timeout=args.timeout, base_url=args.base_url,
+                            group_size=min(args.group_size, GROUP_SIZE))
+    # stop cleanly, storing the queued rows, when terminated as a service
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
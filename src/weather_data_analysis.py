@@ -1,11 +1,131 @@
+from __future__ import annotations
 import sqlite3
-import pandas as pd
-import matplotlib.pyplot as plt
-from datetime import datetime
-import re
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from functools import partial
+import archive
+import metrics
+import schema
+from cache import QueryCache
+from db_pool import ReadOnlyPool
+from lazy import lazy_import
+from schema import DB_PATH
+from streaming import StreamingAggregator
+
+# imported on first use, so that importing this module (e.g. to build the GUI) stays fast
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+plt = lazy_import('matplotlib.pyplot')
+
+
+# Columns that can be projected, with the numpy type used to receive them from SQLite
+WEATHER_COLUMNS = {'temperature': 'f4', 'humidity': 'f4', 'weather': 'O'}
+# The SQL expression reading each column, weather descriptions being dictionary-encoded since schema version 5
+COLUMN_SQL = {'temperature': 'temperature', 'humidity': 'humidity', 'weather': 'description.text'}
+
+CHUNK_SIZE = 65536
+
+# results of fetch_data_from_db, fetch_temperature_rollups and mean_temperature_by_city
+query_cache = QueryCache()
+
+QUERY_SECONDS = metrics.histogram('weather_query_seconds', "Duration of the queries run on a cache miss.", ('query',))
+RESAMPLE_SECONDS = metrics.histogram('weather_resample_seconds', "Duration of pivots and resamplings.",
+                                     ('operation',))
+metrics.gauge('weather_query_cache', "Counters and size of the query cache.", ('stat',),
+              lambda: {(stat,): value for stat, value in query_cache.stats().items()})
+
+# grains of the temperature statistics: (rollup table read, bucket width in seconds, pandas frequency); weeks
+# are merged from the daily rollup and start on Mondays, like the 'W-MON' frequency
+GRAINS = {'h': ('rollup_hourly', 3600, 'h'), 'D': ('rollup_daily', 86400, 'D'), 'W': ('rollup_daily', 604800, 'W-MON')}
+
+# epoch seconds of a Monday, the origin of the weekly buckets
+_WEEK_ORIGIN = 4 * 86400
+
+# hourly statistics of the last LIVE_WINDOW_HOURS, created on first use by live_temperature_trends
+LIVE_WINDOW_HOURS = 24
+live_aggregator = None
+
+
+@contextmanager
+def _connect(pool: ReadOnlyPool | None = None) -> Iterator[sqlite3.Connection]:
+    """
+    Lends a connection of the pool, or opens a connection to DB_PATH for the with block.
+    """
+    if pool is not None:
+        with pool.connection() as conn:
+            yield conn
+        return
+    conn = schema.connect(DB_PATH)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def _db_path(pool: ReadOnlyPool | None) -> str:
+    return pool.db_path if pool is not None else DB_PATH
+
 
+def _fetch_arrays(city: str, starting_date: str, ending_date: str, columns: tuple[str, ...],
+                  chunksize: int, pool: ReadOnlyPool | None) -> Iterator[np.ndarray]:
+    """
+    Yields the observations of a city as structured numpy arrays of at most chunksize rows.
+
+    Archived observations (see archive.py), read from the archive recorded in the database, come
+    first, then the rows still in SQLite. Each SQLite chunk is converted straight from the cursor
+    into a typed structured array, so at most one chunk of Python row tuples is alive at any time.
+    """
+    dtype = np.dtype([('timestamp', 'i8')] + [(column, WEATHER_COLUMNS[column]) for column in columns])
+    starting_ts, ending_ts = schema.to_epoch(starting_date), schema.to_epoch(ending_date)
+    with _connect(pool) as conn:
+        archive_dir = archive.archive_location(conn)
+        if archive_dir is not None:
+            yield from archive.read_archive(archive_dir, city, starting_ts, ending_ts, dtype, chunksize)
+
+        # filter on city_id so that the (city_id, timestamp) index serves the range scan
+        cursor = conn.execute(
+            f"""SELECT timestamp{''.join(', ' + COLUMN_SQL[column] for column in columns)}
+            FROM observation LEFT JOIN description USING (description_id)
+            WHERE city_id = (SELECT city_id FROM city WHERE name = ?) AND timestamp BETWEEN ? AND ?
+            ORDER BY timestamp""",
+            (city, starting_ts, ending_ts)
+            )
+        while chunk := cursor.fetchmany(chunksize):
+            yield np.array(chunk, dtype=dtype)
+
+
+def _typed_frame(city: str, data: np.ndarray, columns: tuple[str, ...], with_city: bool) -> pd.DataFrame:
+    """
+    Builds a DataFrame indexed by datetime64 timestamps from a structured array.
 
-def fetch_data_from_db(city: str, starting_date: str, ending_date: str) -> pd.DataFrame | None:
+    Temperatures are float32, humidities int8 (nullable Int8 if some are missing) and weather
+    descriptions and city names categorical.
+    """
+    frame = {}
+    if with_city:
+        frame['city'] = pd.Categorical.from_codes(np.zeros(len(data), dtype='i1'), categories=[city])
+    for column in columns:
+        values = data[column]
+        if column == 'humidity':
+            values = values.astype('i1') if not np.isnan(values).any() else pd.array(values, dtype='Int8')
+        elif column == 'weather':
+            values = pd.Categorical(values)
+        frame[column] = values
+    index = pd.DatetimeIndex(data['timestamp'].astype('datetime64[s]'), name='timestamp')
+    return pd.DataFrame(frame, index=index)
+
+
+def _projection(columns: Iterable[str] | None) -> tuple[tuple[str, ...], bool]:
+    if columns is None:
+        return tuple(WEATHER_COLUMNS), True
+    unknown = set(columns) - set(WEATHER_COLUMNS) - {'city'}
+    if unknown:
+        raise ValueError(f"unknown column(s): {', '.join(sorted(unknown))}")
+    return tuple(column for column in WEATHER_COLUMNS if column in columns), 'city' in columns
+
+
+def fetch_data_from_db(city: str, starting_date: str, ending_date: str, columns: Iterable[str] | None = None,
+                       pool: ReadOnlyPool | None = None) -> pd.DataFrame | None:
     """
     Fetches weather data from the SQLite database for further analysis.
 
@@ -13,27 +133,259 @@ def fetch_data_from_db(city: str, starting_date: str, ending_date: str) -> pd.Da
         city (str): The name of the city for which weather data is requested.
         starting_date (str): The start date (in ISO format, e.g., '2024-10-01') for the data retrieval.
         ending_date (str): The end date (in ISO format, e.g., '2024-10-07') for the data retrieval.
+        columns (Iterable[str], optional): The columns to load among city, temperature, humidity
+            and weather. Defaults to all of them.
+        pool (ReadOnlyPool, optional): The read-only connections to query, e.g. those of a server.
+            Defaults to opening a connection to DB_PATH.
 
     Returns:
-        pd.DataFrame or None: A DataFrame containing weather data columns (city, timestamp, temperature, humidity, weather).
+        pd.DataFrame or None: A DataFrame indexed by timestamp (datetime64) with the requested columns:
+            city (categorical), temperature (float32), humidity (int8) and weather (categorical).
             If no data is found for the specified city and date range, returns None.
     """
-    conn = sqlite3.connect('openweathermap.db')
-    cursor = conn.cursor()
-    cursor.execute(
-        f"SELECT * FROM weather WHERE city = ? and timestamp BETWEEN ? AND ?", (city, starting_date, ending_date)
-        )
-    rows = cursor.fetchall()
-    conn.commit()
-    conn.close()
-
-    if rows:
-        df = pd.DataFrame(rows)
-        df.columns = ['city', 'timestamp', 'temperature', 'humidity', 'weather']
-    
-        return df
+    columns, with_city = _projection(columns)
+
+    def compute() -> pd.DataFrame | None:
+        with QUERY_SECONDS.time(query='observations'):
+            chunks = list(_fetch_arrays(city, starting_date, ending_date, columns, CHUNK_SIZE, pool))
+        if not chunks:
+            return None
+        data = np.concatenate(chunks)
+        # rows loaded into SQLite after their day was archived, before archived days were sealed, may
+        # interleave with or repeat archived ones, which come first and are kept
+        if (np.diff(data['timestamp']) <= 0).any():
+            data = data[np.argsort(data['timestamp'], kind='stable')]
+            data = data[np.concatenate(([True], np.diff(data['timestamp']) != 0))]
+        return _typed_frame(city, data, columns, with_city)
+
+    starting_ts, ending_ts = schema.to_epoch(starting_date), schema.to_epoch(ending_date)
+    key = ('observations', city, starting_ts, ending_ts, columns, with_city)
+    return query_cache.get_or_compute(key, _db_path(pool), [city], starting_ts, ending_ts, compute,
+                                      partial(_connect, pool))
+
+
+def iter_data_from_db(city: str, starting_date: str, ending_date: str, columns: Iterable[str] | None = None,
+                      chunksize: int = CHUNK_SIZE, pool: ReadOnlyPool | None = None) -> Iterator[pd.DataFrame]:
+    """
+    Iterates over the weather data of a large range in chunks of bounded size.
+
+    Args:
+        city (str): The name of the city for which weather data is requested.
+        starting_date (str): The start date (in ISO format, e.g., '2024-10-01') for the data retrieval.
+        ending_date (str): The end date (in ISO format, e.g., '2024-10-07') for the data retrieval.
+        columns (Iterable[str], optional): The columns to load, as for fetch_data_from_db.
+        chunksize (int, optional): The maximum number of rows per chunk. Defaults to CHUNK_SIZE.
+        pool (ReadOnlyPool, optional): The read-only connections to query, e.g. those of a server.
+            Defaults to opening a connection to DB_PATH.
+
+    Yields:
+        pd.DataFrame: DataFrames typed as the result of fetch_data_from_db, archived rows first,
+            each tier in timestamp order.
+    """
+    columns, with_city = _projection(columns)
+    for chunk in _fetch_arrays(city, starting_date, ending_date, columns, chunksize, pool):
+        yield _typed_frame(city, chunk, columns, with_city)
+
+
+def rollup_grain(starting_date: str, ending_date: str, width: int | None = None) -> str:
+    """
+    Picks the grain matching the requested window.
+
+    Without a width: hourly up to 31 days, daily beyond. With the pixel width of the chart
+    (adaptive resolution): the finest of hourly, daily and weekly giving at most one bucket per
+    pixel, weekly if none does, so the number of points drawn grows with the chart rather than
+    with the window.
+
+    Args:
+        starting_date (str): The start date (in ISO format, e.g., '2024-10-01').
+        ending_date (str): The end date (in ISO format, e.g., '2024-10-07').
+        width (int, optional): The width of the chart in pixels. Defaults to None.
+
+    Returns:
+        str: The grain, 'h', 'D' or 'W' (see GRAINS).
+    """
+    span = schema.to_epoch(ending_date) - schema.to_epoch(starting_date)
+    if width is None:
+        return 'h' if span <= 31 * 86400 else 'D'
+    for grain, (_, bucket_width, _) in GRAINS.items():
+        if span / bucket_width <= width:
+            return grain
+    return 'W'
+
+
+def _bucket_start(ts: int, grain: str) -> int:
+    width = GRAINS[grain][1]
+    origin = _WEEK_ORIGIN if grain == 'W' else 0
+    return ts - (ts - origin) % width
+
+
+def bucket_range(starting_ts: int, ending_ts: int, grain: str) -> tuple[int, int]:
+    """
+    Widens a time range to the whole buckets of a grain covering it.
+
+    The statistics of a bucket depend on every observation in it, so the data behind an
+    aggregated result spans from the start of the first bucket to the end of the last one,
+    e.g. for cache invalidation or ETags.
+
+    Args:
+        starting_ts (int): The start of the range in epoch seconds.
+        ending_ts (int): The end of the range in epoch seconds.
+        grain (str): 'h', 'D' or 'W' (see GRAINS).
+
+    Returns:
+        tuple[int, int]: The start of the first bucket and the last second of the last bucket.
+    """
+    return _bucket_start(starting_ts, grain), _bucket_start(ending_ts, grain) + GRAINS[grain][1] - 1
+
+
+def list_cities(pool: ReadOnlyPool | None = None) -> list[str]:
+    """
+    Lists the cities having data in the database.
+
+    Args:
+        pool (ReadOnlyPool, optional): The read-only connections to query, e.g. those of a server.
+            Defaults to opening a connection to DB_PATH.
+
+    Returns:
+        list[str]: The city names in alphabetical order.
+    """
+    with _connect(pool) as conn:
+        return [name for (name,) in conn.execute('SELECT name FROM city ORDER BY name')]
+
+
+def fetch_temperature_rollups(cities: Iterable[str], starting_date: str, ending_date: str, grain: str = 'h',
+                              pool: ReadOnlyPool | None = None) -> pd.DataFrame:
+    """
+    Fetches the pre-aggregated temperature statistics of several cities with a single query.
+
+    The rollups are maintained on ingest, so no raw observation is read. Buckets are whole hours,
+    days or weeks (merged from the daily rollup), the first one being the bucket containing
+    starting_date.
+
+    Args:
+        cities (Iterable[str]): The names of the cities for which weather data is requested.
+        starting_date (str): The start date (in ISO format, e.g., '2024-10-01') for the data retrieval.
+        ending_date (str): The end date (in ISO format, e.g., '2024-10-07') for the data retrieval.
+        grain (str, optional): 'h' for hourly, 'D' for daily or 'W' for weekly buckets. Defaults to 'h'.
+        pool (ReadOnlyPool, optional): The read-only connections to query, e.g. those of a server.
+            Defaults to opening a connection to DB_PATH.
+
+    Returns:
+        pd.DataFrame: A long DataFrame with city, date, count, mean, min, max and std columns,
+            one row per city and non-empty bucket.
+    """
+    cities = list(dict.fromkeys(cities))
+    table, width, _ = GRAINS[grain]
+    start = _bucket_start(schema.to_epoch(starting_date), grain)
+    end = schema.to_epoch(ending_date)
+    if grain in schema.ROLLUPS:
+        query = f"""SELECT city.name, bucket, temp_count, temp_sum, temp_min, temp_max, temp_sumsq
+        FROM {table} JOIN city USING (city_id)
+        WHERE city.name IN ({', '.join('?' * len(cities))}) AND bucket BETWEEN ? AND ?
+        ORDER BY city_id, bucket"""
     else:
+        # the statistics of the daily buckets merge into those of their week
+        week = f'bucket - (bucket - {_WEEK_ORIGIN}) % {width}'
+        query = f"""SELECT city.name, {week} AS week, SUM(temp_count), SUM(temp_sum), MIN(temp_min),
+            MAX(temp_max), SUM(temp_sumsq)
+        FROM {table} JOIN city USING (city_id)
+        WHERE city.name IN ({', '.join('?' * len(cities))}) AND bucket BETWEEN ? AND ?
+        GROUP BY city_id, week
+        ORDER BY city_id, week"""
+
+    def compute() -> pd.DataFrame:
+        with QUERY_SECONDS.time(query='rollups'):
+            with _connect(pool) as conn:
+                rows = conn.execute(query, (*cities, start, end)).fetchall()
+
+        df = pd.DataFrame(rows, columns=['city', 'bucket', 'count', 'sum', 'min', 'max', 'sumsq'])
+        df['mean'] = df['sum'] / df['count']
+        df['std'] = ((df['sumsq'] - df['sum'] * df['mean']) / (df['count'] - 1)).clip(lower=0) ** 0.5
+        df['date'] = pd.to_datetime(df['bucket'], unit='s')
+        return df[['city', 'date', 'count', 'mean', 'min', 'max', 'std']]
+
+    # the last bucket covers observations up to its end, past ending_date
+    key = ('rollups', tuple(cities), start, end, grain)
+    return query_cache.get_or_compute(key, _db_path(pool), cities, *bucket_range(start, end, grain), compute,
+                                      partial(_connect, pool))
+
+
+def fetch_temperature_rollup(city: str, starting_date: str, ending_date: str, grain: str = 'h') -> pd.DataFrame | None:
+    """
+    Fetches the pre-aggregated temperature statistics of a city per hour, day or week.
+
+    Args:
+        city (str): The name of the city for which weather data is requested.
+        starting_date (str): The start date (in ISO format, e.g., '2024-10-01') for the data retrieval.
+        ending_date (str): The end date (in ISO format, e.g., '2024-10-07') for the data retrieval.
+        grain (str, optional): 'h' for hourly, 'D' for daily or 'W' for weekly buckets. Defaults to 'h'.
+
+    Returns:
+        pd.DataFrame or None: A DataFrame indexed by bucket with count, mean, min, max and std
+            columns, with empty buckets as NaN rows. None if no data is found.
+    """
+    df = fetch_temperature_rollups([city], starting_date, ending_date, grain)
+    if df.empty:
         return None
+    with RESAMPLE_SECONDS.time(operation='asfreq'):
+        return df.set_index('date').drop(columns='city').asfreq(GRAINS[grain][2])
+
+
+def mean_temperature_by_city(starting_date: str, ending_date: str, cities: Iterable[str] | None = None,
+                             grain: str = 'h', pool: ReadOnlyPool | None = None) -> pd.DataFrame:
+    """
+    Computes the mean temperature per bucket of several cities side by side.
+
+    All cities are fetched with one query and pivoted in a single pass, so the cost barely
+    depends on the number of cities.
+
+    Args:
+        starting_date (str): The start date (in ISO format, e.g., '2024-10-01') for data retrieval.
+        ending_date (str): The end date (in ISO format, e.g., '2024-10-07') for data retrieval.
+        cities (Iterable[str], optional): The cities to compare. Defaults to every city in the database.
+        grain (str, optional): 'h' for hourly, 'D' for daily or 'W' for weekly means. Defaults to 'h'.
+        pool (ReadOnlyPool, optional): The read-only connections to query, e.g. those of a server.
+            Defaults to opening a connection to DB_PATH.
+
+    Returns:
+        pd.DataFrame: A wide DataFrame indexed by bucket with one column of mean temperatures per
+            city having data, empty buckets being NaN.
+    """
+    cities = list(dict.fromkeys(cities if cities is not None else list_cities(pool)))
+
+    def compute() -> pd.DataFrame:
+        df = fetch_temperature_rollups(cities, starting_date, ending_date, grain, pool)
+        with RESAMPLE_SECONDS.time(operation='pivot'):
+            wide = df.pivot(index='date', columns='city', values='mean')
+            wide = wide[[city for city in cities if city in wide.columns]]
+            return wide.asfreq(GRAINS[grain][2]) if not wide.empty else wide
+
+    start, end = schema.to_epoch(starting_date), schema.to_epoch(ending_date)
+    key = ('mean', tuple(cities), start, end, grain)
+    return query_cache.get_or_compute(key, _db_path(pool), cities, *bucket_range(start, end, grain), compute,
+                                      partial(_connect, pool))
+
+
+def live_temperature_trends(city: str) -> pd.DataFrame:
+    """
+    Returns the hourly min, mean and max temperatures of a city over the last LIVE_WINDOW_HOURS.
+
+    The first call loads the window from the hourly rollup; later calls only read the
+    observations inserted since the previous call, so refreshing a live view is cheap.
+
+    Args:
+        city (str): The name of the city for which weather data is requested.
+
+    Returns:
+        pd.DataFrame: A DataFrame indexed by hour with count, mean, min and max columns.
+    """
+    global live_aggregator
+    if live_aggregator is None or live_aggregator.db_path != DB_PATH:
+        live_aggregator = StreamingAggregator(LIVE_WINDOW_HOURS, DB_PATH)
+        live_aggregator.prime()
+    else:
+        live_aggregator.tail()
+    return live_aggregator.snapshot(city)
 
 
 # Print weather data given table_name
@@ -64,24 +416,12 @@ def timestamp_spliter(starting_time: str, ending_time: str, split: int = 10) ->
     Returns:
         List[str]: A list of ISO-formatted timestamps representing the evenly split intervals.
     """
-    # convert the str into timestamps
-    starting_time = datetime.strptime(starting_time, "%Y-%m-%dT%H:%M:%S")
-    ending_time = datetime.strptime(ending_time, "%Y-%m-%dT%H:%M:%S")
-
-    # calculate total duration 
-    total_duration = ending_time - starting_time
+    return [tick.isoformat() for tick in _split_range(starting_time, ending_time, split)]
 
-    # calculate the length of each split duration
-    split_duration = total_duration/split
 
-    # Generate split timestamps
-    split_timestamps_list = []
-    current_time = starting_time
-    for _ in range(split):
-        split_timestamps_list.append(current_time.isoformat())
-        current_time += split_duration
-
-    return split_timestamps_list
+def _split_range(starting_time: str, ending_time: str, split: int) -> pd.DatetimeIndex:
+    start, end = np.datetime64(starting_time, 's'), np.datetime64(ending_time, 's')
+    return pd.DatetimeIndex(start + (end - start) * np.arange(split) // split)
 
 
 def timestamp_converter(split_timestamps_list: list[str]) -> list[str]:
@@ -94,97 +434,221 @@ def timestamp_converter(split_timestamps_list: list[str]) -> list[str]:
     Returns:
         List[str]: A list of simplified timestamps (hour:minute).
     """
+    return list(pd.DatetimeIndex(split_timestamps_list).strftime('%H:%M'))
 
-    simplified_split_timestamps_list =[]
-    for timestamps in split_timestamps_list:
-        pattern = r'(\d{2}:\d{2})'
-        match = re.search(pattern, timestamps)
-        if match:
-            simplified_split_timestamps_list.append(match.group(1)) 
-    
-    return simplified_split_timestamps_list
-        
 
-def temperature_trends_graph(city: str, starting_date: str, ending_date: str) -> None:
+def time_ticks(starting_date: str, ending_date: str, split: int = 10) -> tuple[pd.DatetimeIndex, list[str]]:
     """
-    Plots a graph comparing min, mean, and max temperatures for the specified city.
+    Computes evenly spaced x-axis ticks and their labels for a time range, without a Python loop.
+
+    Labels show the time of day for ranges up to two days, the day for ranges up to a year and
+    the month beyond, so they stay readable whatever the range.
 
     Args:
-        city (str): The name of the city for which weather data is requested.
-        starting_date (str): The start date (in ISO format, e.g., '2024-10-01') for data retrieval.
-        ending_date (str): The end date (in ISO format, e.g., '2024-10-07') for data retrieval.
+        starting_date (str): The start date (in ISO format, e.g., '2024-10-01').
+        ending_date (str): The end date (in ISO format, e.g., '2024-10-07').
+        split (int, optional): The number of ticks. Defaults to 10.
+
+    Returns:
+        tuple: The tick positions and their labels.
     """
-    df = fetch_data_from_db(city, starting_date, ending_date)
-    df['date'] = pd.to_datetime(df['timestamp'])
+    ticks = _split_range(starting_date, ending_date, split)
+    span = schema.to_epoch(ending_date) - schema.to_epoch(starting_date)
+    if span <= 2 * 86400:
+        fmt = '%H:%M'
+    elif span <= 366 * 86400:
+        fmt = '%b %d'
+    else:
+        fmt = '%b %Y'
+    return ticks, list(ticks.strftime(fmt))
 
-    # Set the timestamp column as the index
-    df.set_index('date', inplace=True)
 
-    temperature_per_hr_max = df['temperature'].resample('h').max()
-    temperature_per_hr_mean = df['temperature'].resample('h').mean()
-    temperature_per_hr_min = df['temperature'].resample('h').min()
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Selects the points of a series that best preserve its shape (Largest-Triangle-Three-Buckets).
 
-    plt.plot(temperature_per_hr_min, label='Min Temperature', color='blue')
-    plt.plot(temperature_per_hr_mean, label='Mean Temperature', color='green')
-    plt.plot(temperature_per_hr_max, label='Max Temperature', color='red')
-    plt.legend()
-    plt.xlabel('Time (Hourly)')
-    plt.ylabel('Temperature (°C)')
+    The first and last points are kept; the others are split into threshold - 2 buckets, and the
+    point of each bucket forming the largest triangle with the point kept in the previous bucket
+    and the mean of the next bucket is kept. Peaks and troughs survive, unlike with averaging.
 
-    split_timestamps_list = timestamp_spliter(starting_date, ending_date)
-    simplified_split_timestamps_list = timestamp_converter(split_timestamps_list)
-    plt.xticks(split_timestamps_list, simplified_split_timestamps_list)
+    Args:
+        x (np.ndarray): The x values, in increasing order.
+        y (np.ndarray): The y values, without NaN.
+        threshold (int): The number of points to keep.
 
-    plt.title('Temperature Trends')
-    plt.tight_layout()
-    plt.show()
+    Returns:
+        np.ndarray: The indices of the kept points, in increasing order.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    x = x - x[0]
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    # the mean of every bucket, with the last point as the bucket after the last one
+    means_x = np.append(np.add.reduceat(x[1:n - 1], edges[:-1] - 1) / np.diff(edges), x[-1])
+    means_y = np.append(np.add.reduceat(y[1:n - 1], edges[:-1] - 1) / np.diff(edges), y[-1])
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        areas = np.abs((x[previous] - means_x[i + 1]) * (y[lo:hi] - y[previous])
+                       - (x[previous] - x[lo:hi]) * (means_y[i + 1] - y[previous]))
+        previous = lo + int(np.argmax(areas))
+        kept[i + 1] = previous
+    return kept
+
+
+def downsample(series: pd.Series, max_points: int | None) -> pd.Series:
+    """
+    Reduces a time series to at most max_points points with lttb, ignoring its NaN values.
+
+    Args:
+        series (pd.Series): The series, indexed by datetime64 values.
+        max_points (int or None): The number of points to keep, None to keep the series as is.
 
+    Returns:
+        pd.Series: The kept points.
+    """
+    if max_points is None or len(series) <= max_points:
+        return series
+    series = series.dropna()
+    kept = lttb(series.index.asi8, series.to_numpy(), max_points)
+    return series.iloc[kept]
 
 
-def mean_temperature_per_hr_comp_diff_city(starting_date: str, ending_date: str) -> None:
+def temperature_trends(city: str, starting_date: str, ending_date: str,
+                       width: int | None = None) -> tuple[pd.DataFrame, str]:
     """
-    Plots a graph comparing mean temperatures per hour for Hong Kong, New York, and Tokyo.
+    Computes the min, mean and max temperatures plotted by temperature_trends_graph.
 
     Args:
+        city (str): The name of the city for which weather data is requested.
         starting_date (str): The start date (in ISO format, e.g., '2024-10-01') for data retrieval.
         ending_date (str): The end date (in ISO format, e.g., '2024-10-07') for data retrieval.
+        width (int, optional): The width of the chart in pixels, picking the grain adaptively
+            (see rollup_grain). Defaults to None.
+
+    Returns:
+        tuple: The rollup DataFrame (see fetch_temperature_rollup) and its grain ('h', 'D' or 'W').
+    """
+    grain = rollup_grain(starting_date, ending_date, width)
+    df = fetch_temperature_rollup(city, starting_date, ending_date, grain)
+    if df is None:
+        raise ValueError(f"no data for {city} between {starting_date} and {ending_date}")
+    return df, grain
+
+
+def _format_axes(ax: 'plt.Axes', grain: str, starting_date: str, ending_date: str) -> None:
+    ax.set_xlabel({'h': 'Time (Hourly)', 'D': 'Time (Daily)', 'W': 'Time (Weekly)'}[grain])
+    ax.set_ylabel('Temperature (°C)')
+
+    ticks, labels = time_ticks(starting_date, ending_date)
+    ax.set_xticks(ticks, labels)
+
+    ax.set_title('Temperature Trends')
+
+
+def plot_temperature_trends(ax: 'plt.Axes', df: pd.DataFrame, grain: str, starting_date: str, ending_date: str,
+                            max_points: int | None = None) -> None:
+    """
+    Draws the min, mean and max temperatures returned by temperature_trends on an Axes.
+
+    Args:
+        ax (plt.Axes): The Axes to draw on.
+        df (pd.DataFrame): The rollup DataFrame returned by temperature_trends.
+        grain (str): The grain of the rollup ('h', 'D' or 'W').
+        starting_date (str): The start date (in ISO format, e.g., '2024-10-01') of the graph.
+        ending_date (str): The end date (in ISO format, e.g., '2024-10-07') of the graph.
+        max_points (int, optional): The number of points drawn per line, reduced with lttb.
+            Defaults to all of them.
     """
+    ax.plot(downsample(df['min'], max_points), label='Min Temperature', color='blue')
+    ax.plot(downsample(df['mean'], max_points), label='Mean Temperature', color='green')
+    ax.plot(downsample(df['max'], max_points), label='Max Temperature', color='red')
+    ax.legend()
+    _format_axes(ax, grain, starting_date, ending_date)
 
-    df_hk = fetch_data_from_db('Hong Kong', starting_date, ending_date)
-    df_hk['date'] = pd.to_datetime(df_hk['timestamp'])
 
-    df_ny = fetch_data_from_db('New York', starting_date, ending_date)
-    df_ny['date'] = pd.to_datetime(df_ny['timestamp'])
+def plot_mean_temperature_by_city(ax: 'plt.Axes', temperature_mean: pd.DataFrame, grain: str,
+                                  starting_date: str, ending_date: str, max_points: int | None = None) -> None:
+    """
+    Draws the mean temperatures returned by mean_temperature_by_city on an Axes.
 
-    df_tyo = fetch_data_from_db('Tokyo', starting_date, ending_date)
-    df_tyo['date'] = pd.to_datetime(df_tyo['timestamp'])
+    Args:
+        ax (plt.Axes): The Axes to draw on.
+        temperature_mean (pd.DataFrame): The wide DataFrame returned by mean_temperature_by_city.
+        grain (str): The grain of the means ('h', 'D' or 'W').
+        starting_date (str): The start date (in ISO format, e.g., '2024-10-01') of the graph.
+        ending_date (str): The end date (in ISO format, e.g., '2024-10-07') of the graph.
+        max_points (int, optional): The number of points drawn per city, reduced with lttb.
+            Defaults to all of them.
+    """
+    for city in temperature_mean.columns:
+        ax.plot(downsample(temperature_mean[city], max_points), label=f'{city} Mean Temperature')
+    ax.legend(fontsize='small', ncol=max(1, len(temperature_mean.columns) // 10))
+    _format_axes(ax, grain, starting_date, ending_date)
 
-    # Set the timestamp column as the index
-    df_hk.set_index('date', inplace=True)
-    df_ny.set_index('date', inplace=True)
-    df_tyo.set_index('date', inplace=True)
 
-    temperature_per_hr_mean_hk = df_hk['temperature'].resample('h').mean()
-    temperature_per_hr_mean_ny = df_ny['temperature'].resample('h').mean()
-    temperature_per_hr_mean_tyo = df_tyo['temperature'].resample('h').mean()
+def _pixel_width(fig: 'plt.Figure') -> int:
+    return int(fig.get_figwidth() * fig.dpi)
 
-    plt.plot(temperature_per_hr_mean_hk, label='Hong Kong Mean Temperature', color='blue')
-    plt.plot(temperature_per_hr_mean_ny, label='New York Mean Temperature', color='green')
-    plt.plot(temperature_per_hr_mean_tyo, label='Tokyo Mean Temperature', color='red')    
 
-    plt.legend()
-    plt.xlabel('Time (Hourly)')
-    plt.ylabel('Temperature (°C)')
+def _show_or_save(fig: 'plt.Figure', output: str | None) -> None:
+    if output is None:
+        plt.show()
+    else:
+        fig.savefig(output)
+        plt.close(fig)
 
-    split_timestamps_list = timestamp_spliter(starting_date, ending_date)
-    simplified_split_timestamps_list = timestamp_converter(split_timestamps_list)
-    plt.xticks(split_timestamps_list, simplified_split_timestamps_list)
 
-    plt.title('Temperature Trends')
-    plt.tight_layout()
-    plt.show()
+def temperature_trends_graph(city: str, starting_date: str, ending_date: str, output: str | None = None,
+                             adaptive: bool = False, lttb_points: int | None = None) -> None:
+    """
+    Plots a graph comparing min, mean, and max temperatures for the specified city.
 
-# e.g. mean_temperature_per_hr_comp_diff_city('2024-08-28T11:00:00', '2024-08-28T16:00:00')
+    Args:
+        city (str): The name of the city for which weather data is requested.
+        starting_date (str): The start date (in ISO format, e.g., '2024-10-01') for data retrieval.
+        ending_date (str): The end date (in ISO format, e.g., '2024-10-07') for data retrieval.
+        output (str, optional): The image file to save the graph to instead of showing it,
+            e.g. 'trends.png'. Defaults to None.
+        adaptive (bool, optional): Whether to pick the grain from the pixel width of the figure
+            (see rollup_grain). Defaults to False.
+        lttb_points (int, optional): The number of points drawn per line, reduced with lttb.
+            Defaults to all of them.
+    """
+    fig, ax = plt.subplots()
+    width = _pixel_width(fig) if adaptive else None
+    df, grain = temperature_trends(city, starting_date, ending_date, width)
+    plot_temperature_trends(ax, df, grain, starting_date, ending_date, lttb_points)
+    fig.tight_layout()
+    _show_or_save(fig, output)
 
 
+def mean_temperature_per_hr_comp_diff_city(starting_date: str, ending_date: str,
+                                           cities: Iterable[str] | None = None, output: str | None = None,
+                                           adaptive: bool = False, lttb_points: int | None = None) -> None:
+    """
+    Plots a graph comparing mean temperatures per hour for several cities.
 
+    Args:
+        starting_date (str): The start date (in ISO format, e.g., '2024-10-01') for data retrieval.
+        ending_date (str): The end date (in ISO format, e.g., '2024-10-07') for data retrieval.
+        cities (Iterable[str], optional): The cities to compare. Defaults to every city in the database.
+        output (str, optional): The image file to save the graph to instead of showing it,
+            e.g. 'mean.svg'. Defaults to None.
+        adaptive (bool, optional): Whether to pick the grain from the pixel width of the figure
+            (see rollup_grain). Defaults to False.
+        lttb_points (int, optional): The number of points drawn per city, reduced with lttb.
+            Defaults to all of them.
+    """
+    fig, ax = plt.subplots()
+    grain = rollup_grain(starting_date, ending_date, _pixel_width(fig) if adaptive else None)
+    temperature_mean = mean_temperature_by_city(starting_date, ending_date, cities, grain)
+    plot_mean_temperature_by_city(ax, temperature_mean, grain, starting_date, ending_date, lttb_points)
+    fig.tight_layout()
+    _show_or_save(fig, output)
+
+# e.g. mean_temperature_per_hr_comp_diff_city('2024-08-28T11:00:00', '2024-08-28T16:00:00', ['Hong Kong', 'Tokyo'])
@@ -0,0 +1,126 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# the sources are flat modules imported by name, as when running the scripts from src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import schema  # noqa: E402
+from mock_api import MockWeatherAPI  # noqa: E402
+
+
+def observation(timestamp: int, temperature: float) -> tuple[str, dict]:
+    """
+    Returns a (city, weather_data) row of Tokyo, as written to a BatchWriter.
+    """
+    return 'Tokyo', {'timestamp': timestamp, 'temperature': temperature, 'humidity': 50, 'weather': 'mist'}
+
+
+def observations(db_path: str) -> int:
+    """
+    Returns the number of raw observations stored in a database.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM observation').fetchone()[0]
+    finally:
+        conn.close()
+
+
+class StubServer:
+    """
+    A local HTTP server answering with a script of responses, one per request, and recording
+    the headers of the requests it received.
+
+    Each response is a (status, body, headers) tuple; a dict body is sent as JSON, bytes as is.
+    Once the script is exhausted, the last response is repeated.
+    """
+
+    def __init__(self, responses: list[tuple]) -> None:
+        self.responses = list(responses)
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self) -> None:
+                stub.requests.append(dict(self.headers))
+                status, body, headers = stub.responses[min(len(stub.requests), len(stub.responses)) - 1]
+                body = json.dumps(body).encode() if isinstance(body, (dict, list)) else body or b''
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}/data/2.5/weather?q=Tokyo'
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    """
+    Returns a function starting a StubServer with the given responses, stopped after the test.
+    """
+    servers = []
+
+    def start(*responses: tuple) -> StubServer:
+        servers.append(StubServer(list(responses)))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def mock_api():
+    """
+    A MockWeatherAPI publishing a fixed observation time, advanced by setting api.dt.
+    """
+    with MockWeatherAPI() as api:
+        api.dt = 1_700_000_400
+        api.current_dt = lambda: api.dt
+        yield api
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """
+    The path of a new database at the current schema version.
+    """
+    path = str(tmp_path / 'weather.db')
+    schema.connect(path).close()
+    return path
+
+
+@pytest.fixture
+def analysis_db(db_path, monkeypatch):
+    """
+    Points weather_data_analysis at a new database, with an empty query cache.
+    """
+    import weather_data_analysis as an
+
+    monkeypatch.setattr(an, 'DB_PATH', db_path)
+    an.query_cache.clear()
+    yield db_path
+    an.query_cache.clear()
@@ -0,0 +1,68 @@
+import json
+import socket
+import urllib.request
+
+import pytest
+
+import schema
+import api
+from api import QueryServer
+from conftest import observation
+from db_writer import BatchWriter
+
+DAY = schema.to_epoch('2024-10-02T00:00:00')
+
+
+@pytest.fixture
+def server(db_path):
+    with QueryServer(db_path, port=0, workers=2) as server:
+        yield server
+
+
+def etag(server: QueryServer, path: str) -> str:
+    with urllib.request.urlopen(server.base_url + path) as response:
+        return response.headers['ETag']
+
+
+@pytest.mark.parametrize('grain', ['D', 'W'])
+def test_rollup_etags_cover_the_whole_buckets_served(server, db_path, grain):
+    with BatchWriter(db_path) as writer:
+        writer.write_many([observation(DAY + 6 * 3600, 10.0)])
+    path = f'/rollups?city=Tokyo&start=2024-10-02T06:00:00&end=2024-10-02T12:00:00&grain={grain}'
+    before = etag(server, path)
+    assert etag(server, path) == before
+
+    # outside the requested range, but in the daily bucket served
+    with BatchWriter(db_path) as writer:
+        writer.write_many([observation(DAY + 20 * 3600, 30.0)])
+    assert etag(server, path) != before
+
+
+def test_mean_etags_cover_the_whole_buckets_served(server, db_path):
+    with BatchWriter(db_path) as writer:
+        writer.write_many([observation(DAY + 6 * 3600, 10.0)])
+    path = '/means?city=Tokyo&start=2024-10-02T06:00:00&end=2024-10-02T12:00:00&grain=D'
+    before = etag(server, path)
+
+    with BatchWriter(db_path) as writer:
+        writer.write_many([observation(DAY + 3600, 30.0)])
+    assert etag(server, path) != before
+
+
+def test_servers_on_different_databases_answer_from_their_own(tmp_path):
+    paths = [str(tmp_path / 'a.db'), str(tmp_path / 'b.db')]
+    for path, city in zip(paths, ['Tokyo', 'Paris']):
+        schema.connect(path).close()
+        with BatchWriter(path) as writer:
+            writer.write(city, observation(DAY, 10.0)[1])
+    with QueryServer(paths[0], port=0) as first, QueryServer(paths[1], port=0) as second:
+        for server, city in zip([first, second], ['Tokyo', 'Paris']):
+            with urllib.request.urlopen(server.base_url + '/cities') as response:
+                assert json.load(response) == [city]
+
+
+def test_a_client_slow_to_send_its_headers_is_disconnected(server, monkeypatch):
+    monkeypatch.setattr(api, 'REQUEST_SECONDS_LIMIT', 0.2)
+    with socket.create_connection((server.host, server.port), timeout=5) as client:
+        client.sendall(b'GET /cities HTTP/1.1\r\n')
+        assert client.recv(1024) == b''
@@ -0,0 +1,111 @@
+import json
+import os
+import sqlite3
+import time
+
+import pytest
+
+import archive
+import schema
+import weather_data_analysis as an
+from backfill import backfill
+from conftest import observation
+from db_writer import BatchWriter
+from mock_api import weather_payload
+
+DAY = 86400
+# whole days old enough to be archived, and one recent day staying in SQLite
+OLD = int(time.time()) // DAY * DAY - 40 * DAY
+RECENT = int(time.time()) // DAY * DAY - DAY
+
+
+@pytest.fixture
+def archived_db(analysis_db):
+    with BatchWriter(analysis_db) as writer:
+        writer.write_many([observation(OLD + i * 3600, float(i)) for i in range(3)] + [observation(RECENT, 20.0)])
+    return analysis_db
+
+
+def rollups(db_path: str) -> list[tuple]:
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('SELECT bucket, temp_count, temp_sum FROM rollup_hourly ORDER BY bucket').fetchall()
+    finally:
+        conn.close()
+
+
+def temperatures() -> list[float]:
+    start, end = schema.from_epoch(OLD).isoformat(), schema.from_epoch(RECENT + 3600).isoformat()
+    df = an.fetch_data_from_db('Tokyo', start, end)
+    return df['temperature'].tolist()
+
+
+def test_archive_defaults_to_a_directory_next_to_the_database(archived_db, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path.parent)
+    assert archive.compact(archived_db) == 3
+    directory = str(tmp_path / archive.ARCHIVE_DIR)
+    assert os.path.isdir(os.path.join(directory, 'city=Tokyo'))
+
+    # read back from another working directory
+    an.query_cache.clear()
+    assert temperatures() == [0.0, 1.0, 2.0, 20.0]
+
+
+def test_custom_archive_directory_is_recorded_for_the_readers(archived_db, tmp_path):
+    directory = str(tmp_path / 'elsewhere')
+    archive.compact(archived_db, directory)
+    conn = schema.connect(archived_db)
+    assert archive.archive_location(conn) == directory
+    conn.close()
+    assert temperatures() == [0.0, 1.0, 2.0, 20.0]
+
+    with pytest.raises(ValueError):
+        archive.compact(archived_db, str(tmp_path / 'another'))
+    # nothing left to move, the recorded archive is reused
+    assert archive.compact(archived_db) == 0
+
+
+def test_missing_archive_fails_loudly(archived_db, tmp_path):
+    directory = tmp_path / 'archive'
+    archive.compact(archived_db)
+    directory.rename(tmp_path / 'moved')
+
+    an.query_cache.clear()
+    with pytest.raises(FileNotFoundError):
+        temperatures()
+    # compact accepts the new location of the archive and records it
+    archive.compact(archived_db, str(tmp_path / 'moved'))
+    assert temperatures() == [0.0, 1.0, 2.0, 20.0]
+
+
+def test_archived_ranges_are_not_inserted_again(archived_db, tmp_path):
+    archive.compact(archived_db)
+    before = rollups(archived_db)
+
+    path = tmp_path / 'payloads.jsonl'
+    with open(path, 'w', encoding='utf-8') as f:
+        for timestamp in (OLD + 3600, OLD + 7200 + 60, RECENT + 60):
+            payload = weather_payload('Tokyo', timestamp)
+            payload['main'] = {'temp': 30.0, 'humidity': 50}
+            f.write(json.dumps(payload) + '\n')
+    assert backfill(str(path), archived_db)['inserted'] == 1
+    with BatchWriter(archived_db) as writer:
+        writer.write_many([observation(OLD + 3600, 30.0)])
+
+    after = rollups(archived_db)
+    assert after[:-1] == before[:-1]
+    assert after[-1] == (RECENT - RECENT % 3600, 2, 50.0)
+    assert temperatures() == [0.0, 1.0, 2.0, 20.0, 30.0]
+
+
+def test_rows_archived_twice_before_sealing_are_read_once(archived_db):
+    archive.compact(archived_db)
+    # as in a database archived before the seals existed
+    conn = sqlite3.connect(archived_db)
+    conn.execute('UPDATE city SET sealed_before = NULL')
+    conn.commit()
+    conn.close()
+    with BatchWriter(archived_db) as writer:
+        writer.write_many([observation(OLD + 3600, 30.0)])
+
+    assert temperatures() == [0.0, 1.0, 2.0, 20.0]
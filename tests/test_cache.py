@@ -0,0 +1,46 @@
+import sqlite3
+
+import schema
+import weather_data_analysis as an
+from conftest import observation
+from db_writer import BatchWriter
+from retention import prune_observations
+
+START = schema.to_epoch('2024-10-01T00:00:00')
+
+
+def write(db_path: str, timestamps: list[int]) -> None:
+    with BatchWriter(db_path) as writer:
+        writer.write_many([observation(timestamp, 10.0) for timestamp in timestamps])
+
+
+def fetch() -> list[int]:
+    df = an.fetch_data_from_db('Tokyo', '2024-10-01', '2024-10-01T23:59:59', ['temperature'])
+    return [] if df is None else [int(timestamp.timestamp()) for timestamp in df.index]
+
+
+def test_a_row_inserted_in_the_cached_range_invalidates_the_entry(analysis_db):
+    # the counters are kept across tests
+    before = an.query_cache.stats()
+    write(analysis_db, [START, START + 60])
+    fetch()
+    assert fetch() == [START, START + 60]
+    assert an.query_cache.stats()['hits'] == before['hits'] + 1
+
+    write(analysis_db, [START + 120])
+    assert fetch() == [START, START + 60, START + 120]
+    assert an.query_cache.stats()['invalidations'] == before['invalidations'] + 1
+
+
+def test_a_reused_rowid_after_a_deletion_invalidates_the_entry(analysis_db):
+    before = an.query_cache.stats()
+    write(analysis_db, [START + 60, START - 86400])
+    assert fetch() == [START + 60]
+
+    # deleting the latest row gives its rowid to the next one inserted, below the cached mark
+    conn = sqlite3.connect(analysis_db, isolation_level=None)
+    prune_observations(conn, START, pause=0)
+    conn.close()
+    write(analysis_db, [START + 120])
+    assert fetch() == [START + 60, START + 120]
+    assert an.query_cache.stats()['invalidations'] == before['invalidations'] + 1
@@ -0,0 +1,47 @@
+import sqlite3
+import time
+
+import pytest
+
+import db_writer
+from conftest import observation, observations
+from db_writer import BatchWriter
+
+ROW = observation(1_700_000_000, 10.0)
+
+
+def lock(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute('BEGIN IMMEDIATE')
+    return conn
+
+
+def test_a_failed_flush_keeps_the_rows_buffered(db_path):
+    with BatchWriter(db_path, flush_interval=60) as writer:
+        writer.conn.execute('PRAGMA busy_timeout=0')
+        writer.write(*ROW)
+        holder = lock(db_path)
+        with pytest.raises(sqlite3.OperationalError):
+            writer.flush()
+        holder.execute('ROLLBACK')
+        holder.close()
+        assert writer.flush() == 1
+    assert observations(db_path) == 1
+
+
+def test_the_background_flusher_survives_a_failed_flush(db_path):
+    errors = db_writer.FLUSH_ERRORS.values.get((), 0)
+    with BatchWriter(db_path, flush_interval=0.05) as writer:
+        writer.conn.execute('PRAGMA busy_timeout=0')
+        holder = lock(db_path)
+        writer.write(*ROW)
+        deadline = time.monotonic() + 5
+        while db_writer.FLUSH_ERRORS.values.get((), 0) == errors and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert db_writer.FLUSH_ERRORS.values.get((), 0) > errors
+        holder.execute('ROLLBACK')
+        holder.close()
+        while observations(db_path) == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert writer.flusher.is_alive()
+    assert observations(db_path) == 1
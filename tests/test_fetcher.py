@@ -0,0 +1,119 @@
+import time
+
+from fetcher import CircuitBreaker, ResilientFetcher
+from mock_api import weather_payload
+from schedule import parse_weather_data
+
+
+def make_fetcher(**kwargs) -> ResilientFetcher:
+    options = {'timeout': 2, 'retries': 2, 'backoff_base': 0, 'backoff_cap': 0}
+    return ResilientFetcher(**options | kwargs)
+
+
+def test_retries_retryable_statuses_until_success(stub_server):
+    payload = weather_payload('Tokyo', 1_700_000_000)
+    server = stub_server((503, {'cod': 503}, {}), (500, {'cod': 500}, {'Retry-After': '0'}), (200, payload, {}))
+    fetcher = make_fetcher()
+
+    assert fetcher.fetch('Tokyo', server.url) == payload
+    assert len(server.requests) == 3
+    assert fetcher.stats['retries'] == 2
+    assert fetcher.breaker('Tokyo').state == 'closed'
+
+
+def test_does_not_retry_client_errors(stub_server):
+    server = stub_server((404, {'cod': 404}, {}))
+    fetcher = make_fetcher()
+
+    assert fetcher.fetch('Tokyo', server.url) is None
+    assert len(server.requests) == 1
+    assert fetcher.stats['status_404'] == 1
+    assert fetcher.stats['failed'] == 1
+
+
+def test_gives_up_after_the_last_retry(stub_server):
+    server = stub_server((500, {'cod': 500}, {}))
+    fetcher = make_fetcher(retries=3)
+
+    assert fetcher.fetch('Tokyo', server.url) is None
+    assert len(server.requests) == 4
+    assert fetcher.stats['failed'] == 1
+
+
+def test_breaker_opens_after_consecutive_failures_and_short_circuits(stub_server):
+    server = stub_server((500, {'cod': 500}, {}))
+    fetcher = make_fetcher(retries=0, failure_threshold=2, reset_timeout=60)
+
+    for _ in range(2):
+        assert fetcher.fetch('Tokyo', server.url) is None
+    assert fetcher.breaker('Tokyo').state == 'open'
+    assert fetcher.fetch('Tokyo', server.url) is None
+    assert len(server.requests) == 2
+    assert fetcher.stats['short_circuited'] == 1
+
+
+def test_breaker_lets_one_trial_through_when_half_open():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+
+def test_sends_the_etag_back_and_reports_304_as_unchanged(mock_api):
+    fetcher = make_fetcher()
+    url = f'{mock_api.base_url}/weather?q=Tokyo'
+
+    assert fetcher.fetch('Tokyo', url)['dt'] == mock_api.dt
+    assert 'If-None-Match' in fetcher.validators['Tokyo']
+    assert fetcher.fetch('Tokyo', url) is None
+    assert fetcher.stats['not_modified'] == 1
+
+    mock_api.dt += 600
+    assert fetcher.fetch('Tokyo', url)['dt'] == mock_api.dt
+
+
+def test_skips_payloads_whose_observation_did_not_change(stub_server):
+    payload = weather_payload('Tokyo', 1_700_000_000)
+    server = stub_server((200, payload, {}))
+    fetcher = make_fetcher()
+
+    assert fetcher.fetch('Tokyo', server.url) == payload
+    assert fetcher.fetch('Tokyo', server.url) is None
+    assert fetcher.stats['unchanged'] == 1
+
+
+def test_malformed_bodies_count_as_failed_attempts(stub_server):
+    payload = weather_payload('Tokyo', 1_700_000_000)
+    server = stub_server((200, b'{"cod": 200, "ma', {'ETag': '"bad"'}), (200, payload, {'ETag': '"good"'}))
+    fetcher = make_fetcher(retries=1)
+
+    assert fetcher.fetch('Tokyo', server.url) == payload
+    assert fetcher.stats['invalid_payloads'] == 1
+    assert fetcher.stats['retries'] == 1
+    assert fetcher.validators['Tokyo'] == {'If-None-Match': '"good"'}
+
+
+def test_incomplete_payloads_feed_the_breaker(stub_server):
+    payload = weather_payload('Tokyo', 1_700_000_000)
+    del payload['main']
+    server = stub_server((200, payload, {'ETag': '"incomplete"'}))
+    fetcher = make_fetcher(retries=0, failure_threshold=2, reset_timeout=60)
+
+    for _ in range(2):
+        assert fetcher.fetch('Tokyo', server.url, check=parse_weather_data) is None
+    assert fetcher.stats['invalid_payloads'] == 2
+    assert fetcher.stats['failed'] == 2
+    assert fetcher.breaker('Tokyo').state == 'open'
+    assert 'Tokyo' not in fetcher.validators
+    assert 'Tokyo' not in fetcher.last_dt
@@ -0,0 +1,153 @@
+import json
+import sqlite3
+
+import pytest
+
+from backfill import backfill
+from conftest import observations
+from db_writer import BatchWriter
+from fetcher import ResilientFetcher
+from ingest import GroupIngestionEngine, IngestionEngine
+from mock_api import city_id_of, weather_payload
+
+CITIES = [f'City {i}' for i in range(25)]
+
+
+@pytest.fixture
+def writer(db_path):
+    with BatchWriter(db_path) as writer:
+        yield writer
+
+
+def test_cycle_fetches_every_city_once(mock_api, writer, db_path):
+    engine = IngestionEngine(CITIES, rate_limit=0, writer=writer, base_url=mock_api.base_url)
+    try:
+        assert engine.run_cycle() == len(CITIES)
+        writer.flush()
+        assert observations(db_path) == len(CITIES)
+        assert engine.run_cycle() == 0  # the mock did not publish new observations
+        mock_api.dt += 600
+        assert engine.run_cycle() == len(CITIES)
+    finally:
+        engine.close()
+
+
+def test_group_engine_resolves_ids_then_fetches_groups(mock_api, writer, db_path):
+    engine = GroupIngestionEngine(CITIES, group_size=10, rate_limit=0, writer=writer, base_url=mock_api.base_url)
+    try:
+        assert engine.run_cycle() == len(CITIES)
+        writer.flush()
+        assert observations(db_path) == len(CITIES)
+        assert mock_api.requests == len(CITIES)
+        assert engine.owm_ids == {city: city_id_of(city) for city in CITIES}
+
+        mock_api.dt += 600
+        assert engine.run_cycle() == len(CITIES)
+        assert mock_api.requests == len(CITIES) + 3
+    finally:
+        engine.close()
+
+
+def test_group_engine_reuses_stored_ids(mock_api, writer):
+    first = GroupIngestionEngine(CITIES[:5], rate_limit=0, writer=writer, base_url=mock_api.base_url)
+    first.run_cycle()
+    first.close()
+    writer.flush()
+
+    second = GroupIngestionEngine(CITIES[:5], rate_limit=0, writer=writer, base_url=mock_api.base_url)
+    try:
+        assert second.owm_ids == first.owm_ids
+        mock_api.dt += 600
+        requests_before = mock_api.requests
+        assert second.run_cycle() == 5
+        assert mock_api.requests - requests_before == 1
+    finally:
+        second.close()
+
+
+def test_group_engine_falls_back_to_single_requests_for_unresolved_cities(mock_api, writer):
+    engine = GroupIngestionEngine(CITIES[:5], rate_limit=0, writer=writer, base_url=mock_api.base_url)
+    engine.run_cycle()
+    engine.close()
+    writer.flush()
+
+    # a city added since is fetched on its own until its id is known, the others by group
+    engine = GroupIngestionEngine(CITIES[:6], rate_limit=0, writer=writer, base_url=mock_api.base_url)
+    try:
+        assert CITIES[5] not in engine.owm_ids
+        mock_api.dt += 600
+        requests_before = mock_api.requests
+        assert engine.run_cycle() == 6
+        assert mock_api.requests - requests_before == 2
+        assert engine.owm_ids[CITIES[5]] == city_id_of(CITIES[5])
+    finally:
+        engine.close()
+
+
+def test_incomplete_group_payloads_are_fetched_again_next_cycle(mock_api, writer, monkeypatch):
+    engine = GroupIngestionEngine(CITIES[:5], rate_limit=0, writer=writer, base_url=mock_api.base_url)
+    engine.run_cycle()
+    engine.close()
+    writer.flush()
+
+    engine = GroupIngestionEngine(CITIES[:5], rate_limit=0, writer=writer, base_url=mock_api.base_url,
+                                  fetcher=ResilientFetcher(retries=0))
+    try:
+        mock_api.dt += 600
+        with monkeypatch.context() as patch:
+            patch.setattr(mock_api, 'payload', lambda name, owm_id=None: {'id': owm_id, 'name': name})
+            assert engine.run_cycle() == 0
+        assert engine.fetcher.stats['invalid_payloads'] == 1
+        # the observations of the rejected payload are not marked as seen
+        assert engine.run_cycle() == 5
+    finally:
+        engine.close()
+
+
+def test_a_failing_city_does_not_abort_the_cycle(mock_api, writer, db_path, monkeypatch):
+    engine = IngestionEngine(CITIES[:5], rate_limit=0, writer=writer, base_url=mock_api.base_url)
+    fetch_city = engine.fetch_city
+
+    def failing(city):
+        if city == CITIES[2]:
+            raise RuntimeError('boom')
+        return fetch_city(city)
+
+    monkeypatch.setattr(engine, 'fetch_city', failing)
+    try:
+        assert engine.run_cycle() == 4
+        writer.flush()
+        assert observations(db_path) == 4
+        assert engine.errors == {CITIES[2]: 1}
+    finally:
+        engine.close()
+
+
+def test_scheduled_fetch_errors_are_counted(mock_api, writer, monkeypatch):
+    engine = IngestionEngine(CITIES[:1], rate_limit=0, writer=writer, base_url=mock_api.base_url)
+    monkeypatch.setattr(engine, 'fetch_city', lambda city: 1 / 0)
+    engine.submit(engine.store_city, CITIES[0])
+    engine.close()
+    assert engine.errors == {CITIES[0]: 1}
+
+
+@pytest.mark.parametrize('engine_class', [IngestionEngine, GroupIngestionEngine])
+def test_replaying_observations_ingested_live_inserts_nothing(engine_class, mock_api, writer, db_path, tmp_path):
+    engine = engine_class(['tokyo,jp'], rate_limit=0, writer=writer, base_url=mock_api.base_url)
+    try:
+        engine.run_cycle()  # the group engine resolves the id of the city with a single request
+        mock_api.dt += 600
+        engine.run_cycle()
+    finally:
+        engine.close()
+    writer.flush()
+
+    conn = sqlite3.connect(db_path)
+    rollups = conn.execute('SELECT * FROM rollup_hourly ORDER BY bucket').fetchall()
+    path = tmp_path / 'capture.jsonl'
+    path.write_text(''.join(json.dumps(weather_payload('Tokyo', dt)) + '\n' for dt in (mock_api.dt - 600, mock_api.dt)))
+    assert backfill(str(path), db_path)['inserted'] == 0
+    assert conn.execute('SELECT name FROM city').fetchall() == [('Tokyo',)]
+    assert observations(db_path) == 2
+    assert conn.execute('SELECT * FROM rollup_hourly ORDER BY bucket').fetchall() == rollups
+    conn.close()
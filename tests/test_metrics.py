@@ -0,0 +1,35 @@
+import io
+import json
+import logging
+
+import metrics
+
+
+class Recorder(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.records = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+def test_events_are_silent_until_json_logs_are_enabled(monkeypatch):
+    monkeypatch.setattr(metrics.logger, 'handlers', list(metrics.logger.handlers))
+    monkeypatch.setattr(metrics.logger, 'level', metrics.logger.level)
+    monkeypatch.setattr(metrics.logger, 'propagate', metrics.logger.propagate)
+    # nothing reaches the root handlers, nor the last resort one printing errors to stderr
+    root, last_resort = Recorder(), Recorder()
+    monkeypatch.setattr(logging, 'lastResort', last_resort)
+    logging.getLogger().addHandler(root)
+    try:
+        metrics.log_event('ingest_error', level=logging.ERROR, key='Tokyo')
+    finally:
+        logging.getLogger().removeHandler(root)
+    assert root.records == last_resort.records == []
+
+    stream = io.StringIO()
+    metrics.enable_json_logs(stream)
+    metrics.log_event('ingest_error', level=logging.ERROR, key='Tokyo')
+    entry = json.loads(stream.getvalue())
+    assert (entry['event'], entry['level'], entry['key']) == ('ingest_error', 'error', 'Tokyo')
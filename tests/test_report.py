@@ -0,0 +1,32 @@
+import pytest
+
+import schema
+from conftest import observation
+from db_writer import BatchWriter
+from report import data_fingerprint
+
+DAY = schema.to_epoch('2024-10-02T00:00:00')
+
+
+def fingerprint(db_path: str, grain: str) -> str:
+    conn = schema.connect(db_path)
+    try:
+        return data_fingerprint(conn, ['Tokyo'], '2024-10-02T06:00:00', '2024-10-02T12:00:00', grain)
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('grain, changed', [('h', False), ('D', True), ('W', True)])
+def test_fingerprint_covers_the_buckets_drawn(db_path, grain, changed):
+    with BatchWriter(db_path) as writer:
+        writer.write_many([observation(DAY + 6 * 3600, 10.0)])
+    before = fingerprint(db_path, grain)
+
+    # after the range, in its last daily and weekly buckets
+    with BatchWriter(db_path) as writer:
+        writer.write_many([observation(DAY + 20 * 3600, 30.0)])
+    assert (fingerprint(db_path, grain) != before) == changed
+
+
+def test_fingerprint_depends_on_the_grain(db_path):
+    assert fingerprint(db_path, 'h') != fingerprint(db_path, 'D')
@@ -0,0 +1,43 @@
+import sqlite3
+import time
+
+from conftest import observation, observations
+from db_writer import BatchWriter
+from retention import apply_retention
+
+DAY = 86400
+NOW = int(time.time())
+OLD = NOW - NOW % 3600 - 100 * DAY
+MONTH_OLD = NOW - NOW % 3600 - 40 * DAY
+
+
+def hourly(db_path: str) -> list[tuple]:
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('SELECT bucket, temp_count, temp_sum FROM rollup_hourly ORDER BY bucket').fetchall()
+    finally:
+        conn.close()
+
+
+def test_pruned_observations_are_not_counted_again(db_path):
+    with BatchWriter(db_path) as writer:
+        writer.write_many([observation(OLD + i * 60, float(i)) for i in range(5)] + [observation(NOW - 3600, 20.0)])
+    rollups = hourly(db_path)
+
+    assert apply_retention(db_path, raw_days=90, pause=0)['pruned'] == 5
+    with BatchWriter(db_path) as writer:
+        writer.write_many([observation(OLD, 0.0), observation(OLD + 30, 7.0)])
+    assert hourly(db_path) == rollups
+    assert observations(db_path) == 1
+
+
+def test_thinned_observations_are_not_counted_again(db_path):
+    with BatchWriter(db_path) as writer:
+        writer.write_many([observation(MONTH_OLD + i * 60, float(i)) for i in range(20)])
+    rollups = hourly(db_path)
+
+    assert apply_retention(db_path, raw_days=None, thin_days=30, thin_seconds=600, pause=0)['thinned'] == 18
+    with BatchWriter(db_path) as writer:
+        writer.write_many([observation(MONTH_OLD + 60, 1.0)])
+    assert hourly(db_path) == rollups
+    assert observations(db_path) == 2
@@ -0,0 +1,94 @@
+import json
+import random
+import sqlite3
+
+import pytest
+
+import schema
+import weather_data_analysis as an
+from backfill import backfill
+from db_writer import BatchWriter
+from mock_api import weather_payload
+
+START = schema.to_epoch('2024-10-01T00:00:00')
+
+
+def random_rows(n: int, seed: int = 0) -> list[tuple[str, dict]]:
+    rng = random.Random(seed)
+    return [(rng.choice(['Tokyo', 'Paris']), {'timestamp': START + rng.randrange(3 * 86400),
+                                              'temperature': round(rng.uniform(-5, 30), 2),
+                                              'humidity': rng.randint(20, 100), 'weather': 'mist'})
+            for _ in range(n)]
+
+
+def rollups(db_path: str) -> dict:
+    conn = sqlite3.connect(db_path)
+    try:
+        # by city name, as the city ids depend on the order in which the cities were first written
+        return {table: conn.execute(f'''SELECT city.name, bucket, temp_count, temp_sum, temp_min, temp_max, temp_sumsq
+                                    FROM {table} JOIN city USING (city_id) ORDER BY city.name, bucket''').fetchall()
+                for table, _ in schema.ROLLUPS.values()}
+    finally:
+        conn.close()
+
+
+def rebuilt(db_path: str) -> dict:
+    conn = sqlite3.connect(db_path)
+    with conn:
+        schema.rebuild_rollups(conn)
+    conn.close()
+    return rollups(db_path)
+
+
+def assert_same_rollups(actual: dict, expected: dict) -> None:
+    for table, rows in expected.items():
+        assert len(actual[table]) == len(rows)
+        for got, want in zip(actual[table], rows):
+            assert got[:3] == want[:3]
+            assert got[3:] == pytest.approx(want[3:])
+
+
+def test_trigger_keeps_the_rollups_equal_to_the_raw_observations(db_path):
+    with BatchWriter(db_path, batch_size=100) as writer:
+        writer.write_many(random_rows(1000))
+    assert_same_rollups(rollups(db_path), rebuilt(db_path))
+
+
+def test_duplicates_and_missing_temperatures_are_not_counted(db_path):
+    row = ('Tokyo', {'timestamp': START, 'temperature': 10.0, 'humidity': 50, 'weather': 'mist'})
+    missing = ('Tokyo', {'timestamp': START + 60, 'temperature': None, 'humidity': 50, 'weather': 'mist'})
+    with BatchWriter(db_path) as writer:
+        writer.write_many([row, row, missing])
+        writer.flush()
+        writer.write_many([row])
+    assert rollups(db_path)['rollup_hourly'] == [('Tokyo', START, 1, 10.0, 10.0, 10.0, 100.0)]
+
+
+def test_backfill_merges_the_same_statistics_as_the_trigger(tmp_path):
+    rows = random_rows(500, seed=1)
+    triggered = str(tmp_path / 'trigger.db')
+    with BatchWriter(triggered) as writer:
+        writer.write_many(rows)
+
+    path = tmp_path / 'payloads.jsonl'
+    with open(path, 'w', encoding='utf-8') as f:
+        for city, wd in rows:
+            payload = weather_payload(city, wd['timestamp'])
+            payload['main'] = {'temp': wd['temperature'], 'humidity': wd['humidity']}
+            f.write(json.dumps(payload) + '\n')
+    merged = str(tmp_path / 'backfill.db')
+    backfill(str(path), merged, batch_size=128)
+    assert_same_rollups(rollups(merged), rollups(triggered))
+
+
+def test_rollup_queries_derive_mean_and_std(analysis_db):
+    rows = random_rows(400, seed=2)
+    with BatchWriter(analysis_db) as writer:
+        writer.write_many(rows)
+    df = an.fetch_temperature_rollups(['Tokyo'], '2024-10-01', '2024-10-03T23:59:59', 'D')
+
+    raw = an.fetch_data_from_db('Tokyo', '2024-10-01', '2024-10-03T23:59:59', ['temperature'])
+    daily = raw['temperature'].astype('float64').resample('D')
+    assert df['count'].tolist() == daily.count().tolist()
+    assert df['mean'].tolist() == pytest.approx(daily.mean().tolist())
+    assert df['std'].tolist() == pytest.approx(daily.std().tolist())
@@ -0,0 +1,139 @@
+import sqlite3
+import time
+
+import pytest
+
+import schema
+
+
+def migrate_to(conn: sqlite3.Connection, version: int) -> None:
+    """
+    Runs the first migrations only, leaving the database at an older schema version.
+    """
+    for step in range(version):
+        schema.MIGRATIONS[step](conn, schema.LEGACY_CITY)
+        conn.execute(f'PRAGMA user_version = {step + 1}')
+    conn.commit()
+
+
+def test_new_database_is_created_at_the_current_version(db_path):
+    conn = sqlite3.connect(db_path)
+    names = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")}
+    assert schema.schema_version(conn) == schema.SCHEMA_VERSION
+    assert {'city', 'observation', 'description', 'rollup_hourly', 'rollup_daily', 'backfill_checkpoint',
+            'weather'} <= names
+    assert conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    conn.close()
+
+
+def test_legacy_weather_tables_are_moved_into_the_keyed_schema(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE weather (timestamp DATE, temperature REAL, humidity INTEGER, weather TEXT)')
+    conn.executemany('INSERT INTO weather VALUES (?, ?, ?, ?)', [
+        ('2024-10-01 10:00:00', 25.5, 80, 'light rain'),
+        ('2024-10-01T10:01:00', 25.7, 79, 'light rain'),
+        ('not a date', 0, 0, 'mist'),
+    ])
+    conn.execute('CREATE TABLE new_york_weather (timestamp DATE, temperature REAL, humidity INTEGER, weather TEXT)')
+    conn.executemany('INSERT INTO new_york_weather VALUES (?, ?, ?, ?)', [
+        ('2024-10-01 10:00:00', 15.0, 60, 'clear sky'),
+        ('2024-10-01 10:00:00', 15.0, 60, 'clear sky'),
+    ])
+    conn.commit()
+    conn.close()
+
+    conn = schema.connect(path)
+    rows = conn.execute('SELECT city, timestamp, temperature, humidity, weather FROM weather '
+                        'ORDER BY city, timestamp').fetchall()
+    assert rows == [
+        ('Hong Kong', '2024-10-01T10:00:00', 25.5, 80, 'light rain'),
+        ('Hong Kong', '2024-10-01T10:01:00', 25.7, 79, 'light rain'),
+        ('New York', '2024-10-01T10:00:00', 15.0, 60, 'clear sky'),
+    ]
+    assert conn.execute('SELECT timestamp FROM observation ORDER BY rowid LIMIT 1').fetchone()[0] == \
+        schema.to_epoch('2024-10-01T10:00:00')
+    tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert 'new_york_weather' not in tables
+    # the rollups are filled from the migrated rows
+    assert conn.execute('SELECT SUM(temp_count) FROM rollup_hourly').fetchone()[0] == 3
+    conn.close()
+
+
+@pytest.fixture
+def hong_kong_time(monkeypatch):
+    monkeypatch.setenv('TZ', 'Asia/Hong_Kong')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_legacy_timestamps_are_read_in_local_time(tmp_path, hong_kong_time):
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE weather (timestamp DATE, temperature REAL, humidity INTEGER, weather TEXT)')
+    conn.executemany('INSERT INTO weather VALUES (?, ?, ?, ?)', [
+        ('2024-10-01T18:00:00.123456', 25.5, 80, 'light rain'),
+        ('2024-10-01T18:01:00+00:00', 25.7, 79, 'light rain'),
+    ])
+    conn.commit()
+    conn.close()
+
+    conn = schema.connect(path)
+    assert conn.execute('SELECT timestamp FROM observation ORDER BY timestamp').fetchall() == \
+        [(schema.to_epoch('2024-10-01T10:00:00'),), (schema.to_epoch('2024-10-01T18:01:00'),)]
+    conn.close()
+
+
+def test_upgrade_from_an_older_version_keeps_rows_and_rowids(tmp_path):
+    path = str(tmp_path / 'v4.db')
+    conn = sqlite3.connect(path)
+    migrate_to(conn, 4)
+    conn.execute("INSERT INTO city (name) VALUES ('Tokyo')")
+    conn.executemany('INSERT INTO observation (rowid, city_id, timestamp, temperature, humidity, weather) '
+                     'VALUES (?, 1, ?, ?, 50, ?)',
+                     [(10, 1_700_000_000, 10.0, 'mist'), (20, 1_700_000_060, 11.0, 'mist'),
+                      (30, 1_700_000_120, 12.0, None)])
+    conn.commit()
+    before = conn.execute('SELECT * FROM rollup_hourly').fetchall()
+    conn.close()
+
+    conn = schema.connect(path)
+    assert schema.schema_version(conn) == schema.SCHEMA_VERSION
+    assert conn.execute('SELECT rowid, description_id FROM observation ORDER BY rowid').fetchall() == \
+        [(10, 1), (20, 1), (30, None)]
+    assert conn.execute('SELECT weather FROM weather ORDER BY timestamp').fetchall() == [('mist',), ('mist',), (None,)]
+    assert conn.execute('SELECT * FROM rollup_hourly').fetchall() == before
+    # the trigger was recreated on the rebuilt table
+    conn.execute(schema.INSERT_OBSERVATION_SQL, (1, 1_700_000_180, 13.0, 50, None))
+    assert conn.execute('SELECT temp_count FROM rollup_hourly').fetchone()[0] == 4
+    conn.close()
+
+
+def test_connect_is_idempotent(db_path):
+    conn = schema.connect(db_path)
+    assert schema.migrate(conn) == schema.SCHEMA_VERSION
+    conn.close()
+
+
+def test_newer_schema_versions_are_refused(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute(f'PRAGMA user_version = {schema.SCHEMA_VERSION + 1}')
+    with pytest.raises(RuntimeError):
+        schema.migrate(conn)
+    conn.close()
+
+
+def test_readonly_connections_require_the_current_version(tmp_path, db_path):
+    conn = schema.connect_readonly(db_path)
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("INSERT INTO city (name) VALUES ('Tokyo')")
+    conn.close()
+
+    old = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(old)
+    migrate_to(conn, 1)
+    conn.close()
+    with pytest.raises(RuntimeError):
+        schema.connect_readonly(old)
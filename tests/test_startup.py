@@ -0,0 +1,13 @@
+import pytest
+
+from benchmark import bench_startup
+
+# seconds of wall time, interpreter start included, as `benchmark.py startup --budget 1`
+BUDGET = 1
+
+
+@pytest.mark.parametrize('module', ['gui', 'ingest'])
+def test_entry_point_starts_without_the_heavy_libraries(module):
+    timing = bench_startup([module])[module]
+    assert timing['heavy_modules'] == []  # none of benchmark.HEAVY_MODULES
+    assert timing['wall_ms'] < BUDGET * 1000
@@ -0,0 +1,28 @@
+import time
+
+from conftest import observation
+from db_writer import BatchWriter
+from streaming import StreamingAggregator
+
+NOW = int(time.time())
+HOUR = NOW - NOW % 3600
+
+
+def test_listeners_only_receive_the_rows_inserted(db_path):
+    aggregator = StreamingAggregator(db_path=db_path)
+    aggregator.prime()
+    with BatchWriter(db_path) as writer:
+        writer.add_listener(aggregator.on_flush)
+        writer.write_many([observation(HOUR, 10.0), observation(HOUR, 30.0), observation(HOUR + 60, 20.0)])
+        writer.flush()
+        writer.write_many([observation(HOUR + 60, 50.0), observation(HOUR + 120, 30.0)])
+
+    hour = aggregator.snapshot('Tokyo').dropna().iloc[-1]
+    assert hour['count'] == 3
+    assert hour['mean'] == 20.0
+    assert hour['max'] == 30.0
+
+    # the same statistics as a fresh aggregator primed from the rollup
+    primed = StreamingAggregator(db_path=db_path)
+    primed.prime()
+    assert primed.snapshot('Tokyo').dropna().equals(aggregator.snapshot('Tokyo').dropna())
@@ -0,0 +1,36 @@
+import sys
+import time
+
+from conftest import observation, observations
+from supervisor import Supervisor
+
+CITIES = [f'City {i}' for i in range(20)]
+
+
+def test_stop_lets_the_workers_exit_on_their_own(mock_api, db_path):
+    supervisor = Supervisor(CITIES, workers=2, interval=1, db_path=db_path, stop_timeout=20, rate_limit=0,
+                            base_url=mock_api.base_url)
+    supervisor._start_writer()
+    supervisor.workers = [supervisor._start_worker(index, None) for index in range(len(supervisor.shards))]
+    deadline = time.monotonic() + 20
+    while len(supervisor.cycle_stats.get(0, {})) < len(supervisor.shards) and time.monotonic() < deadline:
+        supervisor._collect_events()
+        time.sleep(0.05)
+
+    # the workers are now waiting for their next cycle, a minute away
+    started = time.monotonic()
+    supervisor.stop()
+    assert time.monotonic() - started < 10
+    assert [process.exitcode for process in supervisor.workers] == [0] * len(supervisor.shards)
+    assert supervisor.writer.exitcode == 0
+    assert observations(db_path) == len(CITIES)
+
+
+def test_stop_stores_the_queued_rows_of_a_dead_writer(db_path):
+    supervisor = Supervisor(CITIES, workers=2, db_path=db_path)
+    supervisor.writer = supervisor.context.Process(target=sys.exit, args=(1,))
+    supervisor.writer.start()
+    supervisor.writer.join()
+    supervisor.rows_queue.put(('rows', [observation(1_700_000_000, 10.0), observation(1_700_000_600, 12.0)]))
+    supervisor.stop()
+    assert observations(db_path) == 2